@@ -1,11 +1,24 @@
+import asyncio
+import collections
+import copy
+import datetime
+import functools
+import inspect
 import json
 import logging
 import threading
 import time
 import uuid
 from contextlib import contextmanager
+from typing import Any
 from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
 
 import pika
@@ -13,11 +26,67 @@ from flask import current_app
 from flask import Flask
 from retry import retry
 
+from .aio import AsyncioClient
+from .autoscale import Autoscaler
+from .autoscale import ScaledQueue
+from .blobstore import BlobStore  # noqa: F401
+from .blobstore import ClaimCheck
+from .blobstore import FileSystemBlobStore
+from .breaker import CircuitBreaker
+from .breaker import CircuitBreakers
+from .cache import make_key
+from .cache import ResponseCache
+from .chunking import is_chunk
+from .chunking import Reassembler
+from .chunking import split_message
+from .chunking import without_chunk_headers
+from .cli import cli
 from .consumer import ReconnectingConsumer
+from .cooperative import is_monkey_patched
+from .cooperative import SharedRpcClient
+from .dedup import BloomDedupFilter  # noqa: F401
+from .dedup import DedupFilter
+from .dedup import LRUDedupFilter
+from .dedup import SqliteDedupFilter  # noqa: F401
+from .encoder import Codec
+from .encoder import JSONCodec  # noqa: F401
+from .encoder import TextCodec  # noqa: F401
 from .encoder import UUIDEncoder
+from .exceptions import CircuitOpenError
 from .exceptions import ExchangeTypeError
+from .exceptions import PublishBlockedError
+from .exceptions import SpoolFullError
 from .exceptions import SyncTimeoutError
 from .exchange import ExchangeType
+from .failover import BrokerPool
+from .flow import FlowControl
+from .headers import CACHE_TTL_HEADER
+from .headers import CLAIM_CHECK_HEADER
+from .headers import DEADLINE_HEADER
+from .headers import DELAY_EXCHANGE_HEADER
+from .headers import DELAY_ROUTING_KEY_HEADER
+from .headers import DELAY_UNTIL_HEADER
+from .headers import RECEIVED_AT_HEADER
+from .headers import STREAM_END_HEADER
+from .headers import STREAM_SEQ_HEADER
+from .hedge import HedgeBudget
+from .metrics import LatencyTracker
+from .metrics import Metrics
+from .profiling import HandlerProfiler
+from .publisher import Publisher
+from .router import Router
+from .scheduler import DELAYED_QUEUE
+from .scheduler import TimingWheel
+from .sharding import ShardedQueue
+from .singleflight import SingleFlight
+from .spool import Spool
+from .spool import SpoolReplayer
+from .tracing import InMemorySpanExporter
+from .tracing import LoggingSpanExporter
+from .tracing import Span  # noqa: F401
+from .tracing import SpanExporter  # noqa: F401
+from .tracing import Tracer
+from .utils import logger
 
 __version__ = "1.1.4"
 
@@ -38,6 +107,30 @@ class _ConeyState:
         self.coney = coney
         self.consumer_threads = []
         self.data = {}
+        self.metrics = Metrics()
+        self.spool = None
+        self.spool_replayer = None
+        self.flow = FlowControl(metrics=self.metrics)
+        self.rpc_cache = ResponseCache(metrics=self.metrics)
+        self.rpc_flights = SingleFlight(metrics=self.metrics)
+        self.rpc_latency = LatencyTracker()
+        self.hedge_budget = HedgeBudget()
+        self.breakers = None
+        self.reassembler = Reassembler(metrics=self.metrics)
+        self.chunk_prefetch = 64
+        self.blob_store = None
+        self.sharded_queues = {}
+        self.routers = {}
+        self.timing_wheel = TimingWheel()
+        self.delay_buckets = []
+        self.delay_queues = set()
+        self.delay_lock = threading.Lock()
+        self.autoscaler = None
+        self.brokers = None
+        self.aio = None
+        self.rpc_client = None
+        self.profiler = None
+        self.tracer = None
 
 
 class Coney:
@@ -84,6 +177,8 @@ class Coney:
         self.app = app
         self.thread = None
         self.testing = testing
+        self.message_teardown_funcs: List[Callable] = []
+        self._message_local = threading.local()
         if app is not None:
             self.init_app(app)
 
@@ -100,9 +195,110 @@ class Coney:
         if not (app.config.get("CONEY_BROKER_URI")):
             raise RuntimeError("CONEY_BROKER_URI needs to be set")
 
-        self.broker_uri = app.config.get("CONEY_BROKER_URI")
-
-        app.extensions["coney"] = _ConeyState(self)
+        # a list of the URIs of the nodes of a cluster is failed over
+        broker_uris = app.config["CONEY_BROKER_URI"]
+        if isinstance(broker_uris, str):
+            broker_uris = [broker_uris]
+        self.broker_uri = broker_uris[0]
+
+        state = _ConeyState(self)
+        state.brokers = BrokerPool(
+            broker_uris,
+            base_delay=app.config.get("CONEY_RECONNECT_BASE_DELAY", 0.1),
+            max_delay=app.config.get("CONEY_RECONNECT_MAX_DELAY", 30),
+            metrics=state.metrics,
+        )
+        state.flow.probe_interval = app.config.get("CONEY_BLOCKED_PROBE_INTERVAL", 1.0)
+        state.rpc_cache.max_size = app.config.get("CONEY_RPC_CACHE_SIZE", 1024)
+        state.hedge_budget.ratio = app.config.get("CONEY_HEDGE_BUDGET", 0.1)
+        state.reassembler.timeout = app.config.get("CONEY_CHUNK_TIMEOUT", 60)
+        state.reassembler.memory_bytes = app.config.get(
+            "CONEY_CHUNK_MEMORY_BYTES", 8 * 1024 * 1024
+        )
+        state.chunk_prefetch = app.config.get("CONEY_CHUNK_PREFETCH", 64)
+        if app.config.get("CONEY_CIRCUIT_BREAKER_THRESHOLD"):
+            state.breakers = CircuitBreakers(
+                failure_threshold=app.config["CONEY_CIRCUIT_BREAKER_THRESHOLD"],
+                reset_timeout=app.config.get("CONEY_CIRCUIT_BREAKER_RESET_TIMEOUT", 30),
+                metrics=state.metrics,
+            )
+        state.timing_wheel = TimingWheel(
+            tick=app.config.get("CONEY_TIMING_WHEEL_TICK", 0.1),
+            slots=app.config.get("CONEY_TIMING_WHEEL_SLOTS", 1024),
+        )
+        state.delay_buckets = sorted(
+            app.config.get("CONEY_DELAY_BUCKETS", [60, 600, 3600, 21600, 86400])
+        )
+        if state.delay_buckets and state.delay_buckets[0] > state.timing_wheel.horizon:
+            raise RuntimeError(
+                "The smallest of CONEY_DELAY_BUCKETS may not exceed the"
+                " horizon of the timing wheel"
+            )
+        state.autoscaler = Autoscaler(
+            functools.partial(self._queue_depth, app),
+            interval=app.config.get("CONEY_AUTOSCALE_INTERVAL", 5),
+            target_depth=app.config.get("CONEY_AUTOSCALE_TARGET_DEPTH", 100),
+            metrics=state.metrics,
+        )
+        state.blob_store = app.config.get("CONEY_BLOB_STORE")
+        if state.blob_store is None and app.config.get("CONEY_BLOB_STORE_PATH"):
+            state.blob_store = FileSystemBlobStore(app.config["CONEY_BLOB_STORE_PATH"])
+        if (
+            app.config.get("CONEY_CLAIM_CHECK_THRESHOLD") is not None
+            and state.blob_store is None
+        ):
+            raise RuntimeError(
+                "CONEY_BLOB_STORE or CONEY_BLOB_STORE_PATH needs to be set"
+                " for CONEY_CLAIM_CHECK_THRESHOLD"
+            )
+        state.aio = AsyncioClient(
+            state.brokers, receive=functools.partial(self._receive_body, app)
+        )
+        cooperative = app.config.get("CONEY_COOPERATIVE")
+        if cooperative is None:
+            cooperative = is_monkey_patched()
+        if cooperative:
+            state.rpc_client = SharedRpcClient(
+                functools.partial(self._shared_connection, app),
+                receive=functools.partial(self._receive_body, app),
+            )
+        sample_rate = app.config.get("CONEY_PROFILE_SAMPLE_RATE")
+        slow_threshold = app.config.get("CONEY_SLOW_MESSAGE_THRESHOLD")
+        if sample_rate or slow_threshold is not None:
+            state.profiler = HandlerProfiler(
+                sample_rate=sample_rate,
+                cpu=app.config.get("CONEY_PROFILE_CPU", True),
+                memory=app.config.get("CONEY_PROFILE_MEMORY", False),
+                slow_threshold=slow_threshold,
+                directory=app.config.get("CONEY_PROFILE_DIR"),
+                dump_interval=app.config.get("CONEY_PROFILE_DUMP_INTERVAL", 10),
+                metrics=state.metrics,
+            )
+        exporter = app.config.get("CONEY_SPAN_EXPORTER")
+        if exporter == "memory":
+            exporter = InMemorySpanExporter()
+        elif exporter == "log":
+            exporter = LoggingSpanExporter()
+        if exporter is not None:
+            state.tracer = Tracer(exporter)
+        app.extensions["coney"] = state
+        app.cli.add_command(cli)
+
+        if app.config.get("CONEY_SPOOL_PATH"):
+            state.spool = Spool(
+                app.config["CONEY_SPOOL_PATH"],
+                max_messages=app.config.get("CONEY_SPOOL_MAX_MESSAGES", 10000),
+            )
+            state.metrics.set("spool.depth", len(state.spool))
+            state.spool_replayer = SpoolReplayer(
+                state.spool,
+                lambda: self.channel(app),
+                interval=app.config.get("CONEY_SPOOL_REPLAY_INTERVAL", 1.0),
+                metrics=state.metrics,
+                max_frame_bytes=app.config.get("CONEY_MAX_FRAME_BYTES"),
+            )
+            if not self.testing:
+                state.spool_replayer.start()
 
     def get_app(self, reference_app: Flask = None):
         """
@@ -125,8 +321,33 @@ class Coney:
             " http://mikebarkmin.github.io/flask-coney/contexts/."
         )
 
+    def get_metrics(self, app: Flask = None) -> dict:
+        """Returns a snapshot of the counters and gauges recorded by Coney
+
+        :param app: A flask app
+        """
+        return get_state(self.get_app(app)).metrics.snapshot()
+
+    def get_profile_report(self, app: Flask = None, queue: str = None) -> str:
+        """
+        Returns the profiles of the handlers aggregated per queue as text,
+        e.g. for a debug endpoint. The consumers profile every
+        ``CONEY_PROFILE_SAMPLE_RATE``-th message of a queue. With
+        ``CONEY_PROFILE_DIR`` the profiles are written to files as well,
+        which ``flask coney profile`` merges for all processes.
+
+        :param app: A flask app
+        :param queue: Only report this queue
+        """
+        profiler = get_state(self.get_app(app)).profiler
+        if profiler is None:
+            return ""
+        return profiler.report(queue)
+
     @contextmanager
-    def channel(self, app: Flask = None) -> pika.channel.Channel:
+    def channel(
+        self, app: Flask = None, blocked_connection_timeout: float = None
+    ) -> pika.channel.Channel:
         """Provides context for a channel.
 
         Example::
@@ -135,13 +356,16 @@ class Coney:
                 ch.basic_publish()
 
         :param app: A flask app
+        :param blocked_connection_timeout: see :meth:`connection`
         """
-        with self.connection() as c:
+        with self.connection(app, blocked_connection_timeout) as c:
             yield c.channel()
 
     @contextmanager
     @retry(pika.exceptions.AMQPConnectionError, tries=4, delay=1, jitter=3)
-    def connection(self, app: Flask = None) -> pika.BlockingConnection:
+    def connection(
+        self, app: Flask = None, blocked_connection_timeout: float = None
+    ) -> pika.BlockingConnection:
         """Provides context for a connection.
 
         Example::
@@ -149,16 +373,41 @@ class Coney:
             with connection(app) as c:
                 c.channel()
 
+        The connection reports ``connection.blocked`` and
+        ``connection.unblocked`` notifications of the broker to Coney, so
+        :meth:`publish` can fail fast while the broker blocks publishers.
+
+        If ``CONEY_BROKER_URI`` lists several nodes, the healthy ones are
+        tried first, see :class:`BrokerPool`.
+
         :param app: A flask app
+        :param blocked_connection_timeout: Seconds the broker may block the
+            connection before it is torn down with
+            :class:`pika.exceptions.ConnectionBlockedTimeout`. Defaults to
+            ``CONEY_BLOCKED_CONNECTION_TIMEOUT``.
         """
         app = self.get_app(app)
-        params = pika.URLParameters(self.broker_uri)
-        connection = pika.BlockingConnection(params)
+        state = get_state(app)
+        if blocked_connection_timeout is None:
+            blocked_connection_timeout = app.config.get(
+                "CONEY_BLOCKED_CONNECTION_TIMEOUT"
+            )
+        connection = state.brokers.connect(blocked_connection_timeout)
+        state.flow.watch(connection)
 
         try:
             yield connection
         finally:
-            connection.close()
+            if connection.is_open:
+                connection.close()
+
+    def _shared_connection(
+        self, app: Flask, blocked_connection_timeout: float = None
+    ) -> pika.BlockingConnection:
+        state = get_state(app)
+        connection = state.brokers.connect(blocked_connection_timeout)
+        state.flow.watch(connection)
+        return connection
 
     def queue(
         self,
@@ -167,6 +416,12 @@ class Coney:
         exchange_type: ExchangeType = ExchangeType.DIRECT,
         routing_key: str = None,
         routing_keys: List[str] = None,
+        lazy_claim_check: bool = False,
+        retries: List[float] = None,
+        dedup: Union[bool, DedupFilter] = False,
+        min_consumers: int = 1,
+        max_consumers: int = None,
+        chunked: bool = False,
         app: Flask = None,
     ) -> Callable:
         """
@@ -189,12 +444,89 @@ class Coney:
         If routing_keys and a routing_key is provided, they will be
         combined.
 
+        Payloads offloaded to the blob store because of
+        ``CONEY_CLAIM_CHECK_THRESHOLD`` are fetched before the function is
+        called. With ``lazy_claim_check`` the function gets a
+        :class:`ClaimCheck` instead and fetches the payload itself, e.g.
+        memory-mapped without copying it::
+
+            @coney.queue(queue_name="videos", lazy_claim_check=True)
+            def queue_videos(ch, method, props, body):
+                if isinstance(body, ClaimCheck):
+                    body = body.mmap()
+                transcode(body)
+
+        Without ``retries`` a message is acknowledged before the function is
+        called. With ``retries`` it is acknowledged afterwards, and if the
+        function raises, the message is moved to a retry queue. Once the
+        delay of the retry queue passed, the broker dead-letters the message
+        back to the queue. A message which still fails after the last retry
+        is moved to the parking lot queue ``<queue_name>.parking-lot``::
+
+            @coney.queue(queue_name="orders", retries=[1, 10, 60])
+            def queue_orders(ch, method, props, body):
+                charge(body)
+
+        With ``dedup`` a message is skipped, if a message with the same
+        ``message_id`` was already handled. :meth:`publish` sets a unique
+        ``message_id`` on every message. Pass ``True`` to remember the ids
+        in memory with a :class:`LRUDedupFilter`, or a
+        :class:`BloomDedupFilter` to bound the memory use, or a
+        :class:`SqliteDedupFilter` to share the ids with other processes::
+
+            @coney.queue(queue_name="invoices", dedup=True)
+            def queue_invoices(ch, method, props, body):
+                send_invoice(body)
+
+        The id is remembered once the function returned, so a message which
+        failed can be retried.
+
+        With ``max_consumers`` the queue is consumed by between
+        ``min_consumers`` and ``max_consumers`` consumers, each with its own
+        connection and thread. Every ``CONEY_AUTOSCALE_INTERVAL`` seconds
+        the depth of the queue is sampled and the number of consumers is
+        scaled so every consumer has about ``CONEY_AUTOSCALE_TARGET_DEPTH``
+        messages waiting::
+
+            @coney.queue(queue_name="thumbnails", min_consumers=1, max_consumers=8)
+            def queue_thumbnails(ch, method, props, body):
+                render(body)
+
+        Messages larger than ``CONEY_MAX_FRAME_BYTES`` arrive in chunks,
+        which are only joined by a ``chunked`` queue and rejected by other
+        queues. All chunks of a message must reach the same consumer, so a
+        chunked queue is declared with ``x-single-active-consumer`` and can
+        not be autoscaled. Its consumer holds the acks of up to
+        ``CONEY_CHUNK_PREFETCH`` chunks until their message is complete::
+
+            @coney.queue(queue_name="reports", chunked=True)
+            def queue_reports(ch, method, props, body):
+                store(body)
+
+        Handlers can be coroutine functions. Each consumer thread runs them on
+        an event loop of its own, one message at a time, so they may use the
+        channel and the app context like other handlers::
+
+            @coney.queue(queue_name="enrich")
+            async def queue_enrich(ch, method, props, body):
+                profile = await coney.apublish_sync(body, routing_key="profile")
+                await coney.apublish({**body, **profile}, routing_key="enriched")
+
         :param type: ExchangeType
         :param queue_name: Name of the queue
         :param exchange_name: Name of the exchange
         :param exchange_type: Type of the exchange
         :param routing_key: The routing key
         :param routing_keys: A list of routing keys
+        :param lazy_claim_check: Pass claim-checked payloads as
+            :class:`ClaimCheck`
+        :param retries: Delays in seconds between the retries of failed
+            messages
+        :param dedup: Skip messages which were already handled
+        :param min_consumers: Lower bound of consumers when autoscaling
+        :param max_consumers: Upper bound of consumers, enables autoscaling.
+            Not available for chunked queues.
+        :param chunked: Join messages split into chunks
         :param app: A flask app
         """
         app = self.get_app(app)
@@ -219,30 +551,277 @@ class Coney:
         else:
             raise ExchangeTypeError(f"Exchange type {exchange_type} is not supported")
 
+        if retries and not queue_name:
+            raise RuntimeError("Retries need a named queue")
+
+        if dedup is True:
+            dedup = LRUDedupFilter()
+
+        if max_consumers is not None and not queue_name:
+            raise RuntimeError("Autoscaling needs a named queue")
+        if max_consumers is not None and chunked:
+            raise RuntimeError(
+                "Autoscaling needs competing consumers, which a chunked queue"
+                " can not have"
+            )
+
         def decorator(func):
-            consumer = ReconnectingConsumer(
-                self.broker_uri,
+            start_consumer = functools.partial(
+                self._start_consumer,
+                app,
                 exchange=exchange_name,
                 exchange_type=exchange_type,
                 queue=queue_name,
                 routing_keys=routing_keys + [routing_key],
-                on_message=func,
+                lazy_claim_check=lazy_claim_check,
+                retries=retries or None,
+                dedup=dedup or None,
+                chunked=chunked,
+                prefetch_count=state.chunk_prefetch if chunked else 1,
             )
-            thread = threading.Thread(target=consumer.run)
-            state.consumer_threads.append((consumer, thread))
-            thread.start()
+            handler = self._sync_handler(app, func)
+            if max_consumers is None:
+                start_consumer(on_message=handler)
+                return func
+
+            scaled_queue = ScaledQueue(
+                queue_name,
+                handler,
+                lambda handler: start_consumer(on_message=handler),
+                functools.partial(self._stop_consumer, state),
+                min_consumers=min_consumers,
+                max_consumers=max_consumers,
+            )
+            state.autoscaler.add(scaled_queue)
+            if not self.testing:
+                state.autoscaler.start()
             return func
 
         return decorator
 
-    def _accept(self, corr_id: str, result: str, app: Flask = None):
+    def handler(
+        self,
+        routing_key: str,
+        exchange_name: str,
+        queue_name: str = "",
+        app: Flask = None,
+    ) -> Callable:
+        """
+        A decorator for handling the messages of a topic exchange, whose
+        routing key matches a pattern. All handlers of the same exchange and
+        queue share one queue, connection and thread, which saves broker
+        resources for many low-volume message types.
+
+        Example::
+
+            @coney.handler("orders.*.created", exchange_name="events")
+            def order_created(ch, method, props, body):
+                pass
+
+            @coney.handler("orders.#", exchange_name="events")
+            def order_audit(ch, method, props, body):
+                pass
+
+        In the pattern ``*`` matches exactly one word and ``#`` matches zero
+        or more words. Every matching handler is called with the message in
+        the order the handlers were registered. If a handler raises, the
+        remaining handlers still run and the first error is raised afterwards.
+
+        Without a queue name the broker names the queue. It is exclusive to the
+        connection and deleted with it, so messages published while the
+        consumer reconnects are lost.
+
+        :param routing_key: The topic pattern
+        :param exchange_name: Name of the topic exchange
+        :param queue_name: Name of the shared queue
+        :param app: A flask app
+        """
         app = self.get_app(app)
-        data = get_state(app).data
-        data[corr_id]["is_accept"] = True
-        data[corr_id]["result"] = result
+        state = get_state(app)
 
+        def decorator(func):
+            key = (exchange_name, queue_name)
+            if key not in state.routers:
+                router = Router()
+                consumer = self._start_consumer(
+                    app,
+                    exchange=exchange_name,
+                    exchange_type=ExchangeType.TOPIC,
+                    queue=queue_name,
+                    routing_keys=[],
+                    on_message=router.dispatch,
+                )
+                state.routers[key] = (router, consumer)
+
+            router, consumer = state.routers[key]
+            router.add(routing_key, self._sync_handler(app, func))
+            consumer.bind(routing_key)
+            return func
+
+        return decorator
+
+    def _sync_handler(self, app: Flask, func: Callable) -> Callable:
+        # coroutine handlers run on an event loop of the consumer thread, so
+        # they use the channel and the app context of their own thread, and
+        # the message is acknowledged after them
+        if not inspect.iscoroutinefunction(func):
+            return func
+
+        @functools.wraps(func)
+        def handler(*args):
+            loop = getattr(self._message_local, "loop", None)
+            if loop is None:
+                loop = self._message_local.loop = asyncio.new_event_loop()
+            return loop.run_until_complete(func(*args))
+
+        return handler
+
+    def _close_message_loop(self):
+        loop = getattr(self._message_local, "loop", None)
+        if loop is not None:
+            loop.close()
+            self._message_local.loop = None
+
+    def message_teardown(self, func: Callable) -> Callable:
+        """
+        Registers a function called after every message handled by a
+        consumer, even if the handler raised. It is called with the exception
+        or None.
+
+        Example::
+
+            @coney.message_teardown
+            def remove_session(exc):
+                db.session.remove()
+
+        Each consumer thread pushes one app context for its lifetime, so
+        handlers can use ``current_app`` without pushing a context per
+        message. The context, and with it ``g``, is shared by all messages of
+        the thread. The ``teardown_appcontext`` functions of the app run after
+        every message as well, unless ``CONEY_TEARDOWN_APPCONTEXT`` is False.
+
+        :param func: Called with the exception of the handler or None
+        """
+        self.message_teardown_funcs.append(func)
+        return func
+
+    def _message_scope(self, app: Flask, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def handler(*args):
+            error = None
+            try:
+                return func(*args)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._teardown_message(app, error)
+
+        return handler
+
+    def _teardown_message(self, app: Flask, error: Exception = None):
+        funcs = list(self.message_teardown_funcs)
+        if app.config.get("CONEY_TEARDOWN_APPCONTEXT", True):
+            funcs.append(app.do_teardown_appcontext)
+        # a failing teardown must neither hide the error of the handler nor
+        # prevent the message from being acknowledged
+        for func in funcs:
+            try:
+                func(error)
+            except Exception:
+                logger.exception("Message teardown failed")
+
+    def _run_consumer(self, app: Flask, consumer: ReconnectingConsumer):
+        with app.app_context():
+            try:
+                consumer.run()
+            finally:
+                self._close_message_loop()
+
+    def _start_consumer(self, app: Flask, **kwargs) -> ReconnectingConsumer:
+        state = get_state(app)
+        kwargs["on_message"] = self._message_scope(app, kwargs["on_message"])
+        consumer = ReconnectingConsumer(
+            state.brokers,
+            metrics=state.metrics,
+            chunk_timeout=state.reassembler.timeout,
+            chunk_memory_bytes=state.reassembler.memory_bytes,
+            blob_store=state.blob_store,
+            profiler=state.profiler,
+            tracer=state.tracer,
+            **kwargs,
+        )
+        thread = threading.Thread(target=self._run_consumer, args=(app, consumer))
+        state.consumer_threads.append((consumer, thread))
+        thread.start()
+        return consumer
+
+    def _stop_consumer(self, state: _ConeyState, consumer: ReconnectingConsumer):
+        thread = None
+        for entry in state.consumer_threads:
+            if entry[0] is consumer:
+                state.consumer_threads.remove(entry)
+                thread = entry[1]
+                break
+        consumer.stop()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _queue_depth(self, app: Flask, queue_name: str) -> Tuple[int, int]:
         with self.channel(app) as channel:
-            channel.queue_delete(data[corr_id]["reply_queue_name"])
+            result = channel.queue_declare(queue=queue_name, passive=True)
+        return result.method.message_count, result.method.consumer_count
+
+    def sharded_queue(self, name: str, shards: int, app: Flask = None) -> ShardedQueue:
+        """
+        Declares a queue split into ``shards`` queues named ``name.0`` to
+        ``name.<shards - 1>``, which are bound to the direct exchange
+        ``name``. A single queue is limited to one core of the broker, the
+        shards are not.
+
+        Messages are routed to a shard by the consistent hash of their
+        partition key, so messages with the same key stay in order::
+
+            events = coney.sharded_queue("events", shards=8)
+
+            @events.queue()
+            def queue_events(ch, method, props, body):
+                pass
+
+            coney.publish(body, exchange_name="events", partition_key=user_id)
+
+        Every worker may consume a subset of the shards only::
+
+            @events.queue(shards=[worker_id, worker_id + 4])
+            def queue_events(ch, method, props, body):
+                pass
+
+        :param name: Name of the exchange and prefix of the queue names
+        :param shards: Number of shards
+        :param app: A flask app
+        """
+        app = self.get_app(app)
+        sharded_queue = ShardedQueue(self, name, shards, app=app)
+        if not self.testing:
+            sharded_queue.declare()
+        get_state(app).sharded_queues[name] = sharded_queue
+        return sharded_queue
+
+    def _accept(
+        self, corr_id: str, result: str, app: Flask = None, headers: dict = None
+    ):
+        app = self.get_app(app)
+        response = get_state(app).data.get(corr_id)
+        if response is None or response["is_accept"]:
+            return
+
+        response["is_accept"] = True
+        response["result"] = result
+        response["headers"] = headers or {}
+        response["corr_id"] = corr_id
+
+        with self.channel(app) as channel:
+            channel.queue_delete(response["reply_queue_name"])
 
     def _on_response(
         self,
@@ -254,19 +833,25 @@ class Coney:
     ):
         logging.info(f"on response => {body}")
 
+        body = self._receive_body(self.get_app(app), props, body)
+        if body is None:
+            return
+
         corr_id = props.correlation_id
         if props.content_type == "application/json":
             body = json.loads(body)
 
-        self._accept(corr_id, body, app=app)
+        self._accept(corr_id, body, app=app, headers=props.headers)
 
     def publish(
         self,
-        body: Union[str, dict],
+        body: Union[str, bytes, dict],
         exchange_name: str = "",
         routing_key: str = "",
         durable: bool = False,
         properties: dict = None,
+        deadline: float = None,
+        partition_key: str = None,
         app: Flask = None,
     ):
         """
@@ -278,28 +863,445 @@ class Coney:
             def process():
                 coney.publish({"text": "process me"})
 
-        :param body: Body of the message, either a string or a dict
+        If ``CONEY_SPOOL_PATH`` is set and the broker can not be reached, the
+        message is written to a local spool instead. The spool is replayed in
+        order in the background once the broker is available again.
+
+        While the broker blocks publishers because of a resource alarm, the
+        message is handed to ``CONEY_BLOCKED_FALLBACK`` right away instead of
+        waiting for the broker.
+
+        Bodies larger than ``CONEY_CLAIM_CHECK_THRESHOLD`` bytes are written
+        to the blob store and only a reference is sent through the broker.
+
+        Messages to a :meth:`sharded_queue` are routed by their
+        ``partition_key`` instead of a routing key.
+
+        :param body: Body of the message, either a string, bytes or a dict
         :param exchange_name: The exchange
         :param exchange_type: The type of the exchange
         :param routing_key: The routing key
         :param durable: Should the exchange be durable
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param deadline: Maximum seconds the broker may block the publish.
+            Defaults to ``CONEY_PUBLISH_DEADLINE``.
+        :param partition_key: Key choosing the shard of a :meth:`sharded_queue`
         :param app: A flask app
+        :raises:
+            SpoolFullError: if the broker is unavailable and the spool is full
+            PublishBlockedError: if the broker blocks publishers and no
+                fallback is configured
         """
-        with self.channel(app) as channel:
-            if properties is None:
-                properties = {"content_type": "text/plain"}
+        app = self.get_app(app)
+        state = get_state(app)
+        payload, properties = self._encode(app, body, properties)
+
+        if partition_key is not None:
+            if exchange_name not in state.sharded_queues:
+                raise RuntimeError(f"{exchange_name} is not a sharded queue")
+            routing_key = state.sharded_queues[exchange_name].shard_for(partition_key)
+
+        if deadline is None:
+            deadline = app.config.get("CONEY_PUBLISH_DEADLINE")
+
+        # while the spool is not drained the broker is considered unavailable
+        # and new messages are queued behind the spooled ones to keep the order
+        if state.spool is not None and len(state.spool):
+            self._spool(state, exchange_name, routing_key, payload, properties)
+            return
+
+        if state.flow.is_blocked:
+            if not state.flow.should_probe():
+                self._publish_blocked(
+                    app, exchange_name, routing_key, payload, properties
+                )
+                return
+            if (
+                deadline is None
+                and app.config.get("CONEY_BLOCKED_CONNECTION_TIMEOUT") is None
+            ):
+                # the broker does not answer while it blocks, so a probe
+                # without a deadline would hang as long as the alarm lasts
+                deadline = app.config.get("CONEY_BLOCKED_PROBE_TIMEOUT", 5.0)
 
-            if isinstance(body, dict):
-                body = json.dumps(body, cls=UUIDEncoder)
-                properties["content_type"] = "application/json"
+        try:
+            with self.channel(app, blocked_connection_timeout=deadline) as channel:
+                self._basic_publish(
+                    app, channel, exchange_name, routing_key, payload, properties
+                )
+        except pika.exceptions.ConnectionBlockedTimeout:
+            self._publish_blocked(app, exchange_name, routing_key, payload, properties)
+        except pika.exceptions.AMQPConnectionError:
+            if state.spool is None:
+                raise
+            logger.warning("Broker unavailable, spooling message")
+            self._spool(state, exchange_name, routing_key, payload, properties)
+        else:
+            # the broker does not answer the connection close while blocking,
+            # so a clean close means publishing is possible again
+            state.flow.on_unblocked()
+
+    def publisher(
+        self,
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        codec: Codec = None,
+        app: Flask = None,
+    ) -> Publisher:
+        """
+        Returns a :class:`Publisher` for sending many messages of the same
+        shape with little overhead per message
+
+        Example::
+
+            telemetry = coney.publisher(
+                exchange_name="telemetry", routing_key="cpu", codec=JSONCodec()
+            )
+
+            @app.route('/sample')
+            def sample():
+                telemetry.send({"host": host, "load": load()})
+
+        :param exchange_name: The exchange
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param codec: Encodes the bodies, defaults to :class:`JSONCodec`
+        :param app: A flask app
+        """
+        app = self.get_app(app)
+        return Publisher(
+            self,
+            app,
+            exchange_name=exchange_name,
+            routing_key=routing_key,
+            properties=properties,
+            codec=codec,
+        )
+
+    def publish_in(
+        self,
+        body: Union[str, dict],
+        delay: float,
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        app: Flask = None,
+    ):
+        """
+        Will publish a message after a delay, see :meth:`publish_at`
+
+        Example::
+
+            coney.publish_in({"order": order_id}, delay=30, routing_key="remind")
+
+        :param body: Body of the message, either a string or a dict
+        :param delay: Seconds to wait
+        :param exchange_name: The exchange
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param app: A flask app
+        """
+        self.publish_at(
+            body,
+            time.time() + delay,
+            exchange_name=exchange_name,
+            routing_key=routing_key,
+            properties=properties,
+            app=app,
+        )
+
+    def publish_at(
+        self,
+        body: Union[str, dict],
+        when: Union[float, datetime.datetime],
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        app: Flask = None,
+    ):
+        """
+        Will publish a message at a point in time
 
+        Example::
+
+            coney.publish_at(
+                {"order": order_id},
+                when=datetime.now(timezone.utc) + timedelta(days=1),
+                routing_key="remind",
+            )
+
+        Messages due within ``CONEY_TIMING_WHEEL_TICK`` *
+        ``CONEY_TIMING_WHEEL_SLOTS`` seconds wait in a timing wheel, which
+        serves all of them with a single thread. They are lost if the
+        process exits before.
+
+        Messages due later wait in broker queues with a message ttl of one
+        of the ``CONEY_DELAY_BUCKETS`` seconds. Once the ttl passed, the
+        broker dead-letters them to the ``coney.delayed`` queue, which is
+        consumed by every process which scheduled such a message. From there
+        they go to the next bucket or, once they are due soon, to the timing
+        wheel. Their ack is held until they were published again, so the
+        broker redelivers them if the process exits while they wait.
+
+        :param body: Body of the message, either a string or a dict
+        :param when: Unix timestamp or timezone-aware datetime
+        :param exchange_name: The exchange
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param app: A flask app
+        """
+        app = self.get_app(app)
+        if isinstance(when, datetime.datetime):
+            when = when.timestamp()
+        payload, properties = self._encode(app, body, properties)
+        self._schedule(app, when, exchange_name, routing_key, payload, properties)
+
+    def _schedule(
+        self,
+        app: Flask,
+        when: float,
+        exchange_name: str,
+        routing_key: str,
+        body: Union[str, bytes],
+        properties: dict,
+        settle: Callable = None,
+    ):
+        state = get_state(app)
+        delay = when - time.time()
+        in_wheel = delay <= state.timing_wheel.horizon or not state.delay_buckets
+        if delay <= 0 or in_wheel:
+            publish = functools.partial(
+                self.publish,
+                body,
+                exchange_name=exchange_name,
+                routing_key=routing_key,
+                properties=properties,
+                app=app,
+            )
+        else:
+            # wait in the longest bucket, which does not overshoot
+            bucket = [b for b in state.delay_buckets if b <= delay][-1]
+            headers = {
+                **(properties.get("headers") or {}),
+                DELAY_UNTIL_HEADER: when,
+                DELAY_EXCHANGE_HEADER: exchange_name,
+                DELAY_ROUTING_KEY_HEADER: routing_key,
+            }
+            publish = functools.partial(
+                self.publish,
+                body,
+                routing_key=self._declare_delay_bucket(app, bucket),
+                properties={**properties, "headers": headers},
+                app=app,
+            )
+        if settle is not None:
+            publish = functools.partial(self._publish_and_settle, publish, settle)
+
+        if delay > 0 and in_wheel:
+            if not self.testing:
+                state.timing_wheel.start()
+            state.timing_wheel.schedule(delay, publish)
+        else:
+            publish()
+
+    def _publish_and_settle(self, publish: Callable, settle: Callable):
+        try:
+            publish()
+        except Exception:
+            settle(ack=False, requeue=True)
+            raise
+        settle(ack=True)
+
+    def _declare_delay_bucket(self, app: Flask, bucket: float) -> str:
+        state = get_state(app)
+        queue_name = f"{DELAYED_QUEUE}.{bucket}"
+
+        with state.delay_lock:
+            if queue_name in state.delay_queues:
+                return queue_name
+
+            with self.channel(app) as channel:
+                channel.queue_declare(queue=DELAYED_QUEUE)
+                channel.queue_declare(
+                    queue=queue_name,
+                    arguments={
+                        "x-message-ttl": int(bucket * 1000),
+                        "x-dead-letter-exchange": "",
+                        "x-dead-letter-routing-key": DELAYED_QUEUE,
+                    },
+                )
+
+            if not state.delay_queues and not self.testing:
+                # _on_delayed acks the messages itself, which it holds until
+                # they were published again, so the prefetch is not limited
+                self._start_consumer(
+                    app,
+                    queue=DELAYED_QUEUE,
+                    lazy_claim_check=True,
+                    manual_ack=True,
+                    prefetch_count=0,
+                    on_message=functools.partial(self._on_delayed, app=app),
+                )
+            state.delay_queues.add(queue_name)
+        return queue_name
+
+    def _on_delayed(
+        self,
+        ch: pika.channel.Channel,
+        method: pika.spec.Basic.Deliver,
+        props: pika.spec.BasicProperties,
+        body,
+        app: Flask,
+    ):
+        settle = functools.partial(self._settle_delayed, ch, method.delivery_tag)
+        try:
+            headers = without_chunk_headers(props.headers)
+            headers.pop("x-death", None)
+            when = float(headers.pop(DELAY_UNTIL_HEADER))
+            exchange_name = headers.pop(DELAY_EXCHANGE_HEADER, "")
+            routing_key = headers.pop(DELAY_ROUTING_KEY_HEADER, "")
+
+            if isinstance(body, ClaimCheck):
+                # the claim check header is kept, the payload stays in the store
+                body = b""
+            body, properties = self._encode(
+                app,
+                body,
+                {
+                    **{k: v for k, v in vars(props).items() if v is not None},
+                    "headers": headers,
+                },
+            )
+        except Exception:
+            # a message which can not be scheduled would fail again
+            settle(ack=False)
+            raise
+        self._schedule(
+            app, when, exchange_name, routing_key, body, properties, settle=settle
+        )
+
+    def _settle_delayed(
+        self,
+        ch: pika.channel.Channel,
+        delivery_tag: int,
+        ack: bool,
+        requeue: bool = False,
+    ):
+        if ack:
+            callback = functools.partial(ch.basic_ack, delivery_tag=delivery_tag)
+        else:
+            callback = functools.partial(
+                ch.basic_nack, delivery_tag=delivery_tag, requeue=requeue
+            )
+        # the timing wheel settles the message in its own thread
+        try:
+            ch.connection.add_callback_threadsafe(callback)
+        except pika.exceptions.AMQPConnectionError:
+            # the broker redelivers the message of a closed connection
+            logger.warning("Could not settle delayed message # %s", delivery_tag)
+
+    def _basic_publish(
+        self,
+        app: Flask,
+        channel: pika.channel.Channel,
+        exchange_name: str,
+        routing_key: str,
+        body: Union[str, bytes],
+        properties: dict,
+    ):
+        # bodies above CONEY_MAX_FRAME_BYTES are sent as ordered chunks, which
+        # are joined again by the consumer
+        max_frame_bytes = app.config.get("CONEY_MAX_FRAME_BYTES")
+        for chunk, chunk_properties in split_message(
+            body, properties, max_frame_bytes
+        ):
             channel.basic_publish(
                 exchange=exchange_name,
                 routing_key=routing_key,
-                body=body,
-                properties=pika.BasicProperties(**properties),
+                body=chunk,
+                properties=pika.BasicProperties(**chunk_properties),
             )
 
+    def _receive_body(self, app: Flask, props: pika.spec.BasicProperties, body):
+        state = get_state(app)
+        if is_chunk(props.headers):
+            body = state.reassembler.add(props.headers, body)
+            if body is None:
+                return None
+        key = (props.headers or {}).get(CLAIM_CHECK_HEADER)
+        if key is not None:
+            body = state.blob_store.get(key)
+        return body
+
+    def _publish_blocked(
+        self,
+        app: Flask,
+        exchange_name: str,
+        routing_key: str,
+        body: Union[str, bytes],
+        properties: dict,
+    ):
+        state = get_state(app)
+        state.metrics.incr("flow.rejected")
+        fallback = app.config.get("CONEY_BLOCKED_FALLBACK", "raise")
+
+        if fallback == "spool" and state.spool is not None:
+            self._spool(state, exchange_name, routing_key, body, properties)
+        elif callable(fallback):
+            fallback(exchange_name, routing_key, body, properties)
+        else:
+            raise PublishBlockedError()
+
+    def _encode(
+        self, app: Flask, body: Union[str, bytes, dict], properties: dict = None
+    ) -> Tuple[Union[str, bytes], dict]:
+        if properties is None:
+            properties = {"content_type": "text/plain"}
+        else:
+            properties = dict(properties)
+
+        if isinstance(body, dict):
+            body = json.dumps(body, cls=UUIDEncoder)
+            properties["content_type"] = "application/json"
+        properties.setdefault("message_id", uuid.uuid4().hex)
+        state = get_state(app)
+        if state.tracer is not None:
+            properties["headers"] = state.tracer.inject(properties.get("headers"))
+
+        # payloads above CONEY_CLAIM_CHECK_THRESHOLD are put into the blob
+        # store and only their key is sent through the broker
+        threshold = app.config.get("CONEY_CLAIM_CHECK_THRESHOLD")
+        if threshold is not None:
+            if isinstance(body, str):
+                body = body.encode()
+            if len(body) > threshold:
+                key = state.blob_store.put(body)
+                state.metrics.incr("claim_check.stored")
+                properties["headers"] = {
+                    **(properties.get("headers") or {}),
+                    CLAIM_CHECK_HEADER: key,
+                }
+                body = b""
+
+        return body, properties
+
+    def _spool(
+        self,
+        state: _ConeyState,
+        exchange_name: str,
+        routing_key: str,
+        body: Union[str, bytes],
+        properties: dict,
+    ):
+        try:
+            state.spool.append(exchange_name, routing_key, body, properties)
+        except SpoolFullError:
+            state.metrics.incr("spool.rejected")
+            raise
+        state.metrics.incr("spool.spooled")
+        state.metrics.set("spool.depth", len(state.spool))
+
     def reply_sync(
         self,
         ch: pika.channel.Channel,
@@ -307,6 +1309,7 @@ class Coney:
         properties: pika.spec.BasicProperties,
         body: str,
         app=None,
+        cache_ttl: float = None,
     ):
         """
         Will reply to a message, which was send by :meth:`publish_sync`
@@ -332,19 +1335,90 @@ class Coney:
                     app=app,
                 )
 
+        The request is acknowledged by the consumer, so it is not
+        acknowledged again here.
+
         :parameter ch:
         :parameter method:
         :parameter properties:
         :parameter body: The message to send
+        :parameter cache_ttl: Hint for the client for how many seconds the
+            reply may be cached, see :meth:`publish_sync`
 
         """
+        reply_properties = {"correlation_id": properties.correlation_id, "headers": {}}
+        if cache_ttl is not None:
+            reply_properties["headers"][CACHE_TTL_HEADER] = cache_ttl
+
+        # lets the client split the round-trip into broker and server time
+        state = get_state(self.get_app(app))
+        context = state.tracer.current() if state.tracer is not None else None
+        if context is not None:
+            reply_properties["headers"][RECEIVED_AT_HEADER] = context.received_ns
+
         self.publish(
             body,
             routing_key=properties.reply_to,
-            properties={"correlation_id": properties.correlation_id},
+            properties=reply_properties,
             app=app,
         )
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def reply_stream(
+        self,
+        ch: pika.channel.Channel,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        iterable: Iterable[Union[str, dict]],
+        app: Flask = None,
+    ):
+        """
+        Will reply to a message, which was send by
+        :meth:`publish_stream_sync`, with one message per item of the iterable
+
+        Example::
+
+            @queue(queue_name="export")
+            def export_callback(ch, method, props, body):
+                rows = ({"id": row.id} for row in query_rows(body["table"]))
+                coney.reply_stream(ch, method, props, rows)
+
+        Every item is sent as soon as the iterable produces it, so the
+        result never has to be held in memory as a whole. The items carry a
+        sequence number and the stream is closed by an end marker. Like with
+        :meth:`reply_sync`, the request is acknowledged by the consumer.
+
+        :parameter ch:
+        :parameter method:
+        :parameter properties:
+        :parameter iterable: The items to send, either strings or dicts
+        :param app: A flask app
+        """
+        app = self.get_app(app)
+        with self.channel(app) as channel:
+            seq = 0
+            for item in iterable:
+                body, item_properties = self._encode(
+                    app,
+                    item,
+                    {
+                        "correlation_id": properties.correlation_id,
+                        "headers": {STREAM_SEQ_HEADER: seq},
+                    },
+                )
+                self._basic_publish(
+                    app, channel, "", properties.reply_to, body, item_properties
+                )
+                seq += 1
+
+            channel.basic_publish(
+                exchange="",
+                routing_key=properties.reply_to,
+                body=b"",
+                properties=pika.BasicProperties(
+                    correlation_id=properties.correlation_id,
+                    headers={STREAM_SEQ_HEADER: seq, STREAM_END_HEADER: True},
+                ),
+            )
 
     def publish_sync(
         self,
@@ -353,6 +1427,9 @@ class Coney:
         routing_key: str = "",
         properties: dict = None,
         timeout: float = 10,
+        cache_ttl: float = None,
+        coalesce: bool = False,
+        hedge: bool = False,
         app: Flask = None,
     ):
         """
@@ -377,54 +1454,605 @@ class Coney:
                 body = {"result": result}
                 coney.reply_sync(ch, method, props, body)
 
+        Responses of idempotent requests can be cached by passing a
+        ``cache_ttl``. Requests with the same exchange, routing key and body
+        are then answered from the cache without a round-trip to the broker.
+        If the server sends a ttl hint with :meth:`reply_sync`, the hint is
+        used instead, unless ``CONEY_RPC_CACHE_HONOR_TTL_HINT`` is False::
+
+            permissions = coney.publish_sync(
+                {"user": user_id}, routing_key="permissions", cache_ttl=30
+            )
+
+        With ``coalesce`` concurrent identical requests share one request to
+        the server. Every waiting caller gets a copy of the same response or
+        the same :class:`SyncTimeoutError`. Combine it with ``cache_ttl`` to
+        avoid a stampede on the server when a cached response expires.
+
+        With ``hedge`` the request is sent a second time, if no response
+        arrived after ``CONEY_HEDGE_DELAY`` seconds or, if it is not set, the
+        ``CONEY_HEDGE_PERCENTILE`` of the latencies observed for the routing
+        key. The first response wins. ``CONEY_HEDGE_BUDGET`` caps the share
+        of requests which are hedged. Only hedge idempotent requests.
+
+        The request expires in the queue after ``timeout`` and carries its
+        deadline in a header, so consumers drop it once nobody waits for the
+        reply anymore.
+
+        If ``CONEY_CIRCUIT_BREAKER_THRESHOLD`` is set, a routing key which
+        timed out that many times in a row is not called for
+        ``CONEY_CIRCUIT_BREAKER_RESET_TIMEOUT`` seconds, instead
+        :class:`CircuitOpenError` is raised right away. Afterwards a single
+        request probes if the server is back. With
+        ``CONEY_ADAPTIVE_TIMEOUT_FACTOR`` the timeout is lowered to a multiple
+        of the ``CONEY_ADAPTIVE_TIMEOUT_PERCENTILE`` of the observed latencies.
+
+        In cooperative mode, which is on under gevent or eventlet monkey
+        patching or with ``CONEY_COOPERATIVE``, all requests share one
+        connection and receive their replies through direct reply-to. A
+        waiting request then only blocks its greenlet on an event.
+
         :param body: Body of the message, either a string or a dict
         :param exchange_name: The exchange
         :param routing_key: The routing key
         :param properties: see :py:class:`pika.spec.BasicProperties`
         :param timeout: Timeout in seconds
+        :param cache_ttl: Seconds the response will be cached
+        :param coalesce: Share the request with identical requests in flight
+        :param hedge: Send a second request if the first one is slow
         :param app: A flask app
         :raises:
             SyncTimeoutError: if no message received in timeout
+            CircuitOpenError: if the circuit breaker of the routing key is open
         """
-
         app = self.get_app(app)
+        state = get_state(app)
+
+        if cache_ttl is not None or coalesce:
+            key = make_key(exchange_name, routing_key, body)
+
+        if cache_ttl is not None:
+            hit, result = state.rpc_cache.get(key)
+            if hit:
+                return copy.deepcopy(result)
+
+        hedge_after = None
+        if hedge:
+            state.hedge_budget.deposit()
+            hedge_after = app.config.get("CONEY_HEDGE_DELAY")
+            if hedge_after is None:
+                hedge_after = state.rpc_latency.percentile(
+                    routing_key, app.config.get("CONEY_HEDGE_PERCENTILE", 95)
+                )
+
+        factor = app.config.get("CONEY_ADAPTIVE_TIMEOUT_FACTOR")
+        if factor is not None:
+            observed = state.rpc_latency.percentile(
+                routing_key, app.config.get("CONEY_ADAPTIVE_TIMEOUT_PERCENTILE", 99)
+            )
+            if observed is not None:
+                minimum = app.config.get("CONEY_ADAPTIVE_TIMEOUT_MIN", 0.1)
+                timeout = min(timeout, max(minimum, observed * factor))
+
+        call = functools.partial(
+            self._rpc,
+            body,
+            exchange_name,
+            routing_key,
+            properties,
+            timeout,
+            app,
+            hedge_after=hedge_after,
+        )
+        if state.breakers is not None:
+            call = functools.partial(
+                self._call_guarded, state.breakers.get(routing_key), call
+            )
+        if coalesce:
+            result, headers = copy.deepcopy(state.rpc_flights.do(key, call))
+        else:
+            result, headers = call()
+
+        if cache_ttl is not None:
+            self._cache_response(app, key, result, headers, cache_ttl)
+        return result
+
+    def _call_guarded(self, breaker: CircuitBreaker, call: Callable):
+        if not breaker.allow():
+            raise CircuitOpenError()
+
+        try:
+            response = call()
+        except SyncTimeoutError:
+            breaker.record_failure()
+            raise
+        except Exception:
+            breaker.cancel()
+            raise
+
+        breaker.record_success()
+        return response
+
+    def _cache_response(
+        self, app: Flask, key: tuple, result, headers: dict, cache_ttl: float
+    ):
+        if app.config.get("CONEY_RPC_CACHE_HONOR_TTL_HINT", True):
+            cache_ttl = float(headers.get(CACHE_TTL_HEADER, cache_ttl))
+        get_state(app).rpc_cache.set(key, copy.deepcopy(result), cache_ttl)
+
+    def _rpc(
+        self,
+        body: Union[str, dict],
+        exchange_name: str,
+        routing_key: str,
+        properties: Optional[dict],
+        timeout: float,
+        app: Flask,
+        hedge_after: float = None,
+    ):
+        state = get_state(app)
+        payload, properties = self._encode(app, body, properties)
+        start = time.monotonic()
+
+        # let the server skip the request once nobody waits for the reply
+        properties["headers"] = {
+            **(properties.get("headers") or {}),
+            DEADLINE_HEADER: time.time() + timeout,
+        }
+        properties.setdefault("expiration", str(max(1, int(timeout * 1000))))
+
+        if state.rpc_client is not None:
+            return self._rpc_shared(
+                app, routing_key, payload, properties, start, timeout, hedge_after
+            )
+
         with self.connection(app) as connection:
-            corr_id = str(uuid.uuid4())
             channel = connection.channel()
             result = channel.queue_declare(queue="", exclusive=False, auto_delete=True)
             callback_queue = result.method.queue
-            state = get_state(app)
-            state.data[corr_id] = {
+            response = {
                 "is_accept": False,
                 "result": None,
                 "reply_queue_name": callback_queue,
             }
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(callback_queue, self._on_response)
+            channel.basic_consume(callback_queue, self._on_response, auto_ack=True)
+
+            # a hedged request gets its own correlation id pointing to the
+            # same response, the reply arriving last is dropped by _accept
+            corr_ids = []
+
+            def send():
+                corr_id = str(uuid.uuid4())
+                corr_ids.append(corr_id)
+                state.data[corr_id] = response
+                request_properties = {
+                    **properties,
+                    "reply_to": callback_queue,
+                    "correlation_id": corr_id,
+                }
+                self._basic_publish(
+                    app, channel, "", routing_key, payload, request_properties
+                )
 
-            if properties is None:
-                properties = {"content_type": "text/plain"}
+            try:
+                self._await_reply(
+                    state,
+                    routing_key,
+                    start,
+                    timeout,
+                    hedge_after,
+                    send=send,
+                    is_done=lambda: response["is_accept"],
+                    wait=lambda wait: connection.process_data_events(time_limit=wait),
+                )
+            finally:
+                for corr_id in corr_ids:
+                    del state.data[corr_id]
+
+        logging.info("Got the RPC server response")
+        if response["corr_id"] != corr_ids[0]:
+            state.metrics.incr("rpc.hedge_won")
+        if state.tracer is not None:
+            state.tracer.record_rpc(
+                routing_key, properties["headers"], response["headers"]
+            )
+        return response["result"], response["headers"]
 
-            if isinstance(body, dict):
-                body = json.dumps(body, cls=UUIDEncoder)
-                properties["content_type"] = "application/json"
+    def _rpc_shared(
+        self,
+        app: Flask,
+        routing_key: str,
+        body: Union[str, bytes],
+        properties: dict,
+        start: float,
+        timeout: float,
+        hedge_after: float = None,
+    ):
+        state = get_state(app)
+        messages = list(
+            split_message(body, properties, app.config.get("CONEY_MAX_FRAME_BYTES"))
+        )
+        with state.rpc_client.waiter() as waiter:
+            self._await_reply(
+                state,
+                routing_key,
+                start,
+                timeout,
+                hedge_after,
+                send=lambda: waiter.send("", routing_key, messages),
+                is_done=lambda: waiter.is_done,
+                wait=waiter.wait,
+            )
+        if waiter.error is not None:
+            raise waiter.error
+
+        corr_id, props, result = waiter.reply
+        if corr_id != waiter.corr_ids[0]:
+            state.metrics.incr("rpc.hedge_won")
+        if state.tracer is not None:
+            state.tracer.record_rpc(
+                routing_key, properties["headers"], props.headers or {}
+            )
+        if props.content_type == "application/json":
+            result = json.loads(result)
+        return result, props.headers or {}
 
-            channel.basic_publish(
-                exchange="",
-                routing_key=routing_key,
-                body=body,
-                properties=pika.BasicProperties(
-                    **properties, reply_to=callback_queue, correlation_id=corr_id,
-                ),
+    def _await_reply(
+        self,
+        state: _ConeyState,
+        routing_key: str,
+        start: float,
+        timeout: float,
+        hedge_after: Optional[float],
+        send: Callable,
+        is_done: Callable,
+        wait: Callable,
+    ):
+        end = start + timeout
+        send()
+
+        while not is_done():
+            now = time.monotonic()
+            if now >= end:
+                # keep the percentiles moving while the server is slow
+                state.rpc_latency.observe(routing_key, timeout)
+                raise SyncTimeoutError()
+            remaining = end - now
+
+            if hedge_after is not None:
+                hedge_at = start + hedge_after
+                if now < hedge_at:
+                    remaining = min(remaining, hedge_at - now)
+                else:
+                    hedge_after = None
+                    if state.hedge_budget.try_spend():
+                        logger.info("Hedging request to %s", routing_key)
+                        state.metrics.incr("rpc.hedged")
+                        send()
+
+            wait(remaining)
+
+        state.rpc_latency.observe(routing_key, time.monotonic() - start)
+
+    async def apublish(
+        self,
+        body: Union[str, dict],
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        app: Flask = None,
+    ):
+        """
+        Will publish a message without blocking the event loop
+
+        Example::
+
+            @app.route('/process')
+            async def process():
+                await coney.apublish({"text": "process me"}, routing_key="tasks")
+
+        All coroutines share one connection, which lives on an event loop in
+        a background thread. Unlike :meth:`publish` the message is neither
+        spooled nor handed to ``CONEY_BLOCKED_FALLBACK``.
+
+        :param body: Body of the message, either a string or a dict
+        :param exchange_name: The exchange
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param app: A flask app
+        """
+        app = self.get_app(app)
+        state = get_state(app)
+        payload, properties = self._encode(app, body, properties)
+        messages = list(
+            split_message(payload, properties, app.config.get("CONEY_MAX_FRAME_BYTES"))
+        )
+        await state.aio.call(state.aio.publish(exchange_name, routing_key, messages))
+
+    async def apublish_sync(
+        self,
+        body: Union[str, dict],
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        timeout: float = 10,
+        app: Flask = None,
+    ):
+        """
+        Will publish a message and wait for the response without blocking the
+        event loop
+
+        Example::
+
+            @app.route('/concat')
+            async def concat():
+                body = {'a': request.args.get('a'), 'b': request.args.get('b')}
+                return await coney.apublish_sync(body, routing_key="rpc")
+
+        The servers reply with :meth:`reply_sync` as for :meth:`publish_sync`.
+        The replies arrive through RabbitMQ's direct reply-to, so a request in
+        flight needs neither a thread nor a reply queue.
+
+        :param body: Body of the message, either a string or a dict
+        :param exchange_name: The exchange
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param timeout: Timeout in seconds
+        :param app: A flask app
+        :raises:
+            SyncTimeoutError: if no message received in timeout
+        """
+        app = self.get_app(app)
+        state = get_state(app)
+        payload, properties = self._encode(app, body, properties)
+        properties["headers"] = {
+            **(properties.get("headers") or {}),
+            DEADLINE_HEADER: time.time() + timeout,
+        }
+        properties.setdefault("expiration", str(max(1, int(timeout * 1000))))
+        messages = list(
+            split_message(payload, properties, app.config.get("CONEY_MAX_FRAME_BYTES"))
+        )
+
+        start = time.monotonic()
+        try:
+            props, result = await state.aio.call(
+                state.aio.request(
+                    exchange_name, routing_key, messages, str(uuid.uuid4()), timeout
+                )
+            )
+        except asyncio.TimeoutError:
+            state.rpc_latency.observe(routing_key, timeout)
+            raise SyncTimeoutError() from None
+
+        state.rpc_latency.observe(routing_key, time.monotonic() - start)
+        if state.tracer is not None:
+            state.tracer.record_rpc(
+                routing_key, properties["headers"], props.headers or {}
             )
+        if props.content_type == "application/json":
+            result = json.loads(result)
+        return result
 
-            end = time.time() + timeout
+    def scatter_gather(
+        self,
+        body: Union[str, dict],
+        routing_keys: List[str],
+        exchange_name: str = "",
+        properties: dict = None,
+        timeout: float = 10,
+        min_replies: int = None,
+        app: Flask = None,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Will publish a message to multiple RPC servers and yield the
+        responses as they arrive
 
-            while time.time() < end:
-                if state.data[corr_id]["is_accept"]:
-                    logging.info("Got the RPC server response")
-                    return state.data[corr_id]["result"]
-                else:
-                    connection.process_data_events()
-                    time.sleep(0.3)
-            raise SyncTimeoutError()
+        All requests are published at once and share one reply queue, so the
+        whole call takes as long as the slowest server instead of the sum of
+        all servers.
+
+        Example::
+
+            @app.route('/search')
+            def search():
+                body = {"query": request.args.get("q")}
+                results = coney.scatter_gather(
+                    body, routing_keys=["shard-1", "shard-2", "shard-3"]
+                )
+                return {"hits": [hit for _, hit in results]}
+
+        The servers reply with :meth:`reply_sync`. Pass ``min_replies`` to
+        stop as soon as a quorum of servers replied. Like any generator,
+        nothing is published before the iterator is consumed.
+
+        :param body: Body of the message, either a string or a dict
+        :param routing_keys: The routing keys of the RPC servers
+        :param exchange_name: The exchange
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param timeout: Timeout in seconds
+        :param min_replies: Number of replies to wait for. Defaults to one
+            reply per routing key.
+        :param app: A flask app
+        :returns: An iterator of (routing key, response) tuples
+        :raises:
+            ValueError: if min_replies is not between one and the number of
+                routing keys
+            SyncTimeoutError: if not enough messages are received in timeout
+        """
+        if min_replies is None:
+            min_replies = len(routing_keys)
+        # a quorum which can never be reached would wait out the timeout
+        if not 1 <= min_replies <= len(routing_keys):
+            raise ValueError(
+                f"min_replies must be between 1 and {len(routing_keys)},"
+                f" got {min_replies}"
+            )
+        return self._scatter_gather(
+            body, routing_keys, exchange_name, properties, timeout, min_replies, app
+        )
+
+    def _scatter_gather(
+        self,
+        body: Union[str, dict],
+        routing_keys: List[str],
+        exchange_name: str,
+        properties: Optional[dict],
+        timeout: float,
+        min_replies: int,
+        app: Optional[Flask],
+    ) -> Iterator[Tuple[str, Any]]:
+        app = self.get_app(app)
+        payload, properties = self._encode(app, body, properties)
+
+        with self.connection(app) as connection:
+            channel = connection.channel()
+            result = channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+            callback_queue = result.method.queue
+            pending: Dict[str, str] = {}
+            replies: Deque[Tuple[str, Any]] = collections.deque()
+
+            def on_response(ch, method, props, response):
+                response = self._receive_body(app, props, response)
+                if response is None:
+                    return
+                routing_key = pending.pop(props.correlation_id, None)
+                if routing_key is None:
+                    return
+                if props.content_type == "application/json":
+                    response = json.loads(response)
+                replies.append((routing_key, response))
+
+            channel.basic_consume(callback_queue, on_response, auto_ack=True)
+
+            for routing_key in routing_keys:
+                corr_id = str(uuid.uuid4())
+                pending[corr_id] = routing_key
+                request_properties = {
+                    **properties,
+                    "reply_to": callback_queue,
+                    "correlation_id": corr_id,
+                }
+                self._basic_publish(
+                    app,
+                    channel,
+                    exchange_name,
+                    routing_key,
+                    payload,
+                    request_properties,
+                )
+
+            end = time.monotonic() + timeout
+            received = 0
+
+            while received < min_replies:
+                if replies:
+                    received += 1
+                    yield replies.popleft()
+                    continue
+
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    raise SyncTimeoutError()
+                connection.process_data_events(time_limit=remaining)
+
+    def publish_stream_sync(
+        self,
+        body: Union[str, dict],
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        timeout: float = 10,
+        prefetch_count: int = 10,
+        app: Flask = None,
+    ) -> Iterator[Any]:
+        """
+        Will publish a message and yield the items of the response, which is
+        sent by :meth:`reply_stream`, as they arrive
+
+        Example::
+
+            @app.route('/export')
+            def export():
+                rows = coney.publish_stream_sync(
+                    {"table": "users"}, routing_key="export"
+                )
+                return Response(
+                    (json.dumps(row) + "\\n" for row in rows),
+                    mimetype="application/x-ndjson",
+                )
+
+        At most ``prefetch_count`` items are buffered, the next ones are only
+        delivered by the broker once the buffered items were consumed. Like
+        any generator, nothing is published before the iterator is consumed.
+        A reply sent by :meth:`reply_sync` is yielded as the only item.
+
+        :param body: Body of the message, either a string or a dict
+        :param exchange_name: The exchange
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param timeout: Maximum seconds to wait for the next item
+        :param prefetch_count: Maximum number of buffered items
+        :param app: A flask app
+        :raises:
+            SyncTimeoutError: if the next item is not received in timeout
+        """
+        app = self.get_app(app)
+        payload, properties = self._encode(app, body, properties)
+        corr_id = str(uuid.uuid4())
+
+        with self.connection(app) as connection:
+            channel = connection.channel()
+            result = channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+            callback_queue = result.method.queue
+            chunks = {}
+
+            def on_chunk(ch, method, props, chunk):
+                if props.correlation_id == corr_id:
+                    chunk = self._receive_body(app, props, chunk)
+                if props.correlation_id != corr_id or chunk is None:
+                    ch.basic_ack(method.delivery_tag)
+                    return
+                headers = props.headers or {}
+                if props.content_type == "application/json":
+                    chunk = json.loads(chunk)
+                if STREAM_SEQ_HEADER not in headers:
+                    # a plain reply, e.g. of reply_sync, is a stream of one item
+                    chunks[0] = (False, chunk, method.delivery_tag)
+                    chunks[1] = (True, None, None)
+                    return
+                chunks[headers[STREAM_SEQ_HEADER]] = (
+                    headers.get(STREAM_END_HEADER, False),
+                    chunk,
+                    method.delivery_tag,
+                )
+
+            channel.basic_qos(prefetch_count=prefetch_count)
+            channel.basic_consume(callback_queue, on_chunk)
+            request_properties = {
+                **properties,
+                "reply_to": callback_queue,
+                "correlation_id": corr_id,
+            }
+            self._basic_publish(
+                app, channel, exchange_name, routing_key, payload, request_properties
+            )
+
+            seq = 0
+            end = time.monotonic() + timeout
+
+            while True:
+                if seq in chunks:
+                    is_end, chunk, delivery_tag = chunks.pop(seq)
+                    if is_end:
+                        return
+                    yield chunk
+                    channel.basic_ack(delivery_tag)
+                    seq += 1
+                    end = time.monotonic() + timeout
+                    continue
+
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    raise SyncTimeoutError()
+                connection.process_data_events(time_limit=remaining)
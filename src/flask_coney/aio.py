@@ -0,0 +1,210 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Callable
+from typing import Coroutine
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from .failover import BrokerPool
+from .utils import logger
+
+REPLY_TO = "amq.rabbitmq.reply-to"
+"""Pseudo queue for direct replies, see
+https://www.rabbitmq.com/direct-reply-to.html"""
+
+
+class AsyncioClient:
+    """Publishes messages and waits for replies over a single
+    :class:`pika.adapters.asyncio_connection.AsyncioConnection`.
+
+    The connection lives on a shared event loop running in a background
+    thread, so it can be used from any event loop, e.g. the one of an async
+    Flask view. Replies arrive through direct reply-to, so requests in flight
+    cost a future each but no thread or queue.
+
+    :param url: The broker URI or a :class:`BrokerPool` of the cluster nodes
+    :param receive: Called with the properties and body of a reply, returns
+        the body or None if the reply is not complete yet
+    """
+
+    def __init__(self, url, receive: Callable = None):
+        self._pool = url if isinstance(url, BrokerPool) else BrokerPool(url)
+        self._url: Optional[str] = None
+        self._receive = receive or (lambda props, body: body)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connection: Optional[AsyncioConnection] = None
+        self._channel: Optional[pika.channel.Channel] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The shared event loop, started on first use"""
+        with self._lock:
+            loop = self._loop
+            if loop is None:
+                loop = self._loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+        return loop
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Runs a coroutine on the shared event loop
+
+        :param coro: The coroutine
+        :returns: A future of its result, which can be waited for from any
+            thread
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def call(self, coro: Coroutine):
+        """Runs a coroutine on the shared event loop and awaits its result
+        from the current event loop
+
+        :param coro: The coroutine
+        """
+        return await asyncio.wrap_future(self.submit(coro))
+
+    async def channel(self) -> pika.channel.Channel:
+        """Returns the open channel, connecting if needed. Must run on the
+        shared event loop."""
+        ready = self._ready
+        if ready is None or (
+            ready.done() and (ready.exception() is not None or self._channel is None)
+        ):
+            ready = self._ready = self.loop.create_future()
+            self._connect(ready)
+        return await asyncio.shield(ready)
+
+    async def publish(
+        self, exchange: str, routing_key: str, messages: List[Tuple[bytes, dict]]
+    ):
+        """Publishes the (body, properties) tuples of a message. Must run on
+        the shared event loop.
+
+        :param exchange: The exchange
+        :param routing_key: The routing key
+        :param messages: The body and properties of each chunk of the message
+        """
+        channel = await self.channel()
+        for body, properties in messages:
+            channel.basic_publish(
+                exchange, routing_key, body, pika.BasicProperties(**properties)
+            )
+
+    async def request(
+        self,
+        exchange: str,
+        routing_key: str,
+        messages: List[Tuple[bytes, dict]],
+        correlation_id: str,
+        timeout: float,
+    ) -> Tuple[pika.spec.BasicProperties, bytes]:
+        """Publishes a request and waits for its reply. Must run on the shared
+        event loop.
+
+        :param exchange: The exchange
+        :param routing_key: The routing key
+        :param messages: The body and properties of each chunk of the message
+        :param correlation_id: Id the reply is matched with
+        :param timeout: Seconds to wait for the reply
+        :returns: The properties and the body of the reply
+        :raises:
+            asyncio.TimeoutError: if no reply arrived in timeout
+        """
+        channel = await self.channel()
+        future = self.loop.create_future()
+        self._pending[correlation_id] = future
+        try:
+            for body, properties in messages:
+                properties = {
+                    **properties,
+                    "reply_to": REPLY_TO,
+                    "correlation_id": correlation_id,
+                }
+                channel.basic_publish(
+                    exchange, routing_key, body, pika.BasicProperties(**properties)
+                )
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self._pending[correlation_id]
+
+    def close(self):
+        """Closes the connection and stops the shared event loop"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+
+        def stop():
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+            loop.call_soon(loop.stop)
+
+        loop.call_soon_threadsafe(stop)
+
+    def _connect(self, ready: asyncio.Future):
+        def on_channel_open(channel):
+            channel.add_on_close_callback(self._on_channel_closed)
+            channel.basic_consume(
+                REPLY_TO,
+                self._on_reply,
+                auto_ack=True,
+                callback=lambda _frame: on_consume_ok(channel),
+            )
+
+        def on_consume_ok(channel):
+            self._pool.record_success(url)
+            self._channel = channel
+            if not ready.done():
+                ready.set_result(channel)
+
+        def on_open_error(_connection, error):
+            # the next call connects to another node
+            self._pool.record_failure(url)
+            if not ready.done():
+                ready.set_exception(pika.exceptions.AMQPConnectionError(error))
+
+        url = self._url = self._pool.select()
+        logger.info("Connecting to %s", url)
+        self._connection = AsyncioConnection(
+            pika.URLParameters(url),
+            on_open_callback=lambda c: c.channel(on_open_callback=on_channel_open),
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._loop,
+        )
+
+    def _on_channel_closed(self, _channel, reason):
+        logger.warning("Channel was closed: %s", reason)
+        self._channel = None
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _on_connection_closed(self, _connection, reason):
+        logger.warning("Connection closed: %s", reason)
+        if self._channel is not None and not isinstance(
+            reason, pika.exceptions.ConnectionClosedByClient
+        ):
+            self._pool.record_failure(self._url)
+        self._channel = None
+        error = pika.exceptions.AMQPConnectionError(reason)
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_exception(error)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _on_reply(self, _channel, _method, props, body):
+        body = self._receive(props, body)
+        if body is None:
+            return
+        future = self._pending.get(props.correlation_id)
+        if future is not None and not future.done():
+            future.set_result((props, body))
@@ -0,0 +1,163 @@
+import math
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import pika
+
+from .metrics import Metrics
+from .utils import logger
+
+
+class ScaledQueue:
+    """The consumers of a queue, whose number is adjusted by the
+    :class:`Autoscaler`.
+
+    :param queue_name: Name of the queue
+    :param func: The handler of the queue
+    :param start_consumer: Starts a consumer calling the handler it gets
+        and returns the consumer
+    :param stop_consumer: Stops a consumer returned by start_consumer
+    :param min_consumers: Lower bound of consumers
+    :param max_consumers: Upper bound of consumers
+    """
+
+    def __init__(
+        self,
+        queue_name: str,
+        func: Callable,
+        start_consumer: Callable,
+        stop_consumer: Callable,
+        min_consumers: int = 1,
+        max_consumers: int = 1,
+    ):
+        self.queue_name = queue_name
+        self.func = func
+        self.min_consumers = min_consumers
+        self.max_consumers = max_consumers
+        self.consumers: List[Any] = []
+        self.handled = 0
+        self._start_consumer = start_consumer
+        self._stop_consumer = stop_consumer
+        self._lock = threading.Lock()
+
+    def handle(self, *args):
+        """Calls the handler of the queue and counts the handled messages"""
+        try:
+            return self.func(*args)
+        finally:
+            with self._lock:
+                self.handled += 1
+
+    def scale_to(self, consumers: int):
+        """Starts or stops consumers until there are ``consumers`` running,
+        within the bounds of the queue
+
+        :param consumers: The number of consumers
+        """
+        consumers = max(self.min_consumers, min(self.max_consumers, consumers))
+        while len(self.consumers) < consumers:
+            self.consumers.append(self._start_consumer(self.handle))
+        while len(self.consumers) > consumers:
+            self._stop_consumer(self.consumers.pop())
+
+
+class Autoscaler:
+    """Periodically samples the depth of each :class:`ScaledQueue` and scales
+    its consumers, so every consumer has about ``target_depth`` messages
+    waiting.
+
+    Consumers are added at once when the queue grows, but removed one per
+    interval when it shrinks. Consumers of other processes count towards the
+    target.
+
+    The gauges ``queue.<name>.depth``, ``queue.<name>.consumers`` (on the
+    broker), ``queue.<name>.concurrency`` (of this process) and
+    ``queue.<name>.lag`` (seconds to drain the queue at the current rate) are
+    recorded.
+
+    :param probe: Returns the message and consumer count of a queue
+    :param interval: Seconds between two samples
+    :param target_depth: Waiting messages per consumer
+    :param metrics: Metrics to record the gauges in
+    """
+
+    def __init__(
+        self,
+        probe: Callable[[str], Tuple[int, int]],
+        interval: float = 5,
+        target_depth: int = 100,
+        metrics: Metrics = None,
+    ):
+        self.interval = interval
+        self.target_depth = target_depth
+        self._probe = probe
+        self._metrics = metrics or Metrics()
+        self._queues: List[ScaledQueue] = []
+        self._handled: Dict[str, int] = {}
+        self._sampled_at = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, queue: ScaledQueue):
+        queue.scale_to(queue.min_consumers)
+        self._queues.append(queue)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """Samples all queues and scales their consumers"""
+        now = time.monotonic()
+        elapsed = max(now - self._sampled_at, 1e-9)
+        self._sampled_at = now
+
+        for queue in list(self._queues):
+            try:
+                depth, consumers = self._probe(queue.queue_name)
+            except pika.exceptions.AMQPError as e:
+                logger.warning("Sampling queue %s failed: %s", queue.queue_name, e)
+                continue
+
+            local = len(queue.consumers)
+            wanted = math.ceil(depth / self.target_depth) - (consumers - local)
+            if wanted < local:
+                # scale down slowly, bursts often come in waves
+                wanted = local - 1
+            wanted = max(queue.min_consumers, min(queue.max_consumers, wanted))
+            if wanted != local:
+                logger.info(
+                    "Scaling consumers of %s from %s to %s",
+                    queue.queue_name,
+                    local,
+                    wanted,
+                )
+            queue.scale_to(wanted)
+
+            handled = queue.handled
+            rate = (handled - self._handled.get(queue.queue_name, 0)) / elapsed
+            self._handled[queue.queue_name] = handled
+
+            prefix = f"queue.{queue.queue_name}"
+            self._metrics.set(f"{prefix}.depth", depth)
+            self._metrics.set(f"{prefix}.consumers", consumers)
+            self._metrics.set(f"{prefix}.concurrency", len(queue.consumers))
+            if depth == 0:
+                self._metrics.set(f"{prefix}.lag", 0)
+            elif rate > 0:
+                self._metrics.set(f"{prefix}.lag", depth / rate)
@@ -0,0 +1,140 @@
+import mmap
+import os
+import re
+import tempfile
+import time
+import uuid
+from typing import BinaryIO
+from typing import Union
+
+_KEY = re.compile(r"^[0-9a-f]{32}$")
+
+
+class BlobStore:
+    """Stores the payloads of claim-checked messages.
+
+    Subclass it to keep the payloads in an object store. Only :meth:`put`,
+    :meth:`open` and :meth:`delete` have to be implemented.
+    """
+
+    def put(self, data: bytes) -> str:
+        """Stores a payload
+
+        :param data: The payload
+        :returns: The key to fetch the payload with
+        """
+        raise NotImplementedError()
+
+    def open(self, key: str) -> BinaryIO:
+        """Opens a stored payload for reading
+
+        :param key: The key returned by :meth:`put`
+        """
+        raise NotImplementedError()
+
+    def get(self, key: str) -> bytes:
+        """Returns a stored payload
+
+        :param key: The key returned by :meth:`put`
+        """
+        with self.open(key) as f:
+            return f.read()
+
+    def delete(self, key: str):
+        """Deletes a stored payload
+
+        :param key: The key returned by :meth:`put`
+        """
+        raise NotImplementedError()
+
+
+class FileSystemBlobStore(BlobStore):
+    """Stores every payload in its own file of a local or shared directory.
+
+    Payloads are not deleted once consumed, as a message may be routed to
+    several queues. Call :meth:`purge` periodically to remove old ones.
+
+    :param path: The directory, it is created if it does not exist
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, data: bytes) -> str:
+        key = uuid.uuid4().hex
+        # write to a temporary file first, so a consumer never sees a
+        # partially written payload
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return key
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def delete(self, key: str):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def purge(self, max_age: float) -> int:
+        """Deletes all payloads older than max_age
+
+        :param max_age: Age in seconds
+        :returns: The number of deleted payloads
+        """
+        deadline = time.time() - max_age
+        deleted = 0
+        for entry in os.scandir(self.path):
+            if _KEY.match(entry.name) and entry.stat().st_mtime < deadline:
+                self.delete(entry.name)
+                deleted += 1
+        return deleted
+
+    def _path(self, key: str) -> str:
+        if not _KEY.match(key):
+            raise ValueError(f"Invalid blob key {key!r}")
+        return os.path.join(self.path, key)
+
+
+class ClaimCheck:
+    """Reference to a payload in a :class:`BlobStore`, which is fetched only
+    when it is accessed.
+
+    :param store: The blob store
+    :param key: The key of the payload
+    """
+
+    def __init__(self, store: BlobStore, key: str):
+        self.store = store
+        self.key = key
+
+    def __repr__(self):
+        return f"<ClaimCheck {self.key}>"
+
+    def open(self) -> BinaryIO:
+        """Opens the payload for reading"""
+        return self.store.open(self.key)
+
+    def read(self) -> bytes:
+        """Returns the payload"""
+        return self.store.get(self.key)
+
+    def mmap(self) -> Union[mmap.mmap, bytes]:
+        """Maps the payload into memory read-only, so it is accessed without
+        copying it. Falls back to :meth:`read` for payloads which are not
+        stored in a file.
+        """
+        with self.open() as f:
+            try:
+                fileno = f.fileno()
+            except (AttributeError, OSError):
+                return f.read()
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
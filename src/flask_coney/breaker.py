@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Dict
+
+from .metrics import Metrics
+from .utils import logger
+
+
+class CircuitBreaker:
+    """Stops calling a service, which keeps timing out.
+
+    The breaker starts closed and lets every call through. After
+    ``failure_threshold`` consecutive failures it opens and rejects all
+    calls. Once ``reset_timeout`` seconds passed it is half-open and lets a
+    single probe through: a success closes it again, a failure opens it for
+    another ``reset_timeout``.
+
+    :param name: Name of the breaker used for logging
+    :param failure_threshold: Consecutive failures before the breaker opens
+    :param reset_timeout: Seconds the breaker stays open
+    :param metrics: Metrics to record state changes in
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        name: str = "",
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        metrics: Metrics = None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        """Returns whether a call may be made"""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._metrics.incr("circuit.rejected")
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit %s closed", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def cancel(self):
+        """Releases the probe of a half-open breaker without a verdict, e.g.
+        because the call failed for an unrelated reason"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("Circuit %s opened", self.name)
+                    self._metrics.incr("circuit.opened")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class CircuitBreakers:
+    """Creates one :class:`CircuitBreaker` per key on demand.
+
+    :param failure_threshold: see :class:`CircuitBreaker`
+    :param reset_timeout: see :class:`CircuitBreaker`
+    :param metrics: see :class:`CircuitBreaker`
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        metrics: Metrics = None,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, key: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(
+                    name=key,
+                    failure_threshold=self.failure_threshold,
+                    reset_timeout=self.reset_timeout,
+                    metrics=self._metrics,
+                )
+            return breaker
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Tuple
+from typing import Union
+
+from .encoder import UUIDEncoder
+from .metrics import Metrics
+
+_MISSING = object()
+
+
+def make_key(
+    exchange_name: str, routing_key: str, body: Union[str, bytes, dict]
+) -> tuple:
+    """Builds the key identifying a request by its target and body.
+
+    Dict bodies are encoded with sorted keys, so two dicts with the same items
+    always map to the same key.
+
+    :param exchange_name: The exchange
+    :param routing_key: The routing key
+    :param body: Body of the message, either a string or a dict
+    """
+    if isinstance(body, dict):
+        body = json.dumps(body, cls=UUIDEncoder, sort_keys=True, separators=(",", ":"))
+    if isinstance(body, str):
+        body = body.encode()
+    return exchange_name, routing_key, hashlib.sha256(body).hexdigest()
+
+
+class ResponseCache:
+    """Thread-safe LRU cache for the responses of :meth:`Coney.publish_sync`.
+
+    Every entry has its own time to live. Expired entries are dropped when
+    they are read, the least recently used entry is evicted once the cache
+    holds ``max_size`` entries.
+
+    :param max_size: Maximum number of cached responses
+    :param metrics: Metrics to record hits and misses in
+    """
+
+    def __init__(self, max_size: int = 1024, metrics: Metrics = None):
+        self.max_size = max_size
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> Tuple[bool, Any]:
+        """Looks up a response
+
+        :param key: see :func:`make_key`
+        :returns: A tuple of whether the key was found and the response
+        """
+        with self._lock:
+            expires, value = self._entries.get(key, (0.0, _MISSING))
+            if value is not _MISSING and expires <= time.monotonic():
+                del self._entries[key]
+                value = _MISSING
+
+            if value is _MISSING:
+                self._metrics.incr("rpc_cache.misses")
+                return False, None
+
+            self._entries.move_to_end(key)
+            self._metrics.incr("rpc_cache.hits")
+            return True, value
+
+    def set(self, key: tuple, value: Any, ttl: float):
+        """Stores a response
+
+        :param key: see :func:`make_key`
+        :param value: The response
+        :param ttl: Seconds the response stays valid
+        """
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._metrics.set("rpc_cache.size", len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._metrics.set("rpc_cache.size", 0)
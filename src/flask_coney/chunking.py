@@ -0,0 +1,165 @@
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from .headers import CHUNK_COUNT_HEADER
+from .headers import CHUNK_ID_HEADER
+from .headers import CHUNK_INDEX_HEADER
+from .metrics import Metrics
+from .utils import logger
+
+
+def split_message(
+    body: Union[str, bytes], properties: dict, max_bytes: Optional[int]
+) -> List[Tuple[bytes, dict]]:
+    """Splits a body larger than max_bytes into ordered chunks.
+
+    Every chunk keeps the properties of the message and gets headers with
+    the id of the message, its index and the number of chunks.
+
+    :param body: The encoded body
+    :param properties: see :py:class:`pika.spec.BasicProperties`
+    :param max_bytes: Maximum size of a chunk, None to never split
+    :returns: A list of (body, properties) tuples
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    if not max_bytes or len(body) <= max_bytes:
+        return [(body, properties)]
+
+    chunk_id = uuid.uuid4().hex
+    count = (len(body) + max_bytes - 1) // max_bytes
+    chunks = []
+    for index in range(count):
+        headers = {
+            **(properties.get("headers") or {}),
+            CHUNK_ID_HEADER: chunk_id,
+            CHUNK_INDEX_HEADER: index,
+            CHUNK_COUNT_HEADER: count,
+        }
+        chunk = body[index * max_bytes : (index + 1) * max_bytes]
+        chunks.append((chunk, {**properties, "headers": headers}))
+    return chunks
+
+
+def is_chunk(headers: Optional[dict]) -> bool:
+    return bool(headers and CHUNK_ID_HEADER in headers)
+
+
+def without_chunk_headers(headers: Optional[dict]) -> dict:
+    """Returns a copy of the headers without the ones added by
+    :func:`split_message`"""
+    return {
+        key: value
+        for key, value in (headers or {}).items()
+        if key not in (CHUNK_ID_HEADER, CHUNK_INDEX_HEADER, CHUNK_COUNT_HEADER)
+    }
+
+
+class _Pending:
+    def __init__(self, count: int, memory_bytes: int):
+        self.count = count
+        self.next_index = 0
+        self.started = time.monotonic()
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=memory_bytes)
+
+
+class Reassembler:
+    """Joins the chunks created by :func:`split_message` back into one body.
+
+    Each incomplete message is buffered in memory up to ``memory_bytes`` and
+    spills to a temporary file beyond that. Messages not completed within
+    ``timeout`` seconds, or whose chunks arrive out of order, are dropped.
+
+    The chunks of a message must all reach the same reassembler, so a queue
+    receiving chunks may only have one active consumer.
+
+    :param timeout: Seconds to wait for the missing chunks of a message
+    :param memory_bytes: Bytes of a message buffered in memory
+    :param metrics: Metrics to record dropped messages in
+    :param on_drop: Called with the chunk id of a dropped message
+    """
+
+    def __init__(
+        self,
+        timeout: float = 60,
+        memory_bytes: int = 8 * 1024 * 1024,
+        metrics: Metrics = None,
+        on_drop: Callable[[str], None] = None,
+    ):
+        self.timeout = timeout
+        self.memory_bytes = memory_bytes
+        self._metrics = metrics or Metrics()
+        self._on_drop = on_drop
+        self._lock = threading.Lock()
+        self._pending: Dict[str, _Pending] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, headers: dict, body: bytes) -> Optional[bytes]:
+        """Buffers a chunk
+
+        :param headers: The headers of the chunk
+        :param body: The body of the chunk
+        :returns: The complete body once the last chunk was added, else None
+        """
+        chunk_id = headers[CHUNK_ID_HEADER]
+        index = int(headers[CHUNK_INDEX_HEADER])
+
+        with self._lock:
+            self._expire()
+            pending = self._pending.get(chunk_id)
+            if pending is None and index == 0:
+                pending = _Pending(int(headers[CHUNK_COUNT_HEADER]), self.memory_bytes)
+                self._pending[chunk_id] = pending
+
+            if pending is None or index != pending.next_index:
+                logger.warning("Dropping chunked message %s: missing chunk", chunk_id)
+                self._drop(chunk_id)
+                return None
+
+            pending.buffer.write(body)
+            pending.next_index += 1
+            if pending.next_index < pending.count:
+                return None
+
+            del self._pending[chunk_id]
+
+        pending.buffer.seek(0)
+        body = pending.buffer.read()
+        pending.buffer.close()
+        return body
+
+    def discard(self, chunk_id: str):
+        """Forgets the buffered chunks of a message, e.g. because they are
+        delivered again
+
+        :param chunk_id: The id of the chunked message
+        """
+        with self._lock:
+            pending = self._pending.pop(chunk_id, None)
+        if pending is not None:
+            pending.buffer.close()
+
+    def _expire(self):
+        deadline = time.monotonic() - self.timeout
+        for chunk_id, pending in list(self._pending.items()):
+            if pending.started < deadline:
+                logger.warning("Dropping chunked message %s: timed out", chunk_id)
+                self._drop(chunk_id)
+
+    def _drop(self, chunk_id: str):
+        pending = self._pending.pop(chunk_id, None)
+        if pending is not None:
+            pending.buffer.close()
+        self._metrics.incr("chunks.dropped")
+        if self._on_drop is not None:
+            self._on_drop(chunk_id)
@@ -0,0 +1,148 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .encoder import Codec
+from .profiling import format_allocations
+from .profiling import format_stats
+from .profiling import load_profiles
+from .recording import parse_speed
+from .recording import read_records
+from .recording import record
+from .recording import RecordWriter
+from .recording import replay
+from .recording import replay_properties
+
+cli = AppGroup(
+    "coney", help="Inspect the Coney consumers and record or replay messages."
+)
+
+
+@cli.command("profile")
+@click.option(
+    "--directory",
+    help="Directory of the profiles, defaults to CONEY_PROFILE_DIR.",
+)
+@click.option("--queue", help="Only show the profile of this queue.")
+@click.option(
+    "--sort", default="cumulative", show_default=True, help="pstats sort key."
+)
+@click.option("--limit", default=20, show_default=True, help="Lines per queue.")
+def profile_command(directory, queue, sort, limit):
+    """Shows the handler profiles written by the consumers of all
+    processes."""
+    directory = directory or current_app.config.get("CONEY_PROFILE_DIR")
+    if not directory:
+        raise click.UsageError("Pass --directory or set CONEY_PROFILE_DIR.")
+
+    profiles = load_profiles(directory)
+    if not profiles:
+        click.echo(f"No profiles in {directory}")
+    for name, (stats, allocations) in sorted(profiles.items()):
+        if queue is not None and name != queue:
+            continue
+        click.echo(f"Queue {name}")
+        if stats is not None:
+            click.echo(format_stats(stats, sort, limit))
+        for line in format_allocations(allocations, limit):
+            click.echo(line)
+
+
+@cli.command("record")
+@click.option("--queue", help="Consume the messages of this queue.")
+@click.option(
+    "--exchange",
+    help="Record a copy of the messages of this exchange through a temporary"
+    " queue instead of consuming a queue.",
+)
+@click.option(
+    "--routing-key",
+    default="#",
+    show_default=True,
+    help="Binding of the temporary queue.",
+)
+@click.option("--out", "path", required=True, help="File the messages are added to.")
+@click.option("--limit", type=int, help="Stop after that many messages.")
+@click.option("--duration", type=float, help="Stop after that many seconds.")
+def record_command(queue, exchange, routing_key, path, limit, duration):
+    """Records deliveries with their properties, routing key and time.
+
+    Recording a --queue consumes its messages, so other consumers will not
+    get them. Record an --exchange to leave the traffic untouched.
+    """
+    if bool(queue) == bool(exchange):
+        raise click.UsageError("Pass either --queue or --exchange.")
+
+    coney = current_app.extensions["coney"].coney
+    with coney.channel(current_app) as channel, RecordWriter(path) as writer:
+        if exchange:
+            result = channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+            queue = result.method.queue
+            channel.queue_bind(queue, exchange, routing_key=routing_key)
+        click.echo(f"Recording {queue} to {path}, press Ctrl+C to stop")
+        try:
+            count = record(channel, queue, writer, limit=limit, duration=duration)
+        except KeyboardInterrupt:
+            count = None
+    if count is not None:
+        click.echo(f"Recorded {count} messages")
+
+
+@cli.command("replay")
+@click.option("--file", "path", required=True, help="A file written by record.")
+@click.option(
+    "--speed",
+    default="1x",
+    show_default=True,
+    help="Rate relative to the recording, e.g. 10x. 0 sends as fast as possible.",
+)
+@click.option("--exchange", help="Publish to this exchange instead.")
+@click.option("--routing-key", help="Publish with this routing key instead.")
+@click.option(
+    "--keep-reply-to",
+    is_flag=True,
+    help="Keep the reply_to of requests, so the replies go to the recorded"
+    " reply queues.",
+)
+@click.option(
+    "--keep-message-id",
+    is_flag=True,
+    help="Keep the recorded message ids, so consumers skip the messages they"
+    " already handled.",
+)
+def replay_command(path, speed, exchange, routing_key, keep_reply_to, keep_message_id):
+    """Publishes recorded messages at their original or a multiplied rate.
+
+    Deadlines are moved to the time of the replay, trace headers and, unless
+    kept, reply_to are dropped. Message ids are replaced by new ones unless
+    kept.
+    """
+    try:
+        speed = parse_speed(speed)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--speed") from None
+
+    coney = current_app.extensions["coney"].coney
+    publishers = {}
+
+    def send(item):
+        key = (
+            item.exchange if exchange is None else exchange,
+            item.routing_key if routing_key is None else routing_key,
+        )
+        publisher = publishers.get(key)
+        if publisher is None:
+            publisher = publishers[key] = coney.publisher(
+                exchange_name=key[0], routing_key=key[1], codec=Codec(), app=current_app
+            )
+        properties = replay_properties(
+            item, keep_reply_to=keep_reply_to, keep_message_id=keep_message_id
+        )
+        publisher.send(item.body, properties=properties)
+
+    try:
+        count = replay(read_records(path), send, speed=speed)
+    finally:
+        for publisher in publishers.values():
+            publisher.close()
+    click.echo(f"Replayed {count} messages")
@@ -1,11 +1,24 @@
+import copy
 import functools
 import json
+import threading
 import time
 
 import pika
 
+from .blobstore import ClaimCheck
+from .chunking import is_chunk
+from .chunking import Reassembler
+from .chunking import without_chunk_headers
 from .exchange import ExchangeType
+from .failover import BrokerPool
+from .headers import CHUNK_ID_HEADER
+from .headers import CLAIM_CHECK_HEADER
+from .headers import DEADLINE_HEADER
+from .headers import RETRY_COUNT_HEADER
+from .metrics import Metrics
 from .utils import logger
+from .utils import time_ns
 
 
 class Consumer:
@@ -17,6 +30,18 @@ class Consumer:
         queue="",
         routing_keys=None,
         on_message=None,
+        metrics=None,
+        chunk_timeout=60,
+        chunk_memory_bytes=8 * 1024 * 1024,
+        blob_store=None,
+        lazy_claim_check=False,
+        retries=None,
+        dedup=None,
+        profiler=None,
+        tracer=None,
+        chunked=False,
+        prefetch_count=1,
+        manual_ack=False,
     ):
         self.should_reconnect = False
         self.was_consuming = False
@@ -24,17 +49,34 @@ class Consumer:
         self._connection = None
         self._channel = None
         self._closing = False
-        self._consumer_Tag = None
+        self._stop_requested = False
+        self._consumer_tag = None
         self._url = url
         self._consuming = False
-        self._prefetch_count = 1
+        self._prefetch_count = prefetch_count
+        self._chunked = chunked
+        self._manual_ack = manual_ack
         self._exchange = exchange
         self._exchange_type = exchange_type.value
         self._queue = queue
-        if not routing_keys:
+        if routing_keys is None:
             routing_keys = []
         self._routing_keys = routing_keys
         self._on_message = on_message
+        self._metrics = metrics or Metrics()
+        self._reassembler = Reassembler(
+            timeout=chunk_timeout,
+            memory_bytes=chunk_memory_bytes,
+            metrics=metrics,
+            on_drop=self.reject_chunks,
+        )
+        self._chunk_tags = {}
+        self._blob_store = blob_store
+        self._lazy_claim_check = lazy_claim_check
+        self._retries = retries
+        self._dedup = dedup
+        self._profiler = profiler
+        self._tracer = tracer
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -172,7 +214,20 @@ class Consumer:
         """
         logger.info("Declaring queue %s", queue_name)
         cb = functools.partial(self.on_queue_declareok, userdata=queue_name)
-        self._channel.queue_declare(queue=queue_name, callback=cb)
+        arguments = None
+        if self._chunked:
+            # the chunks of a message must all reach the same consumer
+            arguments = {"x-single-active-consumer": True}
+        # a server-named queue gets a new name on every reconnect, so it must
+        # not outlive the connection
+        unnamed = not queue_name
+        self._channel.queue_declare(
+            queue=queue_name,
+            exclusive=unnamed,
+            auto_delete=unnamed,
+            arguments=arguments,
+            callback=cb,
+        )
 
     def on_queue_declareok(self, _unused_frame, userdata):
         """Method invoked by pika when the Queue.Declare RPC call made in
@@ -190,7 +245,7 @@ class Consumer:
                     "Binding %s to %s with %s",
                     self._exchange,
                     queue_name,
-                    self._routing_key,
+                    routing_key,
                 )
                 self._channel.queue_bind(
                     queue_name, self._exchange, routing_key=routing_key
@@ -200,14 +255,54 @@ class Consumer:
             logger.info("Queue is already bound to default exchange")
             self.on_bindok(_unused_frame, userdata)
 
+    def bind(self, routing_key):
+        """Binds the queue to another routing key. It is safe to call this
+        from another thread while the consumer is running.
+        :param str routing_key: The routing key
+        """
+        if routing_key in self._routing_keys:
+            return
+        self._routing_keys.append(routing_key)
+        # if the queue is not declared yet, on_queue_declareok binds the key
+        if self._connection is not None and self._channel is not None:
+            self._connection.ioloop.add_callback_threadsafe(
+                functools.partial(
+                    self._channel.queue_bind,
+                    self._queue,
+                    self._exchange,
+                    routing_key=routing_key,
+                )
+            )
+
     def on_bindok(self, _unused_frame, userdata):
         """Invoked when the Queue.Bind method has completed. At this
         point we will set the prefetch count for the channel.
         :param str|unicode userdata: Extra user data (queue name)
         """
         logger.info("Queue bound: %s", userdata)
+        if self._retries is not None:
+            self.setup_retry_queues()
         self.set_qos()
 
+    def setup_retry_queues(self):
+        """Declares a queue per retry delay, whose messages are dead-lettered
+        back to the queue once they expired, and the parking lot queue for
+        messages which failed after the last retry.
+        """
+        for attempt, delay in enumerate(self._retries):
+            queue_name = self.retry_queue_name(attempt)
+            logger.info("Declaring retry queue %s", queue_name)
+            self._channel.queue_declare(
+                queue=queue_name,
+                arguments={
+                    "x-message-ttl": int(delay * 1000),
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": self._queue,
+                },
+            )
+        logger.info("Declaring parking lot queue %s", self.parking_lot_name())
+        self._channel.queue_declare(queue=self.parking_lot_name())
+
     def set_qos(self):
         """This method sets up the consumer prefetch to only be delivered
         one message at a time. The consumer must acknowledge this message
@@ -271,16 +366,237 @@ class Consumer:
         :param pika.Spec.BasicProperties: properties
         :param bytes body: The message body
         """
+        # only traced messages need the timestamp
+        received_ns = time_ns() if self._tracer is not None else None
         logger.info(
             "Received message # %s from %s: %s",
             basic_deliver.delivery_tag,
             properties.app_id,
             body,
         )
-        self.acknowledge_message(basic_deliver.delivery_tag)
-        if properties.content_type == "application/json":
+        if self.is_expired(properties):
+            logger.info("Dropping expired message # %s", basic_deliver.delivery_tag)
+            self._metrics.incr("consumer.shed")
+            self.reject_message(basic_deliver.delivery_tag)
+            return
+
+        if self.is_duplicate(properties):
+            logger.info("Dropping duplicate message %s", properties.message_id)
+            self._metrics.incr("consumer.deduplicated")
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+
+        claim_check_key = (properties.headers or {}).get(CLAIM_CHECK_HEADER)
+        if claim_check_key is not None and self._blob_store is None:
+            logger.error(
+                "Dropping claim-checked message # %s: no blob store configured",
+                basic_deliver.delivery_tag,
+            )
+            self.reject_message(basic_deliver.delivery_tag)
+            return
+
+        if is_chunk(properties.headers):
+            if not self._chunked:
+                logger.error(
+                    "Rejecting chunk # %s: the queue is not consumed as chunked",
+                    basic_deliver.delivery_tag,
+                )
+                self._metrics.incr("chunks.rejected")
+                self.reject_message(basic_deliver.delivery_tag)
+                return
+            body, delivery_tags = self.add_chunk(
+                basic_deliver.delivery_tag, properties.headers, body
+            )
+            if body is None:
+                return
+        else:
+            delivery_tags = [basic_deliver.delivery_tag]
+        if self._retries is None:
+            # with a manual ack the handler acknowledges the message itself
+            if not self._manual_ack:
+                for delivery_tag in delivery_tags:
+                    self.acknowledge_message(delivery_tag)
+            body = self.decode_body(properties, body)
+            self.handle_message(channel, basic_deliver, properties, body, received_ns)
+            self.mark_handled(properties)
+            return
+
+        # a body which can not be decoded or fetched is retried and parked
+        # like a failing handler, instead of killing the consumer
+        try:
+            decoded = self.decode_body(properties, body)
+            self.handle_message(
+                channel, basic_deliver, properties, decoded, received_ns
+            )
+        except Exception:
+            logger.exception("Handling message # %s failed", basic_deliver.delivery_tag)
+            self.retry_message(properties, body)
+        else:
+            self.mark_handled(properties)
+        for delivery_tag in delivery_tags:
+            self.acknowledge_message(delivery_tag)
+
+    def decode_body(self, properties, body):
+        """Fetches the payload of a claim check and decodes JSON bodies.
+        :param pika.Spec.BasicProperties: properties
+        :param bytes body: The message body
+        """
+        claim_check_key = (properties.headers or {}).get(CLAIM_CHECK_HEADER)
+        if claim_check_key is not None:
+            body = ClaimCheck(self._blob_store, claim_check_key)
+            # with a lazy claim check the handler decides when and how to
+            # fetch the payload
+            if not self._lazy_claim_check:
+                body = body.read()
+        if properties.content_type == "application/json" and not isinstance(
+            body, ClaimCheck
+        ):
             body = json.loads(body)
-        self._on_message(channel, basic_deliver, properties, body)
+        return body
+
+    def add_chunk(self, delivery_tag, headers, body):
+        """Buffers a chunk. Its ack is held until the message is complete,
+        so the chunks are redelivered if the consumer dies before. If the
+        held chunks fill the prefetch window, the broker would not deliver
+        the missing ones, so the oldest incomplete message is requeued. A
+        message which fills the window on its own can never complete and is
+        rejected.
+        :param int delivery_tag: The delivery tag of the chunk
+        :param dict headers: The headers of the chunk
+        :param bytes body: The body of the chunk
+        :returns: The body and the delivery tags of the held chunks once the
+            message is complete, else (None, None)
+        """
+        chunk_id = headers[CHUNK_ID_HEADER]
+        self._chunk_tags.setdefault(chunk_id, []).append(delivery_tag)
+        body = self._reassembler.add(headers, body)
+        if body is not None:
+            return body, self._chunk_tags.pop(chunk_id, [])
+
+        held = sum(len(tags) for tags in self._chunk_tags.values())
+        if held >= self._prefetch_count:
+            oldest = next(iter(self._chunk_tags))
+            tags = self._chunk_tags.pop(oldest)
+            self._reassembler.discard(oldest)
+            if self._chunk_tags:
+                logger.warning(
+                    "Prefetch window full, requeueing chunked message %s", oldest
+                )
+                self._metrics.incr("chunks.requeued")
+                for tag in tags:
+                    self.requeue_message(tag)
+            else:
+                logger.error(
+                    "Rejecting chunked message %s: more chunks than the prefetch"
+                    " window",
+                    oldest,
+                )
+                self._metrics.incr("chunks.dropped")
+                for tag in tags:
+                    self.reject_message(tag)
+        return None, None
+
+    def reject_chunks(self, chunk_id):
+        """Rejects the held chunks of a message the reassembler dropped.
+        :param str chunk_id: The id of the chunked message
+        """
+        for delivery_tag in self._chunk_tags.pop(chunk_id, []):
+            self.reject_message(delivery_tag)
+
+    def handle_message(
+        self, channel, basic_deliver, properties, body, received_ns=None
+    ):
+        queue = self._queue or self._exchange or "amq.default"
+        if self._tracer is None:
+            self._call_handler(queue, channel, basic_deliver, properties, body)
+            return
+
+        with self._tracer.consume(
+            queue,
+            basic_deliver.routing_key,
+            properties.headers,
+            received_ns or time_ns(),
+        ):
+            self._call_handler(queue, channel, basic_deliver, properties, body)
+
+    def _call_handler(self, queue, channel, basic_deliver, properties, body):
+        if self._profiler is None:
+            self._on_message(channel, basic_deliver, properties, body)
+        else:
+            self._profiler.call(
+                queue, self._on_message, channel, basic_deliver, properties, body
+            )
+
+    def is_duplicate(self, properties):
+        """Checks if a message with the same id was already handled.
+        :param pika.Spec.BasicProperties: properties
+        :rtype: bool
+        """
+        return (
+            self._dedup is not None
+            and properties.message_id is not None
+            and self._dedup.seen(properties.message_id)
+        )
+
+    def mark_handled(self, properties):
+        """Remembers the id of a message, once it was handled successfully.
+        :param pika.Spec.BasicProperties: properties
+        """
+        if self._dedup is not None and properties.message_id is not None:
+            self._dedup.add(properties.message_id)
+
+    def retry_message(self, properties, body):
+        """Publishes a failed message to the next retry queue, from where it
+        is dead-lettered back to the queue once its delay passed. After the
+        last retry the message is moved to the parking lot queue.
+        :param pika.Spec.BasicProperties: properties
+        :param bytes body: The message body
+        """
+        headers = without_chunk_headers(properties.headers)
+        attempt = int(headers.get(RETRY_COUNT_HEADER, 0))
+        if attempt < len(self._retries):
+            queue_name = self.retry_queue_name(attempt)
+            self._metrics.incr("consumer.retried")
+        else:
+            queue_name = self.parking_lot_name()
+            self._metrics.incr("consumer.parked")
+        headers[RETRY_COUNT_HEADER] = attempt + 1
+
+        logger.info("Moving message to %s", queue_name)
+        properties = copy.copy(properties)
+        properties.headers = headers
+        self._channel.basic_publish("", queue_name, body, properties)
+
+    def retry_queue_name(self, attempt):
+        return f"{self._queue}.retry.{attempt}"
+
+    def parking_lot_name(self):
+        return f"{self._queue}.parking-lot"
+
+    def is_expired(self, properties):
+        """Checks the deadline a client like :meth:`Coney.publish_sync` set.
+        Nobody waits for the reply of an expired message anymore.
+        :param pika.Spec.BasicProperties: properties
+        :rtype: bool
+        """
+        deadline = (properties.headers or {}).get(DEADLINE_HEADER)
+        return deadline is not None and float(deadline) < time.time()
+
+    def reject_message(self, delivery_tag):
+        """Reject the message delivery from RabbitMQ without requeueing it,
+        by sending a Basic.Nack RPC method for the delivery tag.
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        """
+        logger.info("Rejecting message %s", delivery_tag)
+        self._channel.basic_nack(delivery_tag, requeue=False)
+
+    def requeue_message(self, delivery_tag):
+        """Hand the message delivery back to RabbitMQ, which delivers it
+        again, by sending a Basic.Nack RPC method for the delivery tag.
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        """
+        logger.info("Requeueing message %s", delivery_tag)
+        self._channel.basic_nack(delivery_tag, requeue=True)
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
@@ -325,8 +641,35 @@ class Consumer:
         starting the IOLoop to block and allow the SelectConnection to operate.
         """
         self._connection = self.connect()
+        if self._stop_requested:
+            # request_stop ran before the connection existed
+            self._connection.ioloop.add_callback_threadsafe(self.shutdown)
         self._connection.ioloop.start()
 
+    def request_stop(self):
+        """Schedules :meth:`shutdown` on the ioloop. It is safe to call this
+        from another thread, a message being handled is finished first.
+        """
+        self._stop_requested = True
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self.shutdown)
+
+    def shutdown(self):
+        """Cancels the consumer and closes the channel and connection, the
+        ioloop stops once the connection is closed. Must run on the ioloop.
+        """
+        if self._closing:
+            return
+        self._closing = True
+        logger.info("Shutting down")
+        if self._consuming and self._channel is not None:
+            self.stop_consuming()
+        elif self._connection.is_closed:
+            self._connection.ioloop.stop()
+        else:
+            self.close_connection()
+
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
         with RabbitMQ. When RabbitMQ confirms the cancellation, on_cancelok
@@ -349,10 +692,25 @@ class Consumer:
 
 
 class ReconnectingConsumer:
-    def __init__(self, url: str, **kwargs):
-        self._reconnect_delay = 0
-        self._url = url
-        self._consumer = Consumer(self._url, **kwargs)
+    """Runs a :class:`Consumer` and replaces it with a new one, which
+    declares the exchange, queue and bindings again, whenever its connection
+    fails.
+
+    A node which dropped an established connection is skipped by the broker
+    pool, so the consumer resumes on another node of the cluster right away.
+
+    :param url: The broker URI or a :class:`BrokerPool` of the cluster nodes
+    :param kwargs: The arguments of :class:`Consumer`
+    """
+
+    def __init__(self, url, **kwargs):
+        self._pool = url if isinstance(url, BrokerPool) else BrokerPool(url)
+        # the consumers share the list, so keys bound later are restored too
+        kwargs["routing_keys"] = list(kwargs.get("routing_keys") or [])
+        self._kwargs = kwargs
+        self._stopped = threading.Event()
+        self._url = self._pool.select()
+        self._consumer = Consumer(self._url, **self._kwargs)
         self._running = True
 
     def run(self):
@@ -361,24 +719,30 @@ class ReconnectingConsumer:
             self._consumer.run()
             self._maybe_reconnect()
 
+    def bind(self, routing_key: str):
+        self._consumer.bind(routing_key)
+
     def stop(self):
+        """Stops consuming and closes the connection. It is safe to call this
+        from another thread, the shutdown runs on the ioloop of the consumer.
+        Join the thread running :meth:`run` to wait for it.
+        """
         self._running = False
-        self._consumer.stop_consuming()
-        self._consumer._connection.ioloop.stop()
+        self._stopped.set()
+        self._consumer.request_stop()
 
     def _maybe_reconnect(self):
         if self._consumer.should_reconnect:
             self._consumer.stop()
-            reconnect_delay = self._get_reconnect_delay()
-            logger.info(f"Reconnecting after {reconnect_delay} seconds")
-            time.sleep(reconnect_delay)
-            self._consumer = Consumer(self._url)
-
-    def _get_reconnect_delay(self):
-        if self._consumer.was_consuming:
-            self._reconnect_delay = 0
-        else:
-            self._reconnect_delay += 1
-        if self._reconnect_delay > 30:
-            self._reconnect_delay = 30
-        return self._reconnect_delay
+            if self._consumer.was_consuming:
+                # a node which served the consumer starts over with the
+                # shortest backoff
+                self._pool.record_success(self._url)
+            self._pool.record_failure(self._url)
+            self._url = self._pool.select()
+            reconnect_delay = self._pool.delay(self._url)
+            logger.info(
+                "Reconnecting to %s after %.2f seconds", self._url, reconnect_delay
+            )
+            self._stopped.wait(reconnect_delay)
+            self._consumer = Consumer(self._url, **self._kwargs)
@@ -0,0 +1,234 @@
+import sys
+import threading
+import uuid
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pika
+from pika.adapters.blocking_connection import BlockingChannel
+
+from .aio import REPLY_TO
+from .utils import logger
+
+
+def is_monkey_patched() -> bool:
+    """Returns whether gevent or eventlet patched the socket module, so
+    threads are greenlets and blocking calls yield to the hub.
+
+    Neither library is imported, only already loaded modules are checked.
+    """
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    if gevent_monkey is not None and gevent_monkey.is_module_patched("socket"):
+        return True
+    eventlet_patcher = sys.modules.get("eventlet.patcher")
+    if eventlet_patcher is not None and eventlet_patcher.is_monkey_patched("socket"):
+        return True
+    return False
+
+
+class ReplyWaiter:
+    """Waits for the first reply to the requests it sent through a
+    :class:`SharedRpcClient`. Use it as a context manager, so it stops
+    listening for late replies.
+
+    :param client: The client sending the requests
+    """
+
+    def __init__(self, client: "SharedRpcClient"):
+        self.corr_ids: List[str] = []
+        self.reply: Optional[Tuple[str, pika.spec.BasicProperties, bytes]] = None
+        self.error: Optional[Exception] = None
+        self._client = client
+        self._done = threading.Event()
+
+    def __enter__(self) -> "ReplyWaiter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    def send(
+        self, exchange: str, routing_key: str, messages: List[Tuple[bytes, dict]]
+    ) -> str:
+        """Publishes a request with a new correlation id
+
+        :param exchange: The exchange
+        :param routing_key: The routing key
+        :param messages: The body and properties of each chunk of the request
+        :returns: The correlation id
+        """
+        corr_id = str(uuid.uuid4())
+        self.corr_ids.append(corr_id)
+        self._client.send(self, exchange, routing_key, messages, corr_id)
+        return corr_id
+
+    def wait(self, timeout: float) -> bool:
+        """Waits for a reply, yielding to other greenlets when monkey patched
+
+        :param timeout: Seconds to wait
+        :returns: Whether a reply arrived or the connection failed
+        """
+        return self._done.wait(timeout)
+
+    def close(self):
+        self._client.forget(self.corr_ids)
+
+    def resolve(self, corr_id: str, props: pika.spec.BasicProperties, body: bytes):
+        if not self._done.is_set():
+            self.reply = (corr_id, props, body)
+            self._done.set()
+
+    def fail(self, error: Exception):
+        if not self._done.is_set():
+            self.error = error
+            self._done.set()
+
+
+class SharedRpcClient:
+    """Sends the requests of all threads or greenlets over one shared
+    connection and dispatches the replies, which arrive through direct
+    reply-to.
+
+    A single I/O thread owns the connection, so waiting callers only block
+    on an event. Under gevent or eventlet the thread is a greenlet and
+    thousands of callers can wait in one worker.
+
+    :param connect: Returns a new :class:`pika.BlockingConnection`
+    :param receive: Called with the properties and body of a reply, returns
+        the body or None if the reply is not complete yet
+    :param connect_timeout: Seconds a request waits for the connection
+    :param reconnect_delay: Seconds to wait before reconnecting
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], pika.BlockingConnection],
+        receive: Callable = None,
+        connect_timeout: float = 10,
+        reconnect_delay: float = 1,
+    ):
+        self.connect_timeout = connect_timeout
+        self.reconnect_delay = reconnect_delay
+        self._connect = connect
+        self._receive = receive or (lambda props, body: body)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, ReplyWaiter] = {}
+        self._connection: Optional[pika.BlockingConnection] = None
+        self._channel: Optional[BlockingChannel] = None
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def waiter(self) -> ReplyWaiter:
+        """Returns a new :class:`ReplyWaiter`, connecting on first use"""
+        self.start()
+        return ReplyWaiter(self)
+
+    def send(
+        self,
+        waiter: ReplyWaiter,
+        exchange: str,
+        routing_key: str,
+        messages: List[Tuple[bytes, dict]],
+        corr_id: str,
+    ):
+        """Publishes a request from any thread, the reply is passed to the
+        waiter
+
+        :raises:
+            pika.exceptions.AMQPConnectionError: if the connection is not
+                established in time or is lost
+        """
+        if not self._ready.wait(self.connect_timeout):
+            raise pika.exceptions.AMQPConnectionError("Shared connection is down")
+
+        with self._lock:
+            connection, channel = self._connection, self._channel
+            # the connection may have failed since the event was checked
+            if connection is None:
+                raise pika.exceptions.AMQPConnectionError("Shared connection is down")
+            self._pending[corr_id] = waiter
+
+        def publish():
+            for body, properties in messages:
+                properties = {
+                    **properties,
+                    "reply_to": REPLY_TO,
+                    "correlation_id": corr_id,
+                }
+                channel.basic_publish(
+                    exchange, routing_key, body, pika.BasicProperties(**properties)
+                )
+
+        connection.add_callback_threadsafe(publish)
+
+    def forget(self, corr_ids: List[str]):
+        """Drops the replies to the correlation ids arriving later"""
+        with self._lock:
+            for corr_id in corr_ids:
+                self._pending.pop(corr_id, None)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            connection, thread = self._connection, self._thread
+            self._thread = None
+        if connection is not None:
+            # wakes up process_data_events
+            connection.add_callback_threadsafe(lambda: None)
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                channel = connection.channel()
+                channel.basic_consume(REPLY_TO, self._on_reply, auto_ack=True)
+                with self._lock:
+                    self._connection, self._channel = connection, channel
+                self._ready.set()
+                while not self._stopped.is_set():
+                    connection.process_data_events(time_limit=1)
+            except pika.exceptions.AMQPError as e:
+                logger.warning("Shared connection failed: %s", e)
+                self._fail_pending(e)
+            finally:
+                self._ready.clear()
+                with self._lock:
+                    self._connection, self._channel = None, None
+                if connection is not None and connection.is_open:
+                    connection.close()
+            self._stopped.wait(self.reconnect_delay)
+
+    def _fail_pending(self, error: Exception):
+        with self._lock:
+            waiters = list(self._pending.values())
+            self._pending.clear()
+        for waiter in waiters:
+            waiter.fail(error)
+
+    def _on_reply(self, _channel, _method, props, body):
+        body = self._receive(props, body)
+        if body is None:
+            return
+        with self._lock:
+            waiter = self._pending.get(props.correlation_id)
+        if waiter is not None:
+            waiter.resolve(props.correlation_id, props, body)
@@ -0,0 +1,184 @@
+import collections
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+
+class DedupFilter:
+    """Remembers the ids of handled messages, so duplicates are skipped.
+
+    Subclass it to share the ids with other processes. Only :meth:`seen`
+    and :meth:`add` have to be implemented.
+    """
+
+    def seen(self, message_id: str) -> bool:
+        """Returns whether a message was already handled
+
+        :param message_id: The message id
+        """
+        raise NotImplementedError()
+
+    def add(self, message_id: str):
+        """Remembers a handled message
+
+        :param message_id: The message id
+        """
+        raise NotImplementedError()
+
+
+class LRUDedupFilter(DedupFilter):
+    """Remembers the most recent ids for ``window`` seconds.
+
+    :param max_size: Maximum number of ids kept
+    :param window: Seconds an id is kept
+    """
+
+    def __init__(self, max_size: int = 100000, window: float = 3600):
+        self.max_size = max_size
+        self.window = window
+        self._lock = threading.Lock()
+        self._ids: "collections.OrderedDict[str, float]" = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def seen(self, message_id: str) -> bool:
+        with self._lock:
+            added = self._ids.get(message_id)
+            return added is not None and time.monotonic() - added < self.window
+
+    def add(self, message_id: str):
+        now = time.monotonic()
+        with self._lock:
+            self._ids[message_id] = now
+            self._ids.move_to_end(message_id)
+            # ids are ordered by age, so the expired ones are in front
+            while self._ids:
+                oldest = next(iter(self._ids.values()))
+                if len(self._ids) <= self.max_size and now - oldest < self.window:
+                    break
+                self._ids.popitem(last=False)
+
+
+class _Bloom:
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = 0
+        self.created = time.monotonic()
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, message_id: str):
+        digest = hashlib.sha256(message_id.encode()).digest()
+        a = int.from_bytes(digest[:8], "big")
+        b = int.from_bytes(digest[8:16], "big") | 1
+        return ((a + i * b) % self.bits for i in range(self.hashes))
+
+    def __contains__(self, message_id: str) -> bool:
+        return all(
+            self._array[p >> 3] & (1 << (p & 7)) for p in self._positions(message_id)
+        )
+
+    def add(self, message_id: str):
+        for p in self._positions(message_id):
+            self._array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class BloomDedupFilter(DedupFilter):
+    """Remembers ids in two rotating Bloom filters of fixed size.
+
+    Once the current filter holds ``capacity`` ids or is older than
+    ``window`` seconds, it replaces the previous one and a new filter is
+    started. An id is thus remembered for at least one generation. A Bloom
+    filter may report an id as seen, which was never added, with the
+    probability ``error_rate``, and the message is skipped.
+
+    :param capacity: Ids per generation
+    :param error_rate: Probability of a false positive
+    :param window: Seconds after which the filter rotates
+    """
+
+    def __init__(
+        self, capacity: int = 1000000, error_rate: float = 0.001, window: float = 3600
+    ):
+        self.capacity = capacity
+        self.window = window
+        self._bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._bits / capacity * math.log(2)))
+        self._lock = threading.Lock()
+        self._current = _Bloom(self._bits, self._hashes)
+        self._previous = None
+
+    def seen(self, message_id: str) -> bool:
+        with self._lock:
+            self._maybe_rotate()
+            return message_id in self._current or (
+                self._previous is not None and message_id in self._previous
+            )
+
+    def add(self, message_id: str):
+        with self._lock:
+            self._maybe_rotate()
+            self._current.add(message_id)
+
+    def _maybe_rotate(self):
+        current = self._current
+        if (
+            current.count >= self.capacity
+            or time.monotonic() - current.created >= self.window
+        ):
+            self._previous = current
+            self._current = _Bloom(self._bits, self._hashes)
+
+
+class SqliteDedupFilter(DedupFilter):
+    """Remembers ids for ``window`` seconds in a sqlite database, which is
+    shared by all processes on a host.
+
+    :param path: Path of the sqlite database file
+    :param window: Seconds an id is kept
+    """
+
+    purge_interval = 1000
+
+    def __init__(self, path: str, window: float = 86400):
+        self.path = path
+        self.window = window
+        self._lock = threading.Lock()
+        self._adds = 0
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            " message_id TEXT PRIMARY KEY,"
+            " added REAL NOT NULL)"
+        )
+
+    def seen(self, message_id: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM seen WHERE message_id = ? AND added >= ?",
+                (message_id, time.time() - self.window),
+            ).fetchone()
+        return row is not None
+
+    def add(self, message_id: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO seen (message_id, added) VALUES (?, ?)",
+                (message_id, time.time()),
+            )
+            self._adds += 1
+            if self._adds % self.purge_interval == 0:
+                self._db.execute(
+                    "DELETE FROM seen WHERE added < ?", (time.time() - self.window,)
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
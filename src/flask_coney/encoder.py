@@ -10,3 +10,41 @@ class UUIDEncoder(json.JSONEncoder):
             # if the obj is uuid, we simply return the value of uuid
             return str(obj)
         return json.JSONEncoder.default(self, obj)
+
+
+class Codec:
+    """Encodes message bodies of one content type for a :class:`Publisher`.
+
+    Subclass it for other formats, only :attr:`content_type` and
+    :meth:`encode` have to be implemented.
+    """
+
+    content_type = "application/octet-stream"
+
+    def encode(self, body) -> bytes:
+        """Encodes a body
+
+        :param body: The body
+        """
+        return body
+
+
+class JSONCodec(Codec):
+    """Encodes dicts and lists as JSON, supporting UUIDs"""
+
+    content_type = "application/json"
+
+    def __init__(self):
+        self._encoder = UUIDEncoder(separators=(",", ":"))
+
+    def encode(self, body) -> bytes:
+        return self._encoder.encode(body).encode()
+
+
+class TextCodec(Codec):
+    """Encodes strings as UTF-8"""
+
+    content_type = "text/plain"
+
+    def encode(self, body: str) -> bytes:
+        return body.encode()
@@ -4,3 +4,15 @@ class ExchangeTypeError(Exception):
 
 class SyncTimeoutError(Exception):
     pass
+
+
+class CircuitOpenError(SyncTimeoutError):
+    pass
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class PublishBlockedError(Exception):
+    pass
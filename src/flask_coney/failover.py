@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+from typing import Callable
+from typing import List
+from typing import Union
+
+import pika
+
+from .metrics import Metrics
+from .utils import logger
+
+
+class BrokerPool:
+    """Picks the node of a cluster to connect to.
+
+    A node whose connection failed is skipped for a backoff, which doubles
+    with every consecutive failure and is jittered, so the clients of a dead
+    node do not reconnect in lockstep. Connections fail over to the next
+    healthy node without waiting. Only if every node backs off, the one whose
+    backoff ends first is picked.
+
+    The node which connected last is preferred, so the connections of a
+    process stay on one node while it is healthy.
+
+    :param uris: The URIs of the nodes, in order of preference
+    :param base_delay: Seconds a node is skipped after its first failure
+    :param max_delay: Upper bound of the backoff in seconds
+    :param metrics: Metrics to count the failures and failovers in
+    :param clock: Returns the current time in seconds
+    """
+
+    def __init__(
+        self,
+        uris: Union[str, List[str]],
+        base_delay: float = 0.1,
+        max_delay: float = 30,
+        metrics: Metrics = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if isinstance(uris, str):
+            uris = [uris]
+        if not uris:
+            raise ValueError("At least one broker URI is needed")
+        self.uris = list(uris)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._metrics = metrics or Metrics()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = dict.fromkeys(self.uris, 0)
+        self._retry_at = dict.fromkeys(self.uris, 0.0)
+        self._current = self.uris[0]
+
+    @property
+    def current(self) -> str:
+        """URI of the node which connected last"""
+        return self._current
+
+    def is_healthy(self, uri: str) -> bool:
+        """Returns whether the node is not backing off"""
+        return self._retry_at[uri] <= self._clock()
+
+    def select(self) -> str:
+        """Returns the URI of the node to connect to next"""
+        return self.candidates()[0]
+
+    def candidates(self) -> List[str]:
+        """Returns the URIs in the order they should be tried: the healthy
+        nodes, starting with the current one, then the nodes backing off,
+        starting with the one whose backoff ends first"""
+        with self._lock:
+            ordered = [self._current]
+            ordered.extend(uri for uri in self.uris if uri != self._current)
+            healthy = [uri for uri in ordered if self.is_healthy(uri)]
+            backing_off = sorted(
+                (uri for uri in ordered if uri not in healthy),
+                key=self._retry_at.__getitem__,
+            )
+        return healthy + backing_off
+
+    def delay(self, uri: str) -> float:
+        """Returns the seconds until the backoff of the node ends"""
+        return max(0.0, self._retry_at[uri] - self._clock())
+
+    def record_success(self, uri: str):
+        with self._lock:
+            if uri != self._current:
+                logger.info("Failed over to broker %s", uri)
+                self._metrics.incr("broker.failover")
+                self._current = uri
+            self._failures[uri] = 0
+            self._retry_at[uri] = 0.0
+
+    def record_failure(self, uri: str):
+        with self._lock:
+            self._failures[uri] += 1
+            failures = self._failures[uri]
+            backoff = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+            # at least half of the backoff, so a flapping node is not hammered
+            backoff = random.uniform(backoff / 2, backoff)
+            self._retry_at[uri] = self._clock() + backoff
+        self._metrics.incr("broker.failures")
+        logger.warning(
+            "Broker %s failed %d times, skipping it for %.2f seconds",
+            uri,
+            failures,
+            backoff,
+        )
+
+    def connect(
+        self, blocked_connection_timeout: float = None
+    ) -> pika.BlockingConnection:
+        """Opens a blocking connection, trying each node once in the order
+        of :meth:`candidates`
+
+        :param blocked_connection_timeout: see :meth:`Coney.connection`
+        :raises:
+            pika.exceptions.AMQPConnectionError: if no node could be reached
+        """
+        errors: List[Exception] = []
+        for uri in self.candidates():
+            params = pika.URLParameters(uri)
+            if blocked_connection_timeout is not None:
+                params.blocked_connection_timeout = blocked_connection_timeout
+            try:
+                connection = pika.BlockingConnection(params)
+            except pika.exceptions.AMQPConnectionError as e:
+                self.record_failure(uri)
+                errors.append(e)
+                continue
+            self.record_success(uri)
+            return connection
+        raise errors[-1]
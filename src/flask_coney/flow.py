@@ -0,0 +1,72 @@
+import threading
+import time
+
+from .metrics import Metrics
+from .utils import logger
+
+
+class FlowControl:
+    """Tracks whether the broker is blocking publishers.
+
+    RabbitMQ sends ``connection.blocked`` when a memory or disk alarm is
+    raised and ``connection.unblocked`` once it is cleared. While blocked,
+    publishing fails fast instead of hanging. Every ``probe_interval``
+    seconds a single publish is let through to find out if the alarm is
+    gone.
+
+    :param probe_interval: Seconds between two probes while blocked
+    :param metrics: Metrics to record the blocked time in
+    """
+
+    def __init__(self, probe_interval: float = 1.0, metrics: Metrics = None):
+        self.probe_interval = probe_interval
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._blocked_since = None
+        self._last_probe = 0.0
+
+    @property
+    def is_blocked(self) -> bool:
+        return self._blocked_since is not None
+
+    @property
+    def blocked_for(self) -> float:
+        """Seconds the broker has been blocking publishers"""
+        blocked_since = self._blocked_since
+        if blocked_since is None:
+            return 0.0
+        return time.monotonic() - blocked_since
+
+    def watch(self, connection):
+        """Registers the blocked and unblocked callbacks on a connection
+
+        :param connection: A :class:`pika.BlockingConnection`
+        """
+        connection.add_on_connection_blocked_callback(self.on_blocked)
+        connection.add_on_connection_unblocked_callback(self.on_unblocked)
+
+    def on_blocked(self, _unused_connection=None, method_frame=None):
+        with self._lock:
+            if self._blocked_since is None:
+                logger.warning("Broker is blocking publishers: %r", method_frame)
+                self._blocked_since = time.monotonic()
+                self._last_probe = self._blocked_since
+                self._metrics.set("flow.blocked", 1)
+
+    def on_unblocked(self, _unused_connection=None, _unused_frame=None):
+        with self._lock:
+            if self._blocked_since is not None:
+                logger.info("Broker stopped blocking publishers")
+                blocked_for = time.monotonic() - self._blocked_since
+                self._blocked_since = None
+                self._metrics.incr("flow.blocked_seconds", blocked_for)
+                self._metrics.set("flow.blocked", 0)
+
+    def should_probe(self) -> bool:
+        """Returns True at most once per probe_interval while blocked"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_probe >= self.probe_interval:
+                self._last_probe = now
+                return True
+            return False
@@ -0,0 +1,47 @@
+CACHE_TTL_HEADER = "x-cache-ttl"
+"""Seconds a client may cache the reply, see :meth:`Coney.reply_sync`"""
+
+DEADLINE_HEADER = "x-deadline"
+"""Unix timestamp after which nobody waits for the reply anymore"""
+
+STREAM_SEQ_HEADER = "x-stream-seq"
+"""Position of a chunk sent by :meth:`Coney.reply_stream`"""
+
+STREAM_END_HEADER = "x-stream-end"
+"""Marks the message ending a stream sent by :meth:`Coney.reply_stream`"""
+
+CHUNK_ID_HEADER = "x-chunk-id"
+"""Id shared by all chunks of a message split by ``CONEY_MAX_FRAME_BYTES``"""
+
+CHUNK_INDEX_HEADER = "x-chunk-index"
+"""Position of a chunk"""
+
+CHUNK_COUNT_HEADER = "x-chunk-count"
+"""Number of chunks of the message"""
+
+CLAIM_CHECK_HEADER = "x-claim-check"
+"""Key of the payload in the blob store, see ``CONEY_CLAIM_CHECK_THRESHOLD``"""
+
+RETRY_COUNT_HEADER = "x-retry-count"
+"""Number of times a failed message was retried, see :meth:`Coney.queue`"""
+
+DELAY_UNTIL_HEADER = "x-delay-until"
+"""Unix timestamp a message of :meth:`Coney.publish_at` is due"""
+
+DELAY_EXCHANGE_HEADER = "x-delay-exchange"
+"""Exchange a delayed message is published to once it is due"""
+
+DELAY_ROUTING_KEY_HEADER = "x-delay-routing-key"
+"""Routing key a delayed message is published with once it is due"""
+
+TRACE_ID_HEADER = "x-trace-id"
+"""Id shared by all messages of a trace, see ``CONEY_SPAN_EXPORTER``"""
+
+PARENT_SPAN_HEADER = "x-parent-span-id"
+"""Id of the span which published the message"""
+
+PUBLISHED_AT_HEADER = "x-published-at-ns"
+"""Unix timestamp in nanoseconds the message was published at"""
+
+RECEIVED_AT_HEADER = "x-received-at-ns"
+"""Unix timestamp in nanoseconds the request of a reply was received at"""
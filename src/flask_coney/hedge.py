@@ -0,0 +1,32 @@
+import threading
+
+
+class HedgeBudget:
+    """Limits the share of requests which may be hedged.
+
+    Every request adds ``ratio`` tokens to the budget, every hedged request
+    takes one token. With a ratio of 0.1 at most one in ten requests will be
+    sent twice, so hedging can not double the load on a slow server.
+
+    :param ratio: Share of requests which may be hedged
+    :param burst: Maximum number of tokens saved up
+    """
+
+    def __init__(self, ratio: float = 0.1, burst: float = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+
+    def deposit(self):
+        """Records a request, which may be hedged"""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        """Takes a token, if one is available"""
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
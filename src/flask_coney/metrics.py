@@ -0,0 +1,85 @@
+import threading
+from collections import deque
+from typing import Deque
+from typing import Dict
+from typing import Optional
+
+
+class Metrics:
+    """Thread-safe store for the counters and gauges Coney records.
+
+    Counters are increased with :meth:`incr`, gauges are overwritten with
+    :meth:`set`. Use :meth:`snapshot` to get a copy of all values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def incr(self, name: str, value: float = 1):
+        """Increases the counter ``name`` by ``value``
+
+        :param name: Name of the counter
+        :param value: Amount to add
+        """
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        """Sets the gauge ``name`` to ``value``
+
+        :param name: Name of the gauge
+        :param value: The current value
+        """
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name: str, default: float = 0) -> float:
+        """Returns the current value of a counter or gauge"""
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of all counters and gauges"""
+        with self._lock:
+            return dict(self._values)
+
+
+class LatencyTracker:
+    """Keeps a sliding window of latencies per key to derive percentiles.
+
+    :param window: Number of samples kept per key
+    :param min_samples: Samples needed before a percentile is reported
+    """
+
+    def __init__(self, window: int = 1000, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, key: str, seconds: float):
+        """Records a latency
+
+        :param key: E.g. the routing key
+        :param seconds: The observed latency
+        """
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key: str, percentile: float) -> Optional[float]:
+        """Returns the percentile of the recorded latencies or None if there
+        are not enough samples yet
+
+        :param key: E.g. the routing key
+        :param percentile: A value between 0 and 100
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
@@ -0,0 +1,332 @@
+import cProfile
+import functools
+import glob
+import inspect
+import io
+import itertools
+import json
+import marshal
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from .metrics import Metrics
+from .utils import logger
+
+MEMORY_FRAMES = 16
+"""Frames tracemalloc keeps per allocation, the handler has to be among
+them for the allocation to be counted"""
+
+
+class HandlerProfiler:
+    """Profiles the handlers of the consumers.
+
+    Every ``sample_rate``-th message of a queue is handled under
+    :mod:`cProfile` and, with ``memory``, :mod:`tracemalloc`. The results are
+    aggregated per queue. Handlers slower than ``slow_threshold`` seconds are
+    logged with the message properties and, if the call was sampled, its top
+    functions.
+
+    Only one handler is profiled at a time, a sample is skipped while another
+    one is running. The memory profile only counts allocations whose
+    innermost ``MEMORY_FRAMES`` frames run code of the file of the handler.
+    Other consumer threads running handlers of the same file are counted
+    too, so profile the memory of a queue with a single consumer thread.
+
+    With a ``directory``, a background thread writes the profiles every
+    ``dump_interval`` seconds if new samples were taken, so handlers never
+    wait for the disk.
+
+    :param sample_rate: Profile one in that many messages, None to only log
+        slow messages
+    :param cpu: Profile with cProfile
+    :param memory: Trace the memory allocations with tracemalloc
+    :param slow_threshold: Seconds after which a handler call is logged
+    :param top: Number of functions or lines logged and reported
+    :param directory: Directory the aggregated profiles are written to
+    :param dump_interval: Seconds between two writes to the directory
+    :param metrics: Metrics to count the profiled and slow messages in
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = None,
+        cpu: bool = True,
+        memory: bool = False,
+        slow_threshold: float = None,
+        top: int = 10,
+        directory: str = None,
+        dump_interval: float = 10,
+        metrics: Metrics = None,
+    ):
+        self.sample_rate = sample_rate
+        self.cpu = cpu
+        self.memory = memory
+        self.slow_threshold = slow_threshold
+        self.top = top
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        self._counters: Dict[str, Iterator[int]] = {}
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._allocations: Dict[str, Dict[str, int]] = {}
+        self._samples: Dict[str, int] = {}
+        self._dirty = False
+        self._dumper: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def call(self, queue: str, func: Callable, *args):
+        """Calls the handler of a queue, profiling it if it is sampled
+
+        :param queue: Name of the queue
+        :param func: The handler
+        :param args: The arguments of the handler
+        """
+        profile = None
+        snapshot = None
+        tracing = False
+        if self._is_sampled(queue) and self._profiling.acquire(blocking=False):
+            try:
+                if self.memory:
+                    # tracing slows down every allocation, so it only runs
+                    # while a sample is taken
+                    tracing = not tracemalloc.is_tracing()
+                    if tracing:
+                        tracemalloc.start(MEMORY_FRAMES)
+                    snapshot = filter_handler_traces(tracemalloc.take_snapshot(), func)
+                if self.cpu:
+                    profile = cProfile.Profile()
+                    profile.enable()
+            except BaseException:
+                self._profiling.release()
+                raise
+
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            duration = time.perf_counter() - start
+            if profile is not None or snapshot is not None:
+                try:
+                    self._record(queue, func, profile, snapshot)
+                finally:
+                    if tracing:
+                        tracemalloc.stop()
+                    self._profiling.release()
+            if self.slow_threshold is not None and duration >= self.slow_threshold:
+                self._log_slow(queue, duration, args, profile)
+
+    def report(self, queue: str = None, sort: str = "cumulative") -> str:
+        """Returns the aggregated profiles as text
+
+        :param queue: Only report this queue
+        :param sort: Sort key of :meth:`pstats.Stats.sort_stats`
+        """
+        with self._lock:
+            queues = sorted(set(self._stats) | set(self._allocations))
+            lines = []
+            for name in queues:
+                if queue is not None and name != queue:
+                    continue
+                lines.append(f"Queue {name}: {self._samples.get(name, 0)} samples")
+                if name in self._stats:
+                    lines.append(format_stats(self._stats[name], sort, self.top))
+                if name in self._allocations:
+                    lines.extend(format_allocations(self._allocations[name], self.top))
+        return "\n".join(lines)
+
+    def reset(self):
+        """Drops the aggregated profiles"""
+        with self._lock:
+            self._stats.clear()
+            self._allocations.clear()
+            self._samples.clear()
+
+    def dump(self, directory: str):
+        """Writes the aggregated profiles to ``<queue>.<pid>.prof`` and
+        ``<queue>.<pid>.mem.json`` files, which are read by
+        :func:`load_profiles`
+
+        :param directory: The directory
+        """
+        # copied under the lock, written without blocking the handlers
+        with self._lock:
+            self._dirty = False
+            stats: Dict[str, dict] = {}
+            for queue, profile_stats in self._stats.items():
+                raw = profile_stats.stats  # type: ignore[attr-defined]
+                stats[queue] = {
+                    func: (cc, nc, tt, ct, dict(callers))
+                    for func, (cc, nc, tt, ct, callers) in raw.items()
+                }
+            allocations = {
+                queue: dict(lines) for queue, lines in self._allocations.items()
+            }
+
+        os.makedirs(directory, exist_ok=True)
+        pid = os.getpid()
+        for queue, queue_stats in stats.items():
+            path = os.path.join(directory, f"{queue}.{pid}.prof")
+            with open(path + ".tmp", "wb") as f:
+                marshal.dump(queue_stats, f)
+            os.replace(path + ".tmp", path)
+        for queue, lines in allocations.items():
+            path = os.path.join(directory, f"{queue}.{pid}.mem.json")
+            with open(path + ".tmp", "w") as f:
+                json.dump(lines, f)
+            os.replace(path + ".tmp", path)
+
+    def flush(self):
+        """Writes the profiles to the directory now, if new samples were
+        taken"""
+        if self.directory is None or not self._dirty:
+            return
+        try:
+            self.dump(self.directory)
+        except OSError as e:
+            logger.warning("Writing profiles to %s failed: %s", self.directory, e)
+
+    def stop(self):
+        """Stops the background thread and writes the last samples"""
+        self._stopped.set()
+        with self._lock:
+            dumper, self._dumper = self._dumper, None
+        if dumper is not None:
+            dumper.join()
+        self.flush()
+
+    def run(self):
+        while not self._stopped.wait(self.dump_interval):
+            self.flush()
+
+    def _is_sampled(self, queue: str) -> bool:
+        if not self.sample_rate or not (self.cpu or self.memory):
+            return False
+        with self._lock:
+            counter = self._counters.get(queue)
+            if counter is None:
+                counter = self._counters[queue] = itertools.count()
+        return next(counter) % self.sample_rate == 0
+
+    def _record(
+        self,
+        queue: str,
+        func: Callable,
+        profile: cProfile.Profile = None,
+        snapshot: tracemalloc.Snapshot = None,
+    ):
+        if profile is not None:
+            profile.disable()
+        if snapshot is not None:
+            after = filter_handler_traces(tracemalloc.take_snapshot(), func)
+            diff = after.compare_to(snapshot, "lineno")
+
+        with self._lock:
+            self._dirty = True
+            if self.directory is not None and self._dumper is None:
+                self._stopped.clear()
+                self._dumper = threading.Thread(target=self.run, daemon=True)
+                self._dumper.start()
+            self._samples[queue] = self._samples.get(queue, 0) + 1
+            if profile is not None:
+                stats = self._stats.get(queue)
+                if stats is None:
+                    self._stats[queue] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            if snapshot is not None:
+                allocations = self._allocations.setdefault(queue, {})
+                for stat in diff:
+                    if stat.size_diff > 0:
+                        line = str(stat.traceback)
+                        allocations[line] = allocations.get(line, 0) + stat.size_diff
+        self._metrics.incr("consumer.profiled")
+
+    def _log_slow(
+        self,
+        queue: str,
+        duration: float,
+        args: tuple,
+        profile: Optional[cProfile.Profile],
+    ):
+        self._metrics.incr("consumer.slow")
+        properties = args[2] if len(args) > 2 else None
+        message = "Handling a message of %s took %.3f seconds, properties: %r"
+        if profile is None:
+            logger.warning(message, queue, duration, properties)
+        else:
+            logger.warning(
+                message + "\n%s",
+                queue,
+                duration,
+                properties,
+                format_stats(pstats.Stats(profile), "cumulative", self.top),
+            )
+
+
+def filter_handler_traces(
+    snapshot: tracemalloc.Snapshot, func: Callable
+) -> tracemalloc.Snapshot:
+    """Keeps the allocations of a snapshot made by code of the file the
+    handler is defined in, which excludes those of other threads. Handlers
+    without code, e.g. callable objects, keep all allocations.
+    """
+    func = inspect.unwrap(func)
+    while isinstance(func, functools.partial):
+        func = inspect.unwrap(func.func)
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return snapshot
+    return snapshot.filter_traces(
+        [tracemalloc.Filter(True, code.co_filename, all_frames=True)]
+    )
+
+
+def format_stats(stats: pstats.Stats, sort: str, top: int) -> str:
+    """Returns the top functions of profile stats as text"""
+    stream = io.StringIO()
+    stats.stream = stream  # type: ignore[attr-defined]
+    stats.sort_stats(sort).print_stats(top)
+    return stream.getvalue()
+
+
+def format_allocations(allocations: Dict[str, int], top: int) -> List[str]:
+    """Returns the lines which allocated the most memory"""
+    ranked = sorted(allocations.items(), key=lambda item: item[1], reverse=True)
+    return [f"{size / 1024:10.1f} KiB  {line}" for line, size in ranked[:top]]
+
+
+def load_profiles(directory: str) -> Dict[str, tuple]:
+    """Merges the profiles written by :meth:`HandlerProfiler.dump` of all
+    processes
+
+    :param directory: The directory
+    :returns: A dict mapping the queue names to the tuple of their
+        :class:`pstats.Stats` or None and their allocations per line
+    """
+    profiles: Dict[str, tuple] = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.prof"))):
+        queue = os.path.basename(path).rsplit(".", 2)[0]
+        stats, allocations = profiles.get(queue, (None, {}))
+        if stats is None:
+            stats = pstats.Stats(path)
+        else:
+            stats.add(path)
+        profiles[queue] = (stats, allocations)
+    for path in sorted(glob.glob(os.path.join(directory, "*.mem.json"))):
+        queue = os.path.basename(path).rsplit(".", 3)[0]
+        stats, allocations = profiles.get(queue, (None, {}))
+        with open(path) as f:
+            for line, size in json.load(f).items():
+                allocations[line] = allocations.get(line, 0) + size
+        profiles[queue] = (stats, allocations)
+    return profiles
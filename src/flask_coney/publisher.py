@@ -0,0 +1,171 @@
+import threading
+import uuid
+import weakref
+
+import pika
+
+from .encoder import Codec
+from .encoder import JSONCodec
+
+
+class Publisher:
+    """Publishes messages of the same shape to a fixed exchange and routing
+    key. Created by :meth:`Coney.publisher`.
+
+    The properties are built once and every thread keeps its own connection
+    and channel open, so :meth:`send` only encodes the body and publishes it.
+    :meth:`close` closes the connections of all threads.
+
+    Messages the fast path can not send, because they have to be chunked,
+    claim-checked or spooled, or because the broker blocks publishers, are
+    handed to :meth:`Coney.publish`.
+
+    :param coney: The Coney instance
+    :param app: A flask app
+    :param exchange_name: The exchange
+    :param routing_key: The routing key
+    :param properties: see :py:class:`pika.spec.BasicProperties`
+    :param codec: Encodes the bodies, defaults to :class:`JSONCodec`
+    """
+
+    def __init__(
+        self,
+        coney,
+        app,
+        exchange_name: str = "",
+        routing_key: str = "",
+        properties: dict = None,
+        codec: Codec = None,
+    ):
+        self.coney = coney
+        self.app = app
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.codec = codec or JSONCodec()
+        self.properties = {
+            **(properties or {}),
+            "content_type": self.codec.content_type,
+        }
+
+        state = app.extensions["coney"]
+        self._flow = state.flow
+        self._spool = state.spool
+        self._tracer = state.tracer
+        self._max_bytes = min(
+            (
+                limit
+                for limit in (
+                    app.config.get("CONEY_MAX_FRAME_BYTES"),
+                    app.config.get("CONEY_CLAIM_CHECK_THRESHOLD"),
+                )
+                if limit is not None
+            ),
+            default=None,
+        )
+        self._set_message_id = "message_id" not in self.properties
+        self._local = threading.local()
+        # the connection of a finished thread goes away with its thread-local
+        # storage, the others are closed by close()
+        self._connections: weakref.WeakSet = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def send(self, body, properties: dict = None):
+        """Encodes and publishes a message
+
+        :param body: The body, as accepted by the codec
+        :param properties: Properties overriding the bound ones for this
+            message, its properties frame is then built for this call only
+        :raises:
+            SpoolFullError: if the broker is unavailable and the spool is full
+            PublishBlockedError: if the broker blocks publishers and no
+                fallback is configured
+        """
+        body = self.codec.encode(body)
+        if properties is not None:
+            properties = {**self.properties, **properties}
+        if (
+            (self._max_bytes is not None and len(body) > self._max_bytes)
+            or self._flow.is_blocked
+            or (self._spool is not None and len(self._spool))
+        ):
+            self._publish_slow(body, properties)
+            return
+
+        local = self._local
+        channel = getattr(local, "channel", None)
+        frame = None
+        try:
+            if channel is None:
+                channel = self._open(local)
+            if properties is None:
+                frame = local.properties
+                headers = self.properties.get("headers")
+            else:
+                frame = pika.BasicProperties(**properties)
+                headers = properties.get("headers")
+            if self._set_message_id and (properties is None or not frame.message_id):
+                frame.message_id = uuid.uuid4().hex
+            if self._tracer is not None:
+                frame.headers = self._tracer.inject(headers)
+            channel.basic_publish(self.exchange_name, self.routing_key, body, frame)
+        except pika.exceptions.AMQPError:
+            self._close_local()
+            # keep the message id, so consumers with dedup skip the message if
+            # it reached the broker before the connection failed
+            if frame is not None and frame.message_id:
+                properties = {**(properties or {}), "message_id": frame.message_id}
+            self._publish_slow(body, properties)
+
+    def close(self):
+        """Closes the connections of all threads. Call it once no thread sends
+        anymore, e.g. when the app shuts down, as pika connections are not
+        thread-safe. A later :meth:`send` opens a new connection.
+        """
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        self._local.connection = self._local.channel = None
+        for connection in connections:
+            self._close_connection(connection)
+
+    def _close_local(self):
+        local = self._local
+        connection = getattr(local, "connection", None)
+        local.connection = local.channel = None
+        if connection is not None:
+            with self._lock:
+                self._connections.discard(connection)
+            self._close_connection(connection)
+
+    def _close_connection(self, connection: pika.BlockingConnection):
+        if connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+    def _open(self, local: threading.local) -> pika.channel.Channel:
+        deadline = self.app.config.get("CONEY_PUBLISH_DEADLINE")
+        if deadline is None:
+            deadline = self.app.config.get("CONEY_BLOCKED_CONNECTION_TIMEOUT")
+        local.connection = self.coney._shared_connection(
+            self.app, blocked_connection_timeout=deadline
+        )
+        with self._lock:
+            self._connections.add(local.connection)
+        local.channel = local.connection.channel()
+        # the frame is reused for every message of the thread, only the
+        # message id and the trace headers change
+        local.properties = pika.BasicProperties(**self.properties)
+        return local.channel
+
+    def _publish_slow(self, body: bytes, properties: dict = None):
+        # Coney.publish stamps the trace headers itself
+        properties = {**self.properties, **(properties or {})}
+        self.coney.publish(
+            body,
+            exchange_name=self.exchange_name,
+            routing_key=self.routing_key,
+            properties=properties,
+            app=self.app,
+        )
@@ -0,0 +1,293 @@
+import collections
+import json
+import struct
+import time
+import uuid
+from typing import BinaryIO
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+
+import pika
+
+from .headers import DEADLINE_HEADER
+from .headers import PARENT_SPAN_HEADER
+from .headers import PUBLISHED_AT_HEADER
+from .headers import RECEIVED_AT_HEADER
+from .headers import TRACE_ID_HEADER
+from .utils import logger
+
+MAGIC = b"CONEYREC\x01"
+"""Starts every recording, the last byte is the format version"""
+
+_RECORD = struct.Struct("<dBBII")
+
+Record = collections.namedtuple(
+    "Record", ["offset", "exchange", "routing_key", "properties", "body", "timestamp"]
+)
+"""A recorded delivery. ``offset`` are the seconds since the first record,
+``timestamp`` is the unix time of the delivery."""
+
+_TRACE_HEADERS = (
+    TRACE_ID_HEADER,
+    PARENT_SPAN_HEADER,
+    PUBLISHED_AT_HEADER,
+    RECEIVED_AT_HEADER,
+)
+
+
+def properties_to_dict(properties: pika.spec.BasicProperties) -> dict:
+    """Returns the properties which are set as dict"""
+    return {k: v for k, v in vars(properties).items() if v is not None}
+
+
+class RecordWriter:
+    """Appends deliveries to a recording.
+
+    Each record is a fixed size header with the unix timestamp and the sizes
+    of the exchange, routing key, properties (JSON) and body, followed by
+    those. Records are only appended, so several sessions can be recorded
+    into one file.
+
+    :param path: Path of the recording
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a+b")
+        self._file.seek(0)
+        if not self._file.read(1):
+            self._file.write(MAGIC)
+            return
+
+        # drop a record cut off by a killed recorder, so the next record
+        # starts at a record boundary
+        self._file.seek(0)
+        _check_magic(self._file)
+        end = self._file.tell()
+        while _read_record(self._file) is not None:
+            end = self._file.tell()
+        self._file.truncate(end)
+
+    def __enter__(self) -> "RecordWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(
+        self,
+        exchange: str,
+        routing_key: str,
+        properties: dict,
+        body: bytes,
+        timestamp: float = None,
+    ):
+        """Appends a delivery
+
+        :param exchange: The exchange the message was published to
+        :param routing_key: The routing key
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :param body: The body
+        :param timestamp: Unix timestamp of the delivery, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        encoded_exchange = exchange.encode()
+        encoded_routing_key = routing_key.encode()
+        encoded_properties = json.dumps(
+            properties, separators=(",", ":"), default=str
+        ).encode()
+        self._file.write(
+            _RECORD.pack(
+                timestamp,
+                len(encoded_exchange),
+                len(encoded_routing_key),
+                len(encoded_properties),
+                len(body),
+            )
+            + encoded_exchange
+            + encoded_routing_key
+            + encoded_properties
+            + body
+        )
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _check_magic(f: BinaryIO):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{f.name} is not a Coney recording")
+
+
+def read_records(path: str) -> Iterator[Record]:
+    """Yields the records of a recording. A record cut off at the end of the
+    file, e.g. because the recorder was killed, is skipped.
+
+    :param path: Path of the recording
+    :raises:
+        ValueError: if the file is not a recording
+    """
+    with open(path, "rb") as f:
+        _check_magic(f)
+        first = None
+        while True:
+            record = _read_record(f)
+            if record is None:
+                return
+            timestamp, exchange, routing_key, properties, body = record
+            if first is None:
+                first = timestamp
+            yield Record(
+                timestamp - first, exchange, routing_key, properties, body, timestamp
+            )
+
+
+def _read_record(f: BinaryIO):
+    header = f.read(_RECORD.size)
+    if len(header) < _RECORD.size:
+        return None
+    timestamp, *sizes = _RECORD.unpack(header)
+    data = f.read(sum(sizes))
+    if len(data) < sum(sizes):
+        logger.warning("Skipping truncated record at the end of %s", f.name)
+        return None
+
+    fields = []
+    start = 0
+    for size in sizes:
+        fields.append(data[start : start + size])
+        start += size
+    exchange, routing_key, properties, body = fields
+    return (
+        timestamp,
+        exchange.decode(),
+        routing_key.decode(),
+        json.loads(properties),
+        body,
+    )
+
+
+def record(
+    channel: pika.adapters.blocking_connection.BlockingChannel,
+    queue: str,
+    writer: RecordWriter,
+    limit: int = None,
+    duration: float = None,
+) -> int:
+    """Consumes the messages of a queue into a recording
+
+    :param channel: The channel to consume with
+    :param queue: Name of the queue
+    :param writer: The recording
+    :param limit: Stop after that many messages
+    :param duration: Stop after that many seconds
+    :returns: The number of recorded messages
+    """
+    count = 0
+    end = time.monotonic() + duration if duration is not None else None
+    try:
+        for method, properties, body in channel.consume(
+            queue, auto_ack=True, inactivity_timeout=1
+        ):
+            if method is not None:
+                writer.write(
+                    method.exchange,
+                    method.routing_key,
+                    properties_to_dict(properties),
+                    body,
+                )
+                count += 1
+            if limit is not None and count >= limit:
+                break
+            if end is not None and time.monotonic() >= end:
+                break
+    finally:
+        writer.flush()
+        channel.cancel()
+    return count
+
+
+def replay(
+    records: Iterable[Record],
+    send: Callable[[Record], None],
+    speed: float = 1,
+    clock: Callable[[], float] = time.monotonic,
+    sleep: Callable[[float], None] = time.sleep,
+) -> int:
+    """Sends records at their original pace, multiplied by speed
+
+    :param records: The records
+    :param send: Publishes a record
+    :param speed: 2 replays twice as fast, 0 as fast as possible
+    :returns: The number of sent records
+    """
+    start = clock()
+    count = 0
+    for item in records:
+        if speed:
+            wait = start + item.offset / speed - clock()
+            if wait > 0:
+                sleep(wait)
+        send(item)
+        count += 1
+    return count
+
+
+def replay_properties(
+    item: Record,
+    now: float = None,
+    keep_reply_to: bool = False,
+    keep_message_id: bool = False,
+) -> dict:
+    """Returns the properties to replay a record with.
+
+    The deadline keeps the time that was left at the delivery, the trace
+    headers are dropped, so the replay starts new traces, and ``reply_to``
+    is dropped unless kept, as nobody waits for the replies anymore. The
+    ``expiration`` is relative to the publish and kept.
+
+    A recorded ``message_id`` is replaced by a new one unless kept, as the
+    dedup filters of the consumers would skip a message replayed twice.
+
+    :param item: The record
+    :param now: Unix time of the replay, defaults to now
+    :param keep_reply_to: Keep the ``reply_to`` property
+    :param keep_message_id: Keep the ``message_id`` property
+    """
+    if now is None:
+        now = time.time()
+    properties = dict(item.properties)
+    headers = {
+        key: value
+        for key, value in (properties.get("headers") or {}).items()
+        if key not in _TRACE_HEADERS
+    }
+    if DEADLINE_HEADER in headers:
+        headers[DEADLINE_HEADER] = (
+            float(headers[DEADLINE_HEADER]) - item.timestamp + now
+        )
+    if headers:
+        properties["headers"] = headers
+    else:
+        properties.pop("headers", None)
+    if not keep_reply_to:
+        properties.pop("reply_to", None)
+    if not keep_message_id and "message_id" in properties:
+        properties["message_id"] = uuid.uuid4().hex
+    return properties
+
+
+def parse_speed(value: str) -> float:
+    """Parses a speed like ``10x`` or ``0.5``"""
+    value = value.strip().lower()
+    if value.endswith("x"):
+        value = value[:-1]
+    speed = float(value)
+    if speed < 0:
+        raise ValueError("The speed must not be negative")
+    return speed
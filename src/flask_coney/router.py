@@ -0,0 +1,132 @@
+import itertools
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import pika
+
+from .utils import logger
+
+
+class _Node:
+    __slots__ = ("children", "values", "is_hash")
+
+    def __init__(self, is_hash: bool = False):
+        self.children: Dict[str, "_Node"] = {}
+        self.values: List[Tuple[int, Any]] = []
+        self.is_hash = is_hash
+
+
+class TopicTrie:
+    """Matches routing keys against AMQP topic patterns.
+
+    The words of a pattern are separated by dots. ``*`` matches exactly one
+    word and ``#`` matches zero or more words. The patterns are compiled into
+    a trie, so a routing key is matched by walking the trie once word by word
+    instead of testing every pattern.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def add(self, pattern: str, value):
+        """Adds a pattern
+
+        :param pattern: E.g. ``orders.*.created``
+        :param value: Returned by :meth:`match` for matching routing keys
+        """
+        with self._lock:
+            node = self._root
+            for word in pattern.split("."):
+                child = node.children.get(word)
+                if child is None:
+                    child = node.children[word] = _Node(is_hash=word == "#")
+                node = child
+            node.values.append((next(self._counter), value))
+
+    def match(self, routing_key: str) -> List:
+        """Returns the values of all patterns matching the routing key in the
+        order they were added
+
+        :param routing_key: E.g. ``orders.eu.created``
+        """
+        nodes = self._closure([self._root])
+        for word in routing_key.split("."):
+            next_nodes = []
+            for node in nodes:
+                for key in (word, "*"):
+                    child = node.children.get(key)
+                    if child is not None:
+                        next_nodes.append(child)
+                if node.is_hash:
+                    # "#" consumes the word and stays active
+                    next_nodes.append(node)
+            if not next_nodes:
+                return []
+            nodes = self._closure(next_nodes)
+
+        return [value for _, value in sorted(v for n in nodes for v in n.values)]
+
+    def _closure(self, nodes: List[_Node]) -> List[_Node]:
+        # "#" also matches zero words, so its node is active right away.
+        # Nodes are deduplicated by identity, keeping their order.
+        active = {}
+        stack = list(reversed(nodes))
+        while stack:
+            node = stack.pop()
+            if id(node) in active:
+                continue
+            active[id(node)] = node
+            child = node.children.get("#")
+            if child is not None:
+                stack.append(child)
+        return list(active.values())
+
+
+class Router:
+    """Dispatches the messages of one queue to the handlers registered for
+    matching routing keys with :meth:`Coney.handler`.
+    """
+
+    def __init__(self):
+        self.trie = TopicTrie()
+
+    def add(self, routing_key: str, func: Callable):
+        """Registers a handler
+
+        :param routing_key: A topic pattern
+        :param func: The handler, called like a :meth:`Coney.queue` function
+        """
+        self.trie.add(routing_key, func)
+
+    def dispatch(
+        self,
+        ch: pika.channel.Channel,
+        method: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body,
+    ):
+        """Calls every handler matching the routing key of the message. A
+        failing handler does not prevent the others from running, the first
+        error is raised after all handlers ran.
+        """
+        handlers = self.trie.match(method.routing_key)
+        if not handlers:
+            logger.warning("No handler for routing key %s", method.routing_key)
+        error = None
+        for func in handlers:
+            try:
+                func(ch, method, properties, body)
+            except Exception as e:
+                logger.exception(
+                    "Handler for routing key %s failed", method.routing_key
+                )
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
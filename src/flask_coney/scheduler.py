@@ -0,0 +1,96 @@
+import math
+import threading
+import time
+from typing import Callable
+from typing import List
+
+from .utils import logger
+
+DELAYED_QUEUE = "coney.delayed"
+"""Queue the broker dead-letters long delayed messages to, once they waited
+in a delay bucket queue"""
+
+
+class TimingWheel:
+    """Hashed timing wheel running callbacks after a delay.
+
+    The wheel has ``slots`` slots and advances by one slot every ``tick``
+    seconds. A callback is put into the slot its delay ends in, together
+    with the number of full rotations left, so scheduling is O(1) and a
+    single thread serves all delays.
+
+    :param tick: Seconds per slot, the resolution of the delays
+    :param slots: Number of slots
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 1024):
+        self.tick = tick
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._wheel: List[List[list]] = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._size = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def horizon(self) -> float:
+        """Seconds of one rotation of the wheel"""
+        return self.tick * self.slots
+
+    def schedule(self, delay: float, callback: Callable):
+        """Runs the callback after delay seconds
+
+        :param delay: Seconds to wait, rounded up to the next tick
+        :param callback: Called without arguments in the thread of the wheel
+        """
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self._lock:
+            index = (self._cursor + ticks) % self.slots
+            self._wheel[index].append([(ticks - 1) // self.slots, callback])
+            self._size += 1
+
+    def advance(self) -> int:
+        """Moves the wheel one slot ahead and runs the callbacks due
+
+        :returns: The number of callbacks run
+        """
+        with self._lock:
+            self._cursor = (self._cursor + 1) % self.slots
+            slot = self._wheel[self._cursor]
+            due = [callback for rounds, callback in slot if rounds == 0]
+            self._wheel[self._cursor] = [
+                [rounds - 1, callback] for rounds, callback in slot if rounds > 0
+            ]
+            self._size -= len(due)
+
+        for callback in due:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Scheduled callback failed")
+        return len(due)
+
+    def start(self):
+        """Starts advancing the wheel in a background thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stopped.wait(max(0, next_tick - time.monotonic())):
+            self.advance()
+            next_tick += self.tick
@@ -0,0 +1,117 @@
+import bisect
+import hashlib
+from typing import Callable
+from typing import List
+from typing import Union
+
+from .exchange import ExchangeType
+
+
+def _hash(value: Union[str, bytes]) -> int:
+    if isinstance(value, str):
+        value = value.encode()
+    # a stable hash, so every process picks the same shard for a key
+    return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes.
+
+    Every node is placed on the ring ``replicas`` times, so keys spread
+    evenly and adding a node only moves the keys of its neighbours.
+
+    :param nodes: The nodes
+    :param replicas: Virtual nodes per node
+    """
+
+    def __init__(self, nodes: List[str], replicas: int = 100):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (_hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get(self, key: Union[str, bytes]) -> str:
+        """Returns the node of a key
+
+        :param key: E.g. a user id
+        """
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardedQueue:
+    """A queue split into ``shards`` queues, which are bound to the direct
+    exchange ``name``. Created by :meth:`Coney.sharded_queue`.
+
+    Messages with the same partition key always end up in the same shard,
+    so they are consumed in order.
+
+    :param coney: The Coney instance
+    :param name: Name of the exchange and prefix of the queue names
+    :param shards: Number of shards
+    :param app: A flask app
+    """
+
+    def __init__(self, coney, name: str, shards: int, app=None):
+        self.coney = coney
+        self.name = name
+        self.app = app
+        self.queue_names = [f"{name}.{shard}" for shard in range(shards)]
+        self.ring = HashRing(self.queue_names)
+
+    def shard_for(self, partition_key: Union[str, bytes]) -> str:
+        """Returns the name of the queue a partition key is routed to
+
+        :param partition_key: E.g. a user id
+        """
+        return self.ring.get(partition_key)
+
+    def declare(self):
+        """Declares the exchange, all shards and their bindings"""
+        with self.coney.channel(self.app) as channel:
+            channel.exchange_declare(
+                exchange=self.name, exchange_type=ExchangeType.DIRECT.value
+            )
+            for queue_name in self.queue_names:
+                channel.queue_declare(queue=queue_name)
+                channel.queue_bind(queue_name, self.name, routing_key=queue_name)
+
+    def publish(self, body: Union[str, dict], partition_key: str, **kwargs):
+        """Publishes a message to the shard of the partition key, see
+        :meth:`Coney.publish`
+
+        :param body: Body of the message, either a string or a dict
+        :param partition_key: E.g. a user id
+        """
+        kwargs.setdefault("app", self.app)
+        self.coney.publish(
+            body, exchange_name=self.name, partition_key=partition_key, **kwargs
+        )
+
+    def queue(self, shards: List[int] = None) -> Callable:
+        """A decorator for consuming the shards, see :meth:`Coney.queue`.
+        Every shard is consumed by its own thread.
+
+        :param shards: Indices of the shards to consume. Defaults to all
+            shards, pass a subset to spread the shards across workers.
+        """
+        if shards is None:
+            shards = list(range(len(self.queue_names)))
+
+        def decorator(func):
+            for shard in shards:
+                queue_name = self.queue_names[shard]
+                self.coney.queue(
+                    queue_name=queue_name,
+                    exchange_name=self.name,
+                    exchange_type=ExchangeType.DIRECT,
+                    routing_key=queue_name,
+                    app=self.app,
+                )(func)
+            return func
+
+        return decorator
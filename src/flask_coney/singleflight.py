@@ -0,0 +1,60 @@
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+
+from .metrics import Metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single call.
+
+    The first caller for a key executes the function, every caller arriving
+    while it is running waits for it and gets the same result or the same
+    exception.
+
+    :param metrics: Metrics to record the coalesced calls in
+    """
+
+    def __init__(self, metrics: Metrics = None):
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Executes ``fn`` unless a call for ``key`` is already in flight
+
+        :param key: Identifies identical calls
+        :param fn: The function to call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._metrics.incr("singleflight.coalesced")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,179 @@
+import json
+import sqlite3
+import threading
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pika
+
+from .chunking import split_message
+from .encoder import UUIDEncoder
+from .exceptions import SpoolFullError
+from .metrics import Metrics
+from .utils import logger
+
+
+class Spool:
+    """Durable append-only outbox for messages which could not be published.
+
+    The messages are stored in a sqlite database, so they survive a restart
+    of the application. They are read back in the order they were appended.
+
+    :param path: Path of the sqlite database file
+    :param max_messages: Maximum number of messages the spool will hold
+    """
+
+    def __init__(self, path: str, max_messages: int = 10000):
+        self.path = path
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " exchange TEXT NOT NULL,"
+            " routing_key TEXT NOT NULL,"
+            " body BLOB NOT NULL,"
+            " properties TEXT NOT NULL)"
+        )
+        (self._size,) = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(
+        self, exchange: str, routing_key: str, body: bytes, properties: dict
+    ) -> Optional[int]:
+        """Appends a message to the spool
+
+        :param exchange: The exchange
+        :param routing_key: The routing key
+        :param body: The encoded body
+        :param properties: see :py:class:`pika.spec.BasicProperties`
+        :raises:
+            SpoolFullError: if the spool already holds max_messages
+        """
+        if isinstance(body, str):
+            body = body.encode()
+
+        with self._lock:
+            if self._size >= self.max_messages:
+                raise SpoolFullError()
+            cursor = self._db.execute(
+                "INSERT INTO outbox (exchange, routing_key, body, properties)"
+                " VALUES (?, ?, ?, ?)",
+                (exchange, routing_key, body, json.dumps(properties, cls=UUIDEncoder)),
+            )
+            self._size += 1
+            return cursor.lastrowid
+
+    def peek(self, limit: int = 100) -> List[Tuple[int, str, str, bytes, dict]]:
+        """Returns the oldest messages without removing them
+
+        :param limit: Maximum number of messages
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, exchange, routing_key, body, properties FROM outbox"
+                " ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            (id, exchange, routing_key, body, json.loads(properties))
+            for id, exchange, routing_key, body, properties in rows
+        ]
+
+    def remove(self, id: int):
+        """Removes a message, which was replayed, from the spool"""
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM outbox WHERE id = ?", (id,))
+            self._size -= cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SpoolReplayer:
+    """Drains a :class:`Spool` in the background once the broker is reachable
+    again.
+
+    :param spool: The spool to drain
+    :param channel: Factory returning a context manager for a channel,
+        see :meth:`flask_coney.Coney.channel`
+    :param interval: Seconds to wait between two drain attempts
+    :param metrics: Metrics to record the replayed messages in
+    :param max_frame_bytes: Split bodies larger than this into chunks, see
+        :func:`flask_coney.chunking.split_message`
+    """
+
+    batch_size = 100
+
+    def __init__(
+        self,
+        spool: Spool,
+        channel: Callable,
+        interval: float = 1.0,
+        metrics: Metrics = None,
+        max_frame_bytes: int = None,
+    ):
+        self._spool = spool
+        self._channel = channel
+        self._interval = interval
+        self._metrics = metrics or Metrics()
+        self._max_frame_bytes = max_frame_bytes
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        while not self._stopped.is_set():
+            if len(self._spool):
+                try:
+                    self.drain()
+                except pika.exceptions.AMQPError as e:
+                    logger.warning("Replaying spooled messages failed: %s", e)
+            self._stopped.wait(self._interval)
+
+    def drain(self) -> int:
+        """Publishes all spooled messages in order. A message is only removed
+        from the spool after the broker confirmed it.
+
+        :returns: The number of replayed messages
+        """
+        replayed = 0
+        with self._channel() as channel:
+            channel.confirm_delivery()
+            while not self._stopped.is_set():
+                batch = self._spool.peek(self.batch_size)
+                if not batch:
+                    break
+                for id, exchange, routing_key, body, properties in batch:
+                    for chunk, chunk_properties in split_message(
+                        body, properties, self._max_frame_bytes
+                    ):
+                        channel.basic_publish(
+                            exchange=exchange,
+                            routing_key=routing_key,
+                            body=chunk,
+                            properties=pika.BasicProperties(**chunk_properties),
+                        )
+                    self._spool.remove(id)
+                    replayed += 1
+                    self._metrics.incr("spool.replayed")
+                    self._metrics.set("spool.depth", len(self._spool))
+        if replayed:
+            logger.info("Replayed %d spooled messages", replayed)
+        return replayed
@@ -0,0 +1,316 @@
+import collections
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Deque
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from .headers import PARENT_SPAN_HEADER
+from .headers import PUBLISHED_AT_HEADER
+from .headers import RECEIVED_AT_HEADER
+from .headers import TRACE_ID_HEADER
+from .utils import logger
+from .utils import time_ns
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+class Span:
+    """A timed step of a message, e.g. waiting in a queue or being handled.
+
+    :param name: E.g. ``coney.queue``
+    :param trace_id: Id shared by all spans of a trace
+    :param span_id: Id of the span
+    :param parent_id: Id of the span which caused this one
+    :param start_ns: Unix timestamp in nanoseconds the step started at
+    :param end_ns: Unix timestamp in nanoseconds the step ended at
+    :param attributes: E.g. the queue and the routing key
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        span_id: str,
+        parent_id: str = None,
+        start_ns: int = 0,
+        end_ns: int = 0,
+        attributes: dict = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.attributes = attributes or {}
+
+    def __repr__(self) -> str:
+        return f"<Span {self.name} {self.duration * 1000:.3f}ms {self.trace_id}>"
+
+    @property
+    def duration(self) -> float:
+        """Seconds the step took"""
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_otlp(self) -> dict:
+        """Returns the span in the shape of the OTLP/JSON encoding of
+        OpenTelemetry"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": (
+                "SPAN_KIND_CONSUMER"
+                if self.name.startswith("coney.handle")
+                else "SPAN_KIND_INTERNAL"
+            ),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class SpanExporter:
+    """Receives the finished spans of a :class:`Tracer`.
+
+    Subclass it to send the spans to a tracing backend, only :meth:`export`
+    has to be implemented. It is called in the thread of the consumer or
+    publisher, so it should not block.
+    """
+
+    def export(self, span: Span):
+        """Exports a finished span
+
+        :param span: The span
+        """
+        raise NotImplementedError()
+
+
+class InMemorySpanExporter(SpanExporter):
+    """Keeps the most recent spans, e.g. for tests or a debug endpoint.
+
+    :param max_spans: Number of spans kept
+    """
+
+    def __init__(self, max_spans: int = 10000):
+        self._spans: Deque[Span] = collections.deque(maxlen=max_spans)
+
+    @property
+    def spans(self) -> List[Span]:
+        return list(self._spans)
+
+    def export(self, span: Span):
+        self._spans.append(span)
+
+    def clear(self):
+        self._spans.clear()
+
+
+class LoggingSpanExporter(SpanExporter):
+    """Logs every span in the OTLP/JSON shape, so a log shipper can forward
+    them to a collector.
+
+    :param level: The log level
+    """
+
+    def __init__(self, level: int = logging.INFO):
+        self.level = level
+
+    def export(self, span: Span):
+        logger.log(self.level, "span %s", json.dumps(span.to_otlp()))
+
+
+class _Context:
+    __slots__ = ("trace_id", "span_id", "received_ns")
+
+    def __init__(self, trace_id: str, span_id: str, received_ns: int):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.received_ns = received_ns
+
+
+class Tracer:
+    """Stamps published messages with trace headers and records the spans of
+    consumed messages.
+
+    A message handled by a consumer activates its trace for the thread, so
+    messages published by the handler, e.g. replies, join the trace.
+
+    :param exporter: Receives the finished spans
+    """
+
+    def __init__(self, exporter: SpanExporter):
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def current(self) -> Optional[_Context]:
+        """Returns the trace of the message handled by the current thread or
+        None"""
+        return getattr(self._local, "context", None)
+
+    def inject(self, headers: dict = None) -> dict:
+        """Returns a copy of the headers with the trace id, the parent span
+        and the publish timestamp
+
+        :param headers: The headers of the message
+        """
+        headers = dict(headers or {})
+        context = self.current()
+        if context is not None:
+            headers.setdefault(TRACE_ID_HEADER, context.trace_id)
+            headers.setdefault(PARENT_SPAN_HEADER, context.span_id)
+        else:
+            headers.setdefault(TRACE_ID_HEADER, _new_id(16))
+        headers[PUBLISHED_AT_HEADER] = time_ns()
+        return headers
+
+    def record(
+        self,
+        name: str,
+        trace_id: str,
+        start_ns: int,
+        end_ns: int,
+        parent_id: str = None,
+        span_id: str = None,
+        attributes: dict = None,
+    ) -> Span:
+        """Exports a span, failures of the exporter are logged
+
+        :param name: E.g. ``coney.queue``
+        :param trace_id: Id of the trace
+        :param start_ns: Unix timestamp in nanoseconds the step started at
+        :param end_ns: Unix timestamp in nanoseconds the step ended at
+        :param parent_id: Id of the span which caused this one
+        :param span_id: Id of the span, a new one if None
+        :param attributes: E.g. the queue and the routing key
+        """
+        span = Span(
+            name,
+            trace_id,
+            span_id or _new_id(8),
+            parent_id=parent_id,
+            start_ns=start_ns,
+            end_ns=end_ns,
+            attributes=attributes,
+        )
+        try:
+            self.exporter.export(span)
+        except Exception:
+            logger.exception("Exporting span %s failed", name)
+        return span
+
+    def record_rpc(
+        self, routing_key: str, request_headers: dict, reply_headers: dict
+    ) -> Span:
+        """Records the round-trip of a request once its reply arrived.
+
+        If the server sent the time it received the request, the round-trip
+        is split into the request waiting in the broker, the server handling
+        it and the reply travelling back.
+
+        :param routing_key: The routing key of the request
+        :param request_headers: The headers the request was published with
+        :param reply_headers: The headers of the reply
+        """
+        end_ns = time_ns()
+        start_ns = request_headers[PUBLISHED_AT_HEADER]
+        trace_id = request_headers[TRACE_ID_HEADER]
+        rpc = self.record(
+            "coney.rpc",
+            trace_id,
+            start_ns,
+            end_ns,
+            parent_id=request_headers.get(PARENT_SPAN_HEADER),
+            attributes={"routing_key": routing_key},
+        )
+
+        received_ns = reply_headers.get(RECEIVED_AT_HEADER)
+        replied_ns = reply_headers.get(PUBLISHED_AT_HEADER)
+        if received_ns is not None and replied_ns is not None:
+            # clamped into the round-trip, the clocks of client and server
+            # may differ
+            received_ns = min(max(start_ns, received_ns), end_ns)
+            replied_ns = min(max(received_ns, replied_ns), end_ns)
+            for name, start, end in (
+                ("coney.rpc.request", start_ns, received_ns),
+                ("coney.rpc.server", received_ns, replied_ns),
+                ("coney.rpc.reply", replied_ns, end_ns),
+            ):
+                self.record(name, trace_id, start, end, parent_id=rpc.span_id)
+        return rpc
+
+    @contextmanager
+    def consume(
+        self, queue: str, routing_key: str, headers: dict, received_ns: int
+    ) -> Iterator[_Context]:
+        """Records the time a message waited in the queue and the time its
+        handler took, while the trace of the message is active for the thread
+
+        :param queue: Name of the queue
+        :param routing_key: The routing key
+        :param headers: The headers of the message
+        :param received_ns: Unix timestamp in nanoseconds the message arrived
+        """
+        headers = headers or {}
+        trace_id = headers.get(TRACE_ID_HEADER) or _new_id(16)
+        parent_id = headers.get(PARENT_SPAN_HEADER)
+        attributes = {"messaging.destination": queue, "routing_key": routing_key}
+
+        published_ns = headers.get(PUBLISHED_AT_HEADER)
+        if published_ns is not None:
+            # the clocks of publisher and consumer may differ
+            self.record(
+                "coney.queue",
+                trace_id,
+                published_ns,
+                max(published_ns, received_ns),
+                parent_id=parent_id,
+                attributes=attributes,
+            )
+
+        context = _Context(trace_id, _new_id(8), received_ns)
+        previous = self.current()
+        self._local.context = context
+        start_ns = time_ns()
+        error = None
+        try:
+            yield context
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._local.context = previous
+            if error is not None:
+                attributes = {**attributes, "error": type(error).__name__}
+            self.record(
+                "coney.handle",
+                trace_id,
+                start_ns,
+                time_ns(),
+                parent_id=parent_id,
+                span_id=context.span_id,
+                attributes=attributes,
+            )
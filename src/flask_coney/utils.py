@@ -1,3 +1,12 @@
 import logging
+import time
 
 logger = logging.getLogger(__name__)
+
+
+def time_ns() -> int:
+    """Returns the unix time in nanoseconds, :func:`time.time_ns` needs
+    Python 3.7"""
+    if hasattr(time, "time_ns"):
+        return time.time_ns()
+    return int(time.time() * 1e9)
@@ -0,0 +1,83 @@
+import asyncio
+from unittest import mock
+
+import pika
+import pytest
+
+from flask_coney.aio import AsyncioClient
+
+
+def test_submit_runs_on_shared_loop():
+    client = AsyncioClient("amqp://localhost")
+
+    async def get_loop():
+        return asyncio.get_event_loop()
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert client.submit(get_loop()).result(timeout=1) is client.loop
+        assert loop.run_until_complete(client.call(get_loop())) is client.loop
+    finally:
+        loop.close()
+        client.close()
+
+
+def test_request_resolved_by_reply():
+    receive = mock.Mock(side_effect=lambda props, body: body.upper())
+    client = AsyncioClient("amqp://localhost", receive=receive)
+    channel = mock.Mock()
+
+    async def request():
+        client._channel = channel
+        client._ready = client._loop.create_future()
+        client._ready.set_result(channel)
+        return await client.request("", "rpc", [(b"ping", {})], "42", timeout=1)
+
+    def reply(_exchange, _routing_key, body, properties):
+        client._on_reply(None, None, properties, b"pong")
+
+    channel.basic_publish.side_effect = reply
+    try:
+        props, body = client.submit(request()).result(timeout=1)
+    finally:
+        client.close()
+
+    assert body == b"PONG"
+    assert props.correlation_id == "42"
+    assert props.reply_to == "amq.rabbitmq.reply-to"
+    assert client._pending == {}
+
+
+def test_request_times_out():
+    client = AsyncioClient("amqp://localhost")
+    channel = mock.Mock()
+
+    async def request():
+        client._ready = client._loop.create_future()
+        client._ready.set_result(channel)
+        client._channel = channel
+        return await client.request("", "rpc", [(b"ping", {})], "42", timeout=0.01)
+
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            client.submit(request()).result(timeout=1)
+    finally:
+        client.close()
+    assert client._pending == {}
+
+
+def test_pending_requests_fail_on_close():
+    client = AsyncioClient("amqp://localhost")
+
+    async def close():
+        future = client._loop.create_future()
+        client._pending["42"] = future
+        client._connection = mock.Mock()
+        client._on_connection_closed(None, "gone")
+        return future
+
+    try:
+        future = client.submit(close()).result(timeout=1)
+    finally:
+        client.close()
+    assert isinstance(future.exception(), pika.exceptions.AMQPConnectionError)
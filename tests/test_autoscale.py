@@ -0,0 +1,77 @@
+from unittest import mock
+
+import pika
+
+from flask_coney.autoscale import Autoscaler
+from flask_coney.autoscale import ScaledQueue
+from flask_coney.metrics import Metrics
+
+
+def make_queue(**kwargs):
+    stop_consumer = mock.Mock()
+    queue = ScaledQueue(
+        "work",
+        mock.Mock(),
+        lambda handler: mock.Mock(handler=handler),
+        stop_consumer,
+        **kwargs,
+    )
+    return queue, stop_consumer
+
+
+def test_scaled_queue_bounds():
+    queue, stop_consumer = make_queue(min_consumers=1, max_consumers=3)
+
+    queue.scale_to(10)
+    assert len(queue.consumers) == 3
+
+    queue.scale_to(0)
+    assert len(queue.consumers) == 1
+    assert stop_consumer.call_count == 2
+
+
+def test_scaled_queue_counts_handled():
+    queue, _ = make_queue()
+    queue.scale_to(1)
+
+    queue.consumers[0].handler("ch", "method", "props", "body")
+
+    queue.func.assert_called_once_with("ch", "method", "props", "body")
+    assert queue.handled == 1
+
+
+def test_autoscaler():
+    metrics = Metrics()
+    depth = {"work": (0, 0)}
+    autoscaler = Autoscaler(lambda name: depth[name], target_depth=10, metrics=metrics)
+    queue, _ = make_queue(min_consumers=1, max_consumers=8)
+    autoscaler.add(queue)
+    assert len(queue.consumers) == 1
+
+    depth["work"] = (45, 1)
+    autoscaler.run_once()
+    assert len(queue.consumers) == 5
+    assert metrics.get("queue.work.depth") == 45
+    assert metrics.get("queue.work.concurrency") == 5
+
+    # consumers of other processes count towards the target
+    depth["work"] = (45, 7)
+    autoscaler.run_once()
+    assert len(queue.consumers) == 4
+
+    depth["work"] = (0, 4)
+    for _ in range(10):
+        autoscaler.run_once()
+    assert len(queue.consumers) == 1
+    assert metrics.get("queue.work.lag") == 0
+
+
+def test_autoscaler_probe_fails():
+    probe = mock.Mock(side_effect=pika.exceptions.AMQPConnectionError())
+    autoscaler = Autoscaler(probe)
+    queue, _ = make_queue(min_consumers=2, max_consumers=4)
+    autoscaler.add(queue)
+
+    autoscaler.run_once()
+
+    assert len(queue.consumers) == 2
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from flask_coney.blobstore import ClaimCheck
+from flask_coney.blobstore import FileSystemBlobStore
+
+
+def test_put_get_delete(tmp_path):
+    store = FileSystemBlobStore(str(tmp_path / "blobs"))
+
+    key = store.put(b"payload")
+
+    assert store.get(key) == b"payload"
+    assert os.listdir(store.path) == [key]
+
+    store.delete(key)
+    store.delete(key)
+
+    assert os.listdir(store.path) == []
+
+
+def test_invalid_key(tmp_path):
+    store = FileSystemBlobStore(str(tmp_path))
+
+    with pytest.raises(ValueError):
+        store.get("../secret")
+
+
+def test_purge(tmp_path):
+    store = FileSystemBlobStore(str(tmp_path))
+    old = store.put(b"old")
+    new = store.put(b"new")
+    os.utime(os.path.join(store.path, old), (0, 0))
+
+    assert store.purge(max_age=60) == 1
+    assert os.listdir(store.path) == [new]
+
+
+def test_claim_check_mmap(tmp_path):
+    store = FileSystemBlobStore(str(tmp_path))
+    claim_check = ClaimCheck(store, store.put(b"x" * 1000))
+
+    mapped = claim_check.mmap()
+
+    assert mapped[:3] == b"xxx"
+    assert len(mapped) == 1000
+    assert claim_check.read() == b"x" * 1000
+    mapped.close()
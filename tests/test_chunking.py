@@ -0,0 +1,54 @@
+import time
+
+from flask_coney.chunking import is_chunk
+from flask_coney.chunking import Reassembler
+from flask_coney.chunking import split_message
+from flask_coney.headers import CHUNK_COUNT_HEADER
+from flask_coney.metrics import Metrics
+
+
+def test_split_small_message():
+    chunks = split_message("small", {"content_type": "text/plain"}, 10)
+
+    assert chunks == [(b"small", {"content_type": "text/plain"})]
+    assert not is_chunk(chunks[0][1].get("headers"))
+
+
+def test_split_and_reassemble():
+    body = bytes(range(256)) * 10
+    chunks = split_message(body, {"headers": {"a": 1}}, 1000)
+
+    assert len(chunks) == 3
+    assert all(props["headers"]["a"] == 1 for _, props in chunks)
+    assert all(props["headers"][CHUNK_COUNT_HEADER] == 3 for _, props in chunks)
+
+    reassembler = Reassembler(memory_bytes=100)
+    results = [reassembler.add(props["headers"], chunk) for chunk, props in chunks]
+
+    assert results[:2] == [None, None]
+    assert results[2] == body
+    assert len(reassembler) == 0
+
+
+def test_reassemble_out_of_order():
+    metrics = Metrics()
+    chunks = split_message(b"abcdef", {}, 2)
+    reassembler = Reassembler(metrics=metrics)
+
+    assert reassembler.add(chunks[0][1]["headers"], chunks[0][0]) is None
+    assert reassembler.add(chunks[2][1]["headers"], chunks[2][0]) is None
+    assert reassembler.add(chunks[1][1]["headers"], chunks[1][0]) is None
+
+    assert len(reassembler) == 0
+    assert metrics.get("chunks.dropped") == 2
+
+
+def test_reassemble_timeout():
+    chunks = split_message(b"abcdef", {}, 2)
+    reassembler = Reassembler(timeout=0.01)
+
+    reassembler.add(chunks[0][1]["headers"], chunks[0][0])
+    time.sleep(0.02)
+    reassembler.add(chunks[1][1]["headers"], chunks[1][0])
+
+    assert len(reassembler) == 0
@@ -0,0 +1,434 @@
+import json
+import queue
+import threading
+import time
+from unittest import mock
+
+import pika
+
+from flask_coney.blobstore import ClaimCheck
+from flask_coney.blobstore import FileSystemBlobStore
+from flask_coney.chunking import split_message
+from flask_coney.consumer import Consumer
+from flask_coney.consumer import ReconnectingConsumer
+from flask_coney.dedup import LRUDedupFilter
+from flask_coney.failover import BrokerPool
+from flask_coney.headers import CLAIM_CHECK_HEADER
+from flask_coney.headers import DEADLINE_HEADER
+from flask_coney.headers import RETRY_COUNT_HEADER
+from flask_coney.metrics import Metrics
+from flask_coney.profiling import HandlerProfiler
+from flask_coney.tracing import InMemorySpanExporter
+from flask_coney.tracing import Tracer
+
+
+def deliver(consumer, body, delivery_tag=1, routing_key="test", **properties):
+    method = pika.spec.Basic.Deliver(delivery_tag=delivery_tag, routing_key=routing_key)
+    props = pika.spec.BasicProperties(**properties)
+    consumer.on_message(consumer._channel, method, props, body)
+    return method, props
+
+
+def make_consumer(**kwargs):
+    handler = mock.Mock()
+    consumer = Consumer("amqp://localhost", on_message=handler, **kwargs)
+    consumer._channel = mock.Mock()
+    return consumer, handler
+
+
+def test_on_message_decodes_json():
+    consumer, handler = make_consumer()
+
+    deliver(consumer, json.dumps({"a": 1}), content_type="application/json")
+
+    consumer._channel.basic_ack.assert_called_once_with(1)
+    assert handler.call_args[0][3] == {"a": 1}
+
+
+def test_on_message_manual_ack():
+    consumer, handler = make_consumer(manual_ack=True)
+
+    deliver(consumer, b"body")
+
+    handler.assert_called_once()
+    consumer._channel.basic_ack.assert_not_called()
+
+
+def test_on_message_drops_expired():
+    metrics = Metrics()
+    consumer, handler = make_consumer(metrics=metrics)
+
+    deliver(consumer, b"late", headers={DEADLINE_HEADER: time.time() - 1})
+
+    handler.assert_not_called()
+    consumer._channel.basic_nack.assert_called_once_with(1, requeue=False)
+    assert metrics.get("consumer.shed") == 1
+
+
+def test_on_message_before_deadline():
+    consumer, handler = make_consumer()
+
+    deliver(consumer, b"in time", headers={DEADLINE_HEADER: time.time() + 10})
+
+    handler.assert_called_once()
+
+
+def test_on_message_reassembles_chunks():
+    consumer, handler = make_consumer(chunked=True, prefetch_count=10)
+    body = json.dumps({"data": "x" * 100})
+    chunks = split_message(body, {"content_type": "application/json"}, 30)
+
+    for tag, (chunk, props) in enumerate(chunks, 1):
+        deliver(consumer, chunk, delivery_tag=tag, **props)
+
+    assert consumer._channel.basic_ack.call_count == len(chunks)
+    handler.assert_called_once()
+    assert handler.call_args[0][3] == {"data": "x" * 100}
+
+
+def test_on_message_holds_chunk_acks():
+    consumer, handler = make_consumer(chunked=True, prefetch_count=10)
+    body = json.dumps({"data": "x" * 100})
+    chunks = split_message(body, {"content_type": "application/json"}, 30)
+
+    for tag, (chunk, props) in enumerate(chunks[:-1], 1):
+        deliver(consumer, chunk, delivery_tag=tag, **props)
+    consumer._channel.basic_ack.assert_not_called()
+
+    deliver(consumer, chunks[-1][0], delivery_tag=len(chunks), **chunks[-1][1])
+    handler.assert_called_once()
+    acked = [c[0][0] for c in consumer._channel.basic_ack.call_args_list]
+    assert acked == list(range(1, len(chunks) + 1))
+
+
+def test_on_message_rejects_dropped_chunks():
+    metrics = Metrics()
+    consumer, handler = make_consumer(chunked=True, prefetch_count=10, metrics=metrics)
+    chunks = split_message("x" * 100, {}, 30)
+
+    deliver(consumer, chunks[0][0], delivery_tag=1, **chunks[0][1])
+    deliver(consumer, chunks[2][0], delivery_tag=2, **chunks[2][1])
+
+    handler.assert_not_called()
+    consumer._channel.basic_ack.assert_not_called()
+    rejected = [c[0][0] for c in consumer._channel.basic_nack.call_args_list]
+    assert rejected == [1, 2]
+    assert metrics.get("chunks.dropped") == 1
+
+
+def test_on_message_requeues_oldest_chunks_when_window_full():
+    metrics = Metrics()
+    consumer, handler = make_consumer(chunked=True, prefetch_count=4, metrics=metrics)
+    first = split_message("a" * 100, {}, 30)
+    second = split_message("b" * 100, {}, 30)
+
+    deliveries = [first[0], first[1], second[0], second[1], second[2], second[3]]
+    for tag, (chunk, props) in enumerate(deliveries, 1):
+        deliver(consumer, chunk, delivery_tag=tag, **props)
+
+    nacked = consumer._channel.basic_nack.call_args_list
+    assert nacked == [mock.call(1, requeue=True), mock.call(2, requeue=True)]
+    assert metrics.get("chunks.requeued") == 1
+    handler.assert_called_once()
+    assert handler.call_args[0][3] == b"b" * 100
+
+    # the requeued chunks are delivered again
+    for tag, (chunk, props) in enumerate(first, 7):
+        deliver(consumer, chunk, delivery_tag=tag, **props)
+
+    assert handler.call_args[0][3] == b"a" * 100
+    acked = [c[0][0] for c in consumer._channel.basic_ack.call_args_list]
+    assert acked == [3, 4, 5, 6, 7, 8, 9, 10]
+
+
+def test_on_message_rejects_chunks_larger_than_window():
+    consumer, handler = make_consumer(chunked=True, prefetch_count=2)
+    chunks = split_message("x" * 100, {}, 30)
+
+    for tag, (chunk, props) in enumerate(chunks[:2], 1):
+        deliver(consumer, chunk, delivery_tag=tag, **props)
+
+    handler.assert_not_called()
+    consumer._channel.basic_ack.assert_not_called()
+    nacked = consumer._channel.basic_nack.call_args_list
+    assert nacked == [mock.call(1, requeue=False), mock.call(2, requeue=False)]
+
+
+def test_on_message_rejects_chunks_if_not_chunked():
+    metrics = Metrics()
+    consumer, handler = make_consumer(metrics=metrics)
+    chunks = split_message("x" * 100, {}, 30)
+
+    deliver(consumer, chunks[0][0], delivery_tag=1, **chunks[0][1])
+
+    handler.assert_not_called()
+    consumer._channel.basic_nack.assert_called_once_with(1, requeue=False)
+    assert metrics.get("chunks.rejected") == 1
+
+
+def test_setup_queue_chunked():
+    consumer, _ = make_consumer(queue="videos", chunked=True)
+    consumer.setup_queue("videos")
+
+    kwargs = consumer._channel.queue_declare.call_args[1]
+    assert kwargs["arguments"] == {"x-single-active-consumer": True}
+
+    consumer, _ = make_consumer(queue="videos")
+    consumer.setup_queue("videos")
+
+    assert consumer._channel.queue_declare.call_args[1]["arguments"] is None
+
+
+def test_setup_queue_unnamed_is_exclusive():
+    consumer, _ = make_consumer(queue="")
+    consumer.setup_queue("")
+
+    kwargs = consumer._channel.queue_declare.call_args[1]
+    assert kwargs["exclusive"] and kwargs["auto_delete"]
+
+    consumer, _ = make_consumer(queue="videos")
+    consumer.setup_queue("videos")
+
+    kwargs = consumer._channel.queue_declare.call_args[1]
+    assert not kwargs["exclusive"] and not kwargs["auto_delete"]
+
+
+def test_on_message_fetches_claim_check(tmp_path):
+    store = FileSystemBlobStore(str(tmp_path))
+    key = store.put(json.dumps({"a": 1}).encode())
+    consumer, handler = make_consumer(blob_store=store)
+
+    deliver(
+        consumer,
+        b"",
+        content_type="application/json",
+        headers={CLAIM_CHECK_HEADER: key},
+    )
+
+    assert handler.call_args[0][3] == {"a": 1}
+
+
+def test_on_message_lazy_claim_check(tmp_path):
+    store = FileSystemBlobStore(str(tmp_path))
+    key = store.put(b"payload")
+    consumer, handler = make_consumer(blob_store=store, lazy_claim_check=True)
+
+    deliver(consumer, b"", headers={CLAIM_CHECK_HEADER: key})
+
+    claim_check = handler.call_args[0][3]
+    assert isinstance(claim_check, ClaimCheck)
+    assert claim_check.read() == b"payload"
+
+
+def test_on_message_claim_check_without_store():
+    consumer, handler = make_consumer()
+
+    deliver(consumer, b"", headers={CLAIM_CHECK_HEADER: "0" * 32})
+
+    handler.assert_not_called()
+    consumer._channel.basic_nack.assert_called_once_with(1, requeue=False)
+
+
+def test_bind():
+    consumer, _ = make_consumer(exchange="events", queue="orders")
+    consumer._connection = mock.Mock()
+
+    consumer.bind("orders.#")
+    consumer.bind("orders.#")
+
+    assert consumer._routing_keys == ["orders.#"]
+    callback = consumer._connection.ioloop.add_callback_threadsafe.call_args[0][0]
+    callback()
+    consumer._channel.queue_bind.assert_called_once_with(
+        "orders", "events", routing_key="orders.#"
+    )
+
+
+def test_on_message_retries_failed_message():
+    metrics = Metrics()
+    consumer, handler = make_consumer(queue="orders", retries=[1, 10], metrics=metrics)
+    handler.side_effect = ValueError()
+
+    deliver(consumer, b"order", headers={"a": 1})
+
+    consumer._channel.basic_ack.assert_called_once_with(1)
+    exchange, queue_name, body, props = consumer._channel.basic_publish.call_args[0]
+    assert (exchange, queue_name, body) == ("", "orders.retry.0", b"order")
+    assert props.headers == {"a": 1, RETRY_COUNT_HEADER: 1}
+    assert metrics.get("consumer.retried") == 1
+
+
+def test_on_message_parks_poison_message():
+    metrics = Metrics()
+    consumer, handler = make_consumer(queue="orders", retries=[1, 10], metrics=metrics)
+    handler.side_effect = ValueError()
+
+    deliver(consumer, b"order", headers={RETRY_COUNT_HEADER: 2})
+
+    queue_name = consumer._channel.basic_publish.call_args[0][1]
+    assert queue_name == "orders.parking-lot"
+    assert metrics.get("consumer.parked") == 1
+
+
+def test_on_message_parks_undecodable_message():
+    consumer, handler = make_consumer(queue="orders", retries=[1])
+
+    deliver(
+        consumer,
+        b"{not json",
+        content_type="application/json",
+        headers={RETRY_COUNT_HEADER: 1},
+    )
+
+    handler.assert_not_called()
+    publish = consumer._channel.basic_publish.call_args[0]
+    assert publish[1:3] == ("orders.parking-lot", b"{not json")
+    consumer._channel.basic_ack.assert_called_once_with(1)
+
+
+def test_on_message_retries_missing_claim_check(tmp_path):
+    consumer, handler = make_consumer(
+        queue="orders", retries=[1], blob_store=FileSystemBlobStore(str(tmp_path))
+    )
+
+    deliver(consumer, b"", headers={CLAIM_CHECK_HEADER: "missing"})
+
+    handler.assert_not_called()
+    assert consumer._channel.basic_publish.call_args[0][1] == "orders.retry.0"
+    consumer._channel.basic_ack.assert_called_once_with(1)
+
+
+def test_on_message_acks_after_handler_with_retries():
+    consumer, handler = make_consumer(queue="orders", retries=[1])
+    handler.side_effect = lambda *args: consumer._channel.basic_ack.assert_not_called()
+
+    deliver(consumer, b"order")
+
+    handler.assert_called_once()
+    consumer._channel.basic_ack.assert_called_once_with(1)
+    consumer._channel.basic_publish.assert_not_called()
+
+
+def test_setup_retry_queues():
+    consumer, _ = make_consumer(queue="orders", retries=[1, 2.5])
+
+    consumer.setup_retry_queues()
+
+    calls = consumer._channel.queue_declare.call_args_list
+    assert [c[1]["queue"] for c in calls] == [
+        "orders.retry.0",
+        "orders.retry.1",
+        "orders.parking-lot",
+    ]
+    assert calls[1][1]["arguments"] == {
+        "x-message-ttl": 2500,
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": "orders",
+    }
+
+
+def test_on_message_skips_duplicates():
+    metrics = Metrics()
+    consumer, handler = make_consumer(dedup=LRUDedupFilter(), metrics=metrics)
+
+    deliver(consumer, b"once", delivery_tag=1, message_id="1")
+    deliver(consumer, b"once", delivery_tag=2, message_id="1")
+    deliver(consumer, b"other", delivery_tag=3, message_id="2")
+
+    assert handler.call_count == 2
+    assert consumer._channel.basic_ack.call_count == 3
+    assert metrics.get("consumer.deduplicated") == 1
+
+
+def test_on_message_dedup_after_failure():
+    consumer, handler = make_consumer(
+        queue="orders", retries=[1], dedup=LRUDedupFilter()
+    )
+    handler.side_effect = [ValueError(), None]
+
+    deliver(consumer, b"order", delivery_tag=1, message_id="1")
+    deliver(consumer, b"order", delivery_tag=2, message_id="1")
+
+    assert handler.call_count == 2
+
+
+def test_on_message_profiled():
+    profiler = HandlerProfiler(sample_rate=1)
+    consumer, handler = make_consumer(queue="orders", profiler=profiler)
+
+    deliver(consumer, b"order")
+
+    handler.assert_called_once()
+    assert "Queue orders: 1 samples" in profiler.report()
+
+
+def test_on_message_traced():
+    exporter = InMemorySpanExporter()
+    consumer, handler = make_consumer(queue="orders", tracer=Tracer(exporter))
+
+    deliver(consumer, b"order", headers=Tracer(exporter).inject())
+
+    handler.assert_called_once()
+    assert [span.name for span in exporter.spans] == ["coney.queue", "coney.handle"]
+
+
+def test_reconnect_keeps_topology():
+    handler = mock.Mock()
+    pool = BrokerPool(["amqp://node1", "amqp://node2"])
+    consumer = ReconnectingConsumer(
+        pool, exchange="orders", queue="created", on_message=handler
+    )
+    consumer.bind("order.created")
+    first = consumer._consumer
+    first.should_reconnect = first.was_consuming = True
+
+    with mock.patch.object(Consumer, "stop"):
+        consumer._maybe_reconnect()
+
+    second = consumer._consumer
+    assert second is not first
+    assert second._url == "amqp://node2"
+    assert second._exchange == "orders"
+    assert second._queue == "created"
+    assert second._routing_keys == ["order.created"]
+    assert second._on_message is handler
+    assert not pool.is_healthy("amqp://node1")
+
+
+def test_stop_runs_on_ioloop():
+    consumer = ReconnectingConsumer("amqp://localhost", on_message=mock.Mock())
+    inner = consumer._consumer
+    inner._connection = connection = mock.Mock(is_closing=False, is_closed=False)
+    callbacks = queue.Queue()
+    connection.ioloop.add_callback_threadsafe.side_effect = callbacks.put
+    closed_by = []
+    connection.close.side_effect = lambda: closed_by.append(threading.current_thread())
+
+    stopper = threading.Thread(target=consumer.stop)
+    stopper.start()
+    stopper.join()
+
+    connection.close.assert_not_called()
+    connection.ioloop.stop.assert_not_called()
+    # the ioloop thread runs the scheduled shutdown
+    callbacks.get_nowait()()
+    assert closed_by == [threading.current_thread()]
+
+    # the connection closed callback stops the ioloop
+    inner.on_connection_closed(connection, None)
+    connection.ioloop.stop.assert_called_once_with()
+    assert not consumer._running
+
+
+def test_stop_cancels_consumer_first():
+    inner, _ = make_consumer()
+    inner._connection = connection = mock.Mock()
+    inner._consuming = True
+
+    inner.request_stop()
+    connection.ioloop.add_callback_threadsafe.assert_called_once_with(inner.shutdown)
+    inner.shutdown()
+    inner.shutdown()
+
+    inner._channel.basic_cancel.assert_called_once()
+    connection.close.assert_not_called()
@@ -0,0 +1,94 @@
+import time
+from unittest import mock
+
+import pika
+import pytest
+
+from flask_coney.cooperative import is_monkey_patched
+from flask_coney.cooperative import SharedRpcClient
+
+
+def test_is_monkey_patched():
+    gevent_monkey = mock.Mock()
+    gevent_monkey.is_module_patched.return_value = True
+
+    with mock.patch.dict("sys.modules", {"gevent.monkey": gevent_monkey}):
+        assert is_monkey_patched()
+    gevent_monkey.is_module_patched.assert_called_once_with("socket")
+
+    gevent_monkey.is_module_patched.return_value = False
+    with mock.patch.dict(
+        "sys.modules", {"gevent.monkey": gevent_monkey, "eventlet.patcher": None}
+    ):
+        assert not is_monkey_patched()
+
+
+def make_client(**kwargs):
+    connection = mock.Mock()
+    connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    connection.process_data_events.side_effect = lambda time_limit: time.sleep(0.01)
+    channel = connection.channel.return_value
+    client = SharedRpcClient(lambda: connection, **kwargs)
+    return client, channel
+
+
+def test_shared_rpc_client():
+    client, channel = make_client(receive=lambda props, body: body.upper())
+
+    def reply(_exchange, _routing_key, body, properties):
+        client._on_reply(None, None, properties, b"pong")
+
+    channel.basic_publish.side_effect = reply
+    try:
+        with client.waiter() as waiter:
+            corr_id = waiter.send("", "rpc", [(b"ping", {"content_type": "x"})])
+            assert waiter.wait(1)
+    finally:
+        client.stop()
+
+    reply_corr_id, props, body = waiter.reply
+    assert reply_corr_id == corr_id
+    assert props.reply_to == "amq.rabbitmq.reply-to"
+    assert props.content_type == "x"
+    assert body == b"PONG"
+    channel.basic_consume.assert_called_once_with(
+        "amq.rabbitmq.reply-to", client._on_reply, auto_ack=True
+    )
+    assert client._pending == {}
+
+
+def test_shared_rpc_client_connection_lost():
+    client, channel = make_client(reconnect_delay=10)
+
+    try:
+        with client.waiter() as waiter:
+            waiter.send("", "rpc", [(b"ping", {})])
+            client._on_reply(None, None, mock.Mock(correlation_id="other"), b"")
+            client._fail_pending(pika.exceptions.AMQPConnectionError())
+            assert waiter.wait(1)
+    finally:
+        client.stop()
+
+    assert waiter.reply is None
+    assert isinstance(waiter.error, pika.exceptions.AMQPConnectionError)
+
+
+def test_shared_rpc_client_connect_timeout():
+    client = SharedRpcClient(mock.Mock(side_effect=pika.exceptions.AMQPError()))
+    client.connect_timeout = 0.01
+
+    try:
+        with pytest.raises(pika.exceptions.AMQPConnectionError):
+            client.waiter().send("", "rpc", [(b"ping", {})])
+    finally:
+        client.stop()
+
+
+def test_shared_rpc_client_send_after_connection_lost():
+    client = SharedRpcClient(mock.Mock())
+    # the connection failed after the ready event was checked
+    client._ready.set()
+
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        client.send(mock.Mock(), "", "rpc", [(b"ping", {})], "1")
+    assert client._pending == {}
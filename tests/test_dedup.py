@@ -0,0 +1,78 @@
+import time
+
+from flask_coney.dedup import BloomDedupFilter
+from flask_coney.dedup import LRUDedupFilter
+from flask_coney.dedup import SqliteDedupFilter
+
+
+def test_lru_filter():
+    dedup = LRUDedupFilter(max_size=2)
+
+    dedup.add("a")
+    dedup.add("b")
+    assert dedup.seen("a")
+    assert not dedup.seen("c")
+
+    dedup.add("c")
+    assert not dedup.seen("a")
+    assert dedup.seen("b")
+    assert len(dedup) == 2
+
+
+def test_lru_filter_window():
+    dedup = LRUDedupFilter(window=0.01)
+
+    dedup.add("a")
+    time.sleep(0.02)
+
+    assert not dedup.seen("a")
+    dedup.add("b")
+    assert len(dedup) == 1
+
+
+def test_bloom_filter():
+    dedup = BloomDedupFilter(capacity=1000, error_rate=0.01)
+
+    for n in range(1000):
+        dedup.add(str(n))
+
+    assert all(dedup.seen(str(n)) for n in range(1000))
+    false_positives = sum(dedup.seen(f"x{n}") for n in range(1000))
+    assert false_positives < 50
+
+
+def test_bloom_filter_rotates():
+    dedup = BloomDedupFilter(capacity=10)
+
+    dedup.add("old")
+    for n in range(10):
+        dedup.add(str(n))
+    assert dedup.seen("old")
+
+    for n in range(10, 20):
+        dedup.add(str(n))
+    assert not dedup.seen("old")
+    assert dedup.seen("15")
+
+
+def test_sqlite_filter(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    dedup = SqliteDedupFilter(path)
+    dedup.add("a")
+
+    other = SqliteDedupFilter(path)
+
+    assert other.seen("a")
+    assert not other.seen("b")
+    dedup.close()
+    other.close()
+
+
+def test_sqlite_filter_window(tmp_path):
+    dedup = SqliteDedupFilter(str(tmp_path / "dedup.db"), window=0.01)
+
+    dedup.add("a")
+    time.sleep(0.02)
+
+    assert not dedup.seen("a")
+    dedup.close()
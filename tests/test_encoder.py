@@ -2,6 +2,9 @@ from uuid import uuid4
 
 import pytest
 
+from flask_coney.encoder import Codec
+from flask_coney.encoder import JSONCodec
+from flask_coney.encoder import TextCodec
 from flask_coney.encoder import UUIDEncoder
 
 
@@ -18,3 +21,12 @@ def test_encode_not_jsonable():
 
     with pytest.raises(TypeError):
         UUIDEncoder().default(encode)
+
+
+def test_codecs():
+    id = uuid4()
+
+    assert JSONCodec().encode({"id": id}) == b'{"id":"%s"}' % str(id).encode()
+    assert JSONCodec.content_type == "application/json"
+    assert TextCodec().encode("hä") == "hä".encode()
+    assert Codec().encode(b"raw") == b"raw"
@@ -0,0 +1,89 @@
+from unittest import mock
+
+import pika
+import pytest
+
+from flask_coney.failover import BrokerPool
+from flask_coney.metrics import Metrics
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_failover_to_healthy_node():
+    clock = Clock()
+    metrics = Metrics()
+    pool = BrokerPool(
+        ["amqp://node1", "amqp://node2", "amqp://node3"],
+        base_delay=1,
+        metrics=metrics,
+        clock=clock,
+    )
+    assert pool.select() == "amqp://node1"
+
+    pool.record_failure("amqp://node1")
+    assert pool.select() == "amqp://node2"
+    assert pool.delay("amqp://node2") == 0
+
+    pool.record_success("amqp://node2")
+    assert pool.current == "amqp://node2"
+    assert metrics.get("broker.failover") == 1
+
+    # the current node is kept once the failed one recovered
+    clock.now = 1
+    assert pool.select() == "amqp://node2"
+    assert pool.candidates() == ["amqp://node2", "amqp://node1", "amqp://node3"]
+
+
+def test_backoff():
+    clock = Clock()
+    pool = BrokerPool(
+        ["amqp://node1", "amqp://node2"], base_delay=1, max_delay=4, clock=clock
+    )
+
+    for backoff in [1, 2, 4, 4, 4]:
+        pool.record_failure("amqp://node1")
+        assert backoff / 2 <= pool.delay("amqp://node1") <= backoff
+
+    pool.record_failure("amqp://node2")
+    assert pool.select() == "amqp://node2"
+    assert pool.candidates() == ["amqp://node2", "amqp://node1"]
+
+    pool.record_success("amqp://node1")
+    assert pool.select() == "amqp://node1"
+    assert pool.delay("amqp://node1") == 0
+
+
+def test_connect_tries_every_node():
+    pool = BrokerPool(["amqp://node1", "amqp://node2"])
+    connection = mock.Mock()
+
+    def connect(params):
+        if params.host == "node1":
+            raise pika.exceptions.AMQPConnectionError()
+        assert params.blocked_connection_timeout == 5
+        return connection
+
+    with mock.patch("pika.BlockingConnection", side_effect=connect) as blocking:
+        assert pool.connect(blocked_connection_timeout=5) is connection
+        assert pool.current == "amqp://node2"
+        assert pool.connect(5) is connection
+        assert blocking.call_count == 3
+
+    with mock.patch(
+        "pika.BlockingConnection", side_effect=pika.exceptions.AMQPConnectionError
+    ) as blocking:
+        with pytest.raises(pika.exceptions.AMQPConnectionError):
+            pool.connect()
+        assert blocking.call_count == 2
+
+
+def test_pool_needs_uris():
+    assert BrokerPool("amqp://node1").uris == ["amqp://node1"]
+    with pytest.raises(ValueError):
+        BrokerPool([])
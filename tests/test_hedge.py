@@ -0,0 +1,23 @@
+from flask_coney.hedge import HedgeBudget
+
+
+def test_hedge_budget_ratio():
+    budget = HedgeBudget(ratio=0.25)
+
+    spent = 0
+    for _ in range(20):
+        budget.deposit()
+        if budget.try_spend():
+            spent += 1
+
+    assert spent == 5
+
+
+def test_hedge_budget_burst():
+    budget = HedgeBudget(ratio=1, burst=2)
+    for _ in range(10):
+        budget.deposit()
+
+    assert budget.try_spend()
+    assert budget.try_spend()
+    assert not budget.try_spend()
@@ -0,0 +1,35 @@
+from flask_coney.metrics import LatencyTracker
+from flask_coney.metrics import Metrics
+
+
+def test_metrics_counters_and_gauges():
+    metrics = Metrics()
+    metrics.incr("a")
+    metrics.incr("a", 2)
+    metrics.set("b", 5)
+    metrics.set("b", 3)
+
+    assert metrics.snapshot() == {"a": 3, "b": 3}
+
+
+def test_latency_tracker_percentile():
+    tracker = LatencyTracker(min_samples=10)
+    for i in range(1, 101):
+        tracker.observe("rpc", i / 100)
+
+    assert tracker.percentile("rpc", 50) == 0.51
+    assert tracker.percentile("rpc", 95) == 0.96
+    assert tracker.percentile("rpc", 100) == 1.0
+
+
+def test_latency_tracker_needs_samples():
+    tracker = LatencyTracker(window=5, min_samples=3)
+    tracker.observe("rpc", 1)
+
+    assert tracker.percentile("rpc", 50) is None
+    assert tracker.percentile("other", 50) is None
+
+    for _ in range(10):
+        tracker.observe("rpc", 2)
+
+    assert tracker.percentile("rpc", 0) == 2
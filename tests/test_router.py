@@ -0,0 +1,74 @@
+from unittest import mock
+
+import pika
+import pytest
+
+from flask_coney.router import Router
+from flask_coney.router import TopicTrie
+
+
+@pytest.mark.parametrize(
+    "pattern, routing_key, matches",
+    [
+        ("orders.created", "orders.created", True),
+        ("orders.created", "orders.deleted", False),
+        ("orders.*.created", "orders.eu.created", True),
+        ("orders.*.created", "orders.created", False),
+        ("orders.*.created", "orders.eu.de.created", False),
+        ("orders.#", "orders", True),
+        ("orders.#", "orders.eu.de.created", True),
+        ("orders.#.created", "orders.created", True),
+        ("orders.#.created", "orders.eu.de.created", True),
+        ("orders.#.created", "orders.eu.deleted", False),
+        ("#", "anything.at.all", True),
+        ("#.#", "orders", True),
+        ("*.#.*", "orders", False),
+        ("*.#.*", "orders.created", True),
+    ],
+)
+def test_topic_trie(pattern, routing_key, matches):
+    trie = TopicTrie()
+    trie.add(pattern, "handler")
+
+    assert trie.match(routing_key) == (["handler"] if matches else [])
+
+
+def test_topic_trie_order():
+    trie = TopicTrie()
+    trie.add("orders.#", 1)
+    trie.add("orders.*.created", 2)
+    trie.add("#", 3)
+    trie.add("invoices.#", 4)
+
+    assert trie.match("orders.eu.created") == [1, 2, 3]
+
+
+def test_router_dispatch():
+    router = Router()
+    created = mock.Mock()
+    audit = mock.Mock()
+    router.add("orders.*.created", created)
+    router.add("orders.#", audit)
+    method = pika.spec.Basic.Deliver(routing_key="orders.eu.deleted")
+
+    router.dispatch(None, method, None, b"body")
+
+    created.assert_not_called()
+    audit.assert_called_once_with(None, method, None, b"body")
+
+
+def test_router_dispatch_runs_all_handlers_if_one_raises():
+    router = Router()
+    created = mock.Mock(side_effect=ValueError("created"))
+    audit = mock.Mock(side_effect=KeyError("audit"))
+    everything = mock.Mock()
+    router.add("orders.*.created", created)
+    router.add("orders.#", audit)
+    router.add("#", everything)
+    method = pika.spec.Basic.Deliver(routing_key="orders.eu.created")
+
+    with pytest.raises(ValueError):
+        router.dispatch(None, method, None, b"body")
+
+    audit.assert_called_once_with(None, method, None, b"body")
+    everything.assert_called_once_with(None, method, None, b"body")
@@ -0,0 +1,57 @@
+from unittest import mock
+
+from flask_coney.scheduler import TimingWheel
+
+
+def test_timing_wheel():
+    wheel = TimingWheel(tick=1, slots=4)
+    fired = []
+
+    wheel.schedule(2, lambda: fired.append("a"))
+    wheel.schedule(0, lambda: fired.append("b"))
+    wheel.schedule(9, lambda: fired.append("c"))
+
+    assert len(wheel) == 3
+    assert [wheel.advance() for _ in range(10)] == [1, 1, 0, 0, 0, 0, 0, 0, 1, 0]
+    assert fired == ["b", "a", "c"]
+    assert len(wheel) == 0
+
+
+def test_timing_wheel_rounds_up_to_tick():
+    wheel = TimingWheel(tick=0.1, slots=8)
+    callback = mock.Mock()
+
+    wheel.schedule(0.25, callback)
+
+    wheel.advance()
+    wheel.advance()
+    callback.assert_not_called()
+    wheel.advance()
+    callback.assert_called_once_with()
+
+
+def test_timing_wheel_failing_callback():
+    wheel = TimingWheel(tick=1, slots=4)
+    callback = mock.Mock()
+    wheel.schedule(1, mock.Mock(side_effect=ValueError()))
+    wheel.schedule(1, callback)
+
+    assert wheel.advance() == 2
+    callback.assert_called_once_with()
+
+
+def test_timing_wheel_thread():
+    wheel = TimingWheel(tick=0.01, slots=16)
+    callback = mock.Mock()
+
+    wheel.start()
+    wheel.schedule(0.05, callback)
+    try:
+        for _ in range(100):
+            if callback.called:
+                break
+            wheel._stopped.wait(0.01)
+    finally:
+        wheel.stop()
+
+    callback.assert_called_once_with()
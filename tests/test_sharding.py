@@ -0,0 +1,49 @@
+from collections import Counter
+from unittest import mock
+
+import pytest
+
+from flask_coney import Coney
+from flask_coney.sharding import HashRing
+
+
+def test_hash_ring_spreads_keys():
+    ring = HashRing([f"events.{i}" for i in range(4)])
+
+    counts = Counter(ring.get(str(key)) for key in range(4000))
+
+    assert set(counts) == set(ring.nodes)
+    assert min(counts.values()) > 600
+
+
+def test_hash_ring_moves_few_keys():
+    before = HashRing(["a", "b", "c", "d"])
+    after = HashRing(["a", "b", "c", "d", "e"])
+
+    moved = [key for key in map(str, range(1000)) if before.get(key) != after.get(key)]
+
+    assert all(after.get(key) == "e" for key in moved)
+    assert len(moved) < 350
+
+
+def test_sharded_queue(app):
+    coney = Coney(app, testing=True)
+    events = coney.sharded_queue("events", shards=4)
+
+    assert events.queue_names == ["events.0", "events.1", "events.2", "events.3"]
+    assert events.shard_for("user-1") == events.shard_for("user-1")
+
+    with mock.patch.object(coney, "queue") as queue:
+        events.queue(shards=[1, 3])(lambda *args: None)
+
+    assert [call[1]["queue_name"] for call in queue.call_args_list] == [
+        "events.1",
+        "events.3",
+    ]
+
+
+def test_publish_partition_key_without_sharded_queue(app):
+    coney = Coney(app, testing=True)
+
+    with pytest.raises(RuntimeError):
+        coney.publish("body", exchange_name="events", partition_key="user-1", app=app)
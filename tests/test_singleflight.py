@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from flask_coney import SyncTimeoutError
+from flask_coney.singleflight import SingleFlight
+
+
+def run_concurrently(flight, fn, n=5):
+    results = []
+
+    def target():
+        try:
+            results.append(flight.do("key", fn))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_single_flight_shares_result():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        return "result"
+
+    results = run_concurrently(SingleFlight(), fn)
+
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+
+
+def test_single_flight_shares_error():
+    def fn():
+        time.sleep(0.1)
+        raise SyncTimeoutError()
+
+    results = run_concurrently(SingleFlight(), fn)
+
+    assert len(results) == 5
+    assert all(isinstance(r, SyncTimeoutError) for r in results)
+
+
+def test_single_flight_sequential_calls():
+    flight = SingleFlight()
+
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+
+    with pytest.raises(ValueError):
+        flight.do("key", lambda: int("a"))
+
+    assert flight.do("key", lambda: 3) == 3
@@ -0,0 +1,105 @@
+import json
+import logging
+import time
+
+import pytest
+
+from flask_coney.headers import PARENT_SPAN_HEADER
+from flask_coney.headers import PUBLISHED_AT_HEADER
+from flask_coney.headers import RECEIVED_AT_HEADER
+from flask_coney.headers import TRACE_ID_HEADER
+from flask_coney.tracing import InMemorySpanExporter
+from flask_coney.tracing import LoggingSpanExporter
+from flask_coney.tracing import Span
+from flask_coney.tracing import Tracer
+from flask_coney.utils import time_ns
+
+
+@pytest.fixture
+def exporter():
+    return InMemorySpanExporter()
+
+
+def test_inject_starts_trace(exporter):
+    tracer = Tracer(exporter)
+
+    headers = tracer.inject({"a": 1})
+
+    assert headers["a"] == 1
+    assert len(headers[TRACE_ID_HEADER]) == 32
+    assert PARENT_SPAN_HEADER not in headers
+    assert headers[PUBLISHED_AT_HEADER] > 0
+
+
+def test_consume_records_spans(exporter):
+    tracer = Tracer(exporter)
+    headers = tracer.inject()
+    received_ns = headers[PUBLISHED_AT_HEADER] + 5_000_000
+
+    with tracer.consume("orders", "orders.created", headers, received_ns) as context:
+        child = tracer.inject()
+    assert tracer.current() is None
+
+    queue, handle = exporter.spans
+    assert queue.name == "coney.queue"
+    assert queue.duration == pytest.approx(0.005)
+    assert queue.attributes["messaging.destination"] == "orders"
+    assert handle.name == "coney.handle"
+    assert handle.span_id == context.span_id
+    assert {queue.trace_id, handle.trace_id} == {headers[TRACE_ID_HEADER]}
+    assert child[TRACE_ID_HEADER] == headers[TRACE_ID_HEADER]
+    assert child[PARENT_SPAN_HEADER] == context.span_id
+
+
+def test_consume_records_errors(exporter):
+    tracer = Tracer(exporter)
+
+    with pytest.raises(ValueError):
+        with tracer.consume("orders", "orders", None, 0):
+            raise ValueError()
+
+    (handle,) = exporter.spans
+    assert handle.attributes["error"] == "ValueError"
+
+
+def test_record_rpc(exporter):
+    tracer = Tracer(exporter)
+    request = tracer.inject()
+    request[PUBLISHED_AT_HEADER] -= 1_000_000_000
+    start = request[PUBLISHED_AT_HEADER]
+    reply = {RECEIVED_AT_HEADER: start + 1000, PUBLISHED_AT_HEADER: start + 3000}
+
+    rpc = tracer.record_rpc("rpc", request, reply)
+
+    names = [span.name for span in exporter.spans]
+    assert names == [
+        "coney.rpc",
+        "coney.rpc.request",
+        "coney.rpc.server",
+        "coney.rpc.reply",
+    ]
+    _, request_span, server, reply_span = exporter.spans
+    assert request_span.end_ns - request_span.start_ns == 1000
+    assert server.end_ns - server.start_ns == 2000
+    assert reply_span.end_ns == rpc.end_ns
+    assert {span.parent_id for span in exporter.spans[1:]} == {rpc.span_id}
+
+
+def test_logging_exporter(caplog):
+    span = Span("coney.handle", "t" * 32, "s" * 16, "p" * 16, 1, 2, {"n": 1})
+
+    with caplog.at_level(logging.INFO):
+        LoggingSpanExporter().export(span)
+
+    otlp = json.loads(caplog.records[0].getMessage().split(" ", 1)[1])
+    assert otlp["parentSpanId"] == "p" * 16
+    assert otlp["kind"] == "SPAN_KIND_CONSUMER"
+    assert otlp["startTimeUnixNano"] == "1"
+    assert otlp["attributes"] == [{"key": "n", "value": {"intValue": "1"}}]
+
+
+def test_time_ns_without_time_ns(monkeypatch):
+    monkeypatch.delattr(time, "time_ns")
+    monkeypatch.setattr(time, "time", lambda: 1.5)
+
+    assert time_ns() == 1500000000